@@ -0,0 +1,518 @@
+# coding=utf-8
+
+from argparse import ArgumentParser, Namespace
+from os import path, mkdir, listdir, remove
+from os.path import exists, dirname, realpath
+from sys import exit, executable
+from subprocess import run, PIPE
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import perf_counter, sleep, time
+from typing import Dict, List
+from random import Random
+from threading import Thread
+import tracemalloc
+import resource
+
+from core import globals
+from core.utils import ErrorLevel, Log
+from core.storage import CreateUserRecord, JournalStorage, RECORD_USER, RECORD_INTERVAL
+from core.monitor import PresenceMonitor
+from core.userinfo import TOKEN_CACHE_SUFFIX
+from core.index import PresenceIndex
+from core.statusbatch import ExtractStatuses, EvaluateStatuses, LoadNumpy
+from core.decoders import JsonBackend
+from core.replay import CreateOfflineMonitor, ReplayDriver, SyntheticFeed, ReadRecording
+from core.fakefacebook import FakeFacebook, StartFakeFacebook, FakeFacebookConfig
+
+SOAK_SAVE_COUNT = 10 # same loop as server.py: a save every 10th cycle, 2s apart
+SOAK_SLEEP_TIME = 2
+
+REPLAY_BUDDY_COUNTS = [100, 1000, 10000]
+
+STARTUP_USERS       = 2000 # users in the db the startup benchmark loads
+STARTUP_INTERVALS   = 100  # closed intervals per user
+STARTUP_LATENCY     = 0.2  # seconds the stand-in server takes to answer, roughly a facebook round trip
+
+LATENCY_PUSHES      = 30          # messages pushed through the stand-in server per pull mode
+LATENCY_PUSH_GAP    = (0.2, 1.5)  # seconds between two pushes
+LATENCY_HOLD_TIME   = 10          # long-poll hold time of the stand-in server
+LATENCY_SLEEP_TIME  = 2           # same loop as server.py
+
+def Percentile(values: List[float], fraction: float) -> float:
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def ReplayOnce(recording: List, measureMemory: bool):
+	# replays into a fresh monitor, returns the stats, the time of a full save and the peak memory
+	workDir = mkdtemp()
+	try:
+		pm = CreateOfflineMonitor(workDir)
+		if measureMemory:
+			tracemalloc.start()
+		stats = ReplayDriver(pm).replay(recording)
+		begin = perf_counter()
+		pm.saveDB(isFullSave=True)
+		saveTime = perf_counter() - begin
+		peakMemory = None
+		if measureMemory:
+			peakMemory = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+		pm.storage.close()
+		return stats, saveTime, peakMemory
+	finally:
+		rmtree(workDir)
+
+def PrintReplay(label: str, recording: List):
+	# timings come from a plain run, tracemalloc slows everything down so memory gets its own run
+	stats, saveTime, _ = ReplayOnce(recording, measureMemory=False)
+	_, _, peakMemory = ReplayOnce(recording, measureMemory=True)
+	print("{}: {} payloads, {} messages, {} presence events".format(label, stats.payloads, stats.messages, stats.presences))
+	print("  {:>24} {:>12.0f}".format("events/s", stats.presences / max(stats.decodeTime + stats.processTime, 1e-9)))
+	print("  {:>24} {:>12.3f}".format("decode ms", stats.decodeTime * 1e3))
+	print("  {:>24} {:>12.3f}".format("process ms", stats.processTime * 1e3))
+	print("  {:>24} {:>12.3f}".format("full save ms", saveTime * 1e3))
+	print("  {:>24} {:>12.1f}".format("peak memory KiB", peakMemory / 1024))
+	print("  {:>24} {:>8} {:>12} {:>12}".format("message type", "count", "mean us", "p99 us"))
+	for itemType, latencies in sorted(stats.typeLatencies.items(), key=lambda item: str(item[0])):
+		print("  {:>24} {:>8} {:>12.2f} {:>12.2f}".format(
+			str(itemType), len(latencies), sum(latencies) / len(latencies) * 1e6, Percentile(latencies, 0.99) * 1e6
+		))
+
+def BenchmarkTransitions(args: Namespace):
+	# per event cost of processPresence should not depend on the length of the history
+	workDir = mkdtemp()
+	try:
+		pm = CreateOfflineMonitor(workDir)
+		print("{:>10} {:>14}".format("history", "us/event"))
+		for historySize in [100, 1000, 10000, 100000]:
+			uid = str(historySize)
+			pm.db[uid] = CreateUserRecord()
+			for i in range(historySize):
+				pm.db[uid]["online"].append(2 * i, 2 * i + 1)
+			timeStamp = 2 * historySize
+			begin = perf_counter()
+			for i in range(args.events):
+				pm.processPresence(pm.createPresence(uid, timeStamp + i, online=(i % 2 == 0)), "online")
+			elapsed = perf_counter() - begin
+			print("{:>10} {:>14.3f}".format(historySize, elapsed / args.events * 1e6))
+	finally:
+		rmtree(workDir)
+
+def BenchmarkReplay(args: Namespace):
+	# whole /pull pipeline (decode, dispatch, state machine, save) on synthetic feeds,
+	# or on a feed recorded with server.py --record
+	print("json backend: {}".format(JsonBackend()))
+	if args.feed is not None:
+		PrintReplay(args.feed, list(ReadRecording(args.feed)))
+		return
+	for buddyCount in REPLAY_BUDDY_COUNTS:
+		PrintReplay("{} buddies".format(buddyCount), SyntheticFeed(buddyCount).generate(args.payloads))
+
+def BenchmarkStale(args: Namespace):
+	# cost of one stale user check and the presence queries it sends over an hour of
+	# simulated time, with every user online and the query answers saying "still online"
+	workDir = mkdtemp()
+	try:
+		print("{:>10} {:>14} {:>14}".format("online", "us/check", "queries/hour"))
+		for userCount in [1000, 10000, 100000]:
+			userDir = path.join(workDir, str(userCount))
+			mkdir(userDir)
+			pm = CreateOfflineMonitor(userDir)
+			now = 1000000
+			pm.epochClock = lambda: now
+			for i in range(userCount):
+				pm.processPresence(pm.createPresence(str(i), now - i % 600, online=True), "online")
+			queries, elapsed, checks = 0, 0.0, 0
+			for step in range(0, 3600, 2):
+				now += 2
+				begin = perf_counter()
+				staleUsers = pm.getStaleUsers()
+				elapsed += perf_counter() - begin
+				checks += 1
+				for uid in staleUsers:
+					pm.staleScheduler.confirmed(uid, now)
+				queries += len(staleUsers)
+			print("{:>10} {:>14.3f} {:>14}".format(userCount, elapsed / checks * 1e6, queries))
+			pm.storage.close()
+	finally:
+		rmtree(workDir)
+
+def ProcessStatusesPerItem(pm: PresenceMonitor, entries: dict, lastActiveKey: str, activeKey: str):
+	# the per buddy path the monitor used before core.statusbatch, kept as the baseline
+	for uid, entry in entries.items():
+		if lastActiveKey in entry:
+			isOnline = not pm.isOlderThanDelta(entry[lastActiveKey])
+			if activeKey in entry:
+				isActive = (entry[activeKey] != 0) and isOnline
+			elif isOnline is False:
+				isActive = False
+			else:
+				isActive = None
+			isMobile = False if isOnline is False else None
+			pm.processByMatchingStates(pm.createPresence(uid, pm.clock(), isOnline, isActive, isMobile))
+
+def ProcessStatusesBatch(useNumpy: bool):
+	def process(pm: PresenceMonitor, entries: dict, lastActiveKey: str, activeKey: str):
+		uids, lastActive, active = ExtractStatuses(entries, lastActiveKey, activeKey)
+		online, active = EvaluateStatuses(lastActive, active, pm.onlineCutoff(), useNumpy)
+		pm.applyStatuses(uids, online, active, pm.clock())
+	return process
+
+def BenchmarkBuddyList(args: Namespace):
+	# full chatproxy-presence buddy lists through the per item and the batch paths,
+	# every path starts from an empty monitor and has to end with the same open intervals
+	paths = [("per item", ProcessStatusesPerItem), ("batch", ProcessStatusesBatch(False))]
+	if LoadNumpy() is not None:
+		paths.append(("batch numpy", ProcessStatusesBatch(True)))
+	workDir = mkdtemp()
+	try:
+		print("{:>10} {:>14} {:>14}".format("buddies", "path", "us/buddy"))
+		for buddyCount in REPLAY_BUDDY_COUNTS:
+			feed = SyntheticFeed(buddyCount)
+			messages = [feed.buddyList()["buddyList"] for _ in range(10)]
+			openIntervals = None
+			for name, process in paths:
+				pathDir = path.join(workDir, "{}-{}".format(buddyCount, len(listdir(workDir))))
+				mkdir(pathDir)
+				pm = CreateOfflineMonitor(pathDir)
+				pm.epochClock = lambda: feed.now
+				pm.clock = lambda: int(feed.now)
+				begin = perf_counter()
+				for entries in messages:
+					process(pm, entries, "lat", "p")
+				elapsed = perf_counter() - begin
+				if openIntervals is not None and pm.openIntervals != openIntervals:
+					Log(ErrorLevel.error, "{} path ended in a different state", name)
+				openIntervals = pm.openIntervals
+				pm.storage.close()
+				print("{:>10} {:>14} {:>14.3f}".format(buddyCount, name, elapsed / (len(messages) * buddyCount) * 1e6))
+	finally:
+		rmtree(workDir)
+
+def BenchmarkIndex(args: Namespace):
+	# "who was online at T" through the interval index against a scan of every user,
+	# 1000 users with alternating online/offline histories of growing length
+	random = Random(0)
+	print("{:>12} {:>14} {:>14}".format("intervals", "index us", "scan us"))
+	for perUser in [10, 100, 1000]:
+		db = {}
+		for uid in range(1000):
+			user = db[str(uid)] = CreateUserRecord()
+			timeStamp = random.randint(0, 600)
+			for _ in range(perUser):
+				length = random.randint(60, 3600)
+				user["online"].append(timeStamp, timeStamp + length)
+				timeStamp += length + random.randint(60, 7200)
+		index = PresenceIndex.fromDatabase(db)
+		end = max(user["online"][-1][1] for user in db.values())
+		moments = [random.randint(0, end) for _ in range(100)]
+		begin = perf_counter()
+		for moment in moments:
+			index.usersAt("online", moment)
+		indexTime = (perf_counter() - begin) / len(moments)
+		begin = perf_counter()
+		for moment in moments:
+			[uid for uid, user in db.items() if len(user["online"].slice(moment, moment)) != 0]
+		scanTime = (perf_counter() - begin) / len(moments)
+		print("{:>12} {:>14.1f} {:>14.1f}".format(perUser * 1000, indexTime * 1e6, scanTime * 1e6))
+
+class SoakProbe:
+	# installed as the monitor's feed recorder to timestamp the arrival of every /pull
+	# response, and around resetParameters to time the recovery after a failed cycle
+
+	def __init__(self, pm: PresenceMonitor):
+		self.receivedAt = None # type: float
+		self.resetAt = None # type: float
+		self.resets = 0
+		self.recoveries = [] # type: List[float]
+		self.resetParameters = pm.resetParameters
+		pm.recorder = self
+		pm.resetParameters = self.reset
+
+	def record(self, rawResponse: str):
+		self.receivedAt = perf_counter()
+
+	def reset(self):
+		self.resets += 1
+		if self.resetAt is None:
+			self.resetAt = perf_counter()
+		self.resetParameters()
+
+	def cycleDone(self):
+		if self.resetAt is not None and self.receivedAt is not None and self.receivedAt > self.resetAt:
+			self.recoveries.append(perf_counter() - self.resetAt)
+			self.resetAt = None
+
+def BenchmarkSoak(args: Namespace):
+	# runs the threaded monitor loop against the stand-in server for --duration seconds,
+	# every --report seconds prints the processing latency of the /pull responses
+	# (arrival to processed), the peak rss and how fast it got back after resets
+	workDir = mkdtemp()
+	fake = FakeFacebook(args.friends, holdTime=args.hold, errorRate=args.error_rate)
+	server = StartFakeFacebook(fake, port=0)
+	try:
+		configPath = path.join(workDir, "soak.conf")
+		with open(configPath, 'w') as configFile:
+			configFile.write(FakeFacebookConfig(*server.server_address) + "bus_port=0\nmetrics_port=0\n")
+		pm = PresenceMonitor(configPath, path.join(workDir, "database.json"))
+		probe = SoakProbe(pm)
+		print("{:>8} {:>8} {:>10} {:>8} {:>10} {:>10} {:>10} {:>8} {:>10}".format(
+			"time s", "cycles", "messages", "users", "p50 ms", "p99 ms", "max ms", "resets", "rss MiB"
+		))
+		begin = perf_counter()
+		nextReport = begin + args.report
+		cycles, latencies = 0, []
+		while perf_counter() - begin < args.duration:
+			probe.receivedAt = None
+			try:
+				pm.query()
+				cycles += 1
+				if cycles % SOAK_SAVE_COUNT == 0:
+					pm.saveDB()
+			except:
+				pm.resetParameters()
+			if probe.receivedAt is not None:
+				latencies.append(perf_counter() - probe.receivedAt)
+			probe.cycleDone()
+			if perf_counter() >= nextReport and len(latencies) != 0:
+				print("{:>8.0f} {:>8} {:>10} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>8} {:>10.1f}".format(
+					perf_counter() - begin, cycles, fake.stats.messages, len(pm.db),
+					Percentile(latencies, 0.5) * 1e3, Percentile(latencies, 0.99) * 1e3, max(latencies) * 1e3,
+					probe.resets, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+				))
+				nextReport += args.report
+				latencies = []
+			sleep(SOAK_SLEEP_TIME)
+		pm.saveAll()
+		pm.storage.close()
+		if len(probe.recoveries) != 0:
+			print("recovered from {} resets, mean {:.2f}s, max {:.2f}s".format(
+				len(probe.recoveries), sum(probe.recoveries) / len(probe.recoveries), max(probe.recoveries)
+			))
+		print("fake server: {}".format(fake.stats.toDict()))
+	finally:
+		fake.stop()
+		server.shutdown()
+		rmtree(workDir)
+
+def CreateStartupDatabase(dbPath: str):
+	storage = JournalStorage(dbPath)
+	storage.load()
+	version = 0
+	records = []
+	for uid in range(STARTUP_USERS):
+		version += 1
+		records.append([RECORD_USER, str(uid), "user {}".format(uid), None, None, version])
+		timeStamp = 1500000000 + uid
+		for _ in range(STARTUP_INTERVALS):
+			version += 1
+			records.append([RECORD_INTERVAL, str(uid), "online", timeStamp, timeStamp + 600, version])
+			timeStamp += 3600
+	storage.append(records)
+	storage.compact(wait=True)
+	storage.close()
+
+def MeasureImport() -> float:
+	# in a fresh interpreter, nothing imported yet
+	script = "from time import perf_counter; begin = perf_counter(); import core.monitor; print(perf_counter() - begin)"
+	result = run([executable, "-c", script], cwd=dirname(realpath(__file__)), stdout=PIPE, universal_newlines=True)
+	return float(result.stdout.strip()) if result.returncode == 0 else float("nan")
+
+def StartupOnce(configPath: str, dbPath: str, fake: FakeFacebook, loadInBackground: bool, cachedToken: bool):
+	# seconds from the constructor call until it returned, until the stand-in server got the
+	# first /pull and until the first response was processed, plus the token pages fetched
+	if not cachedToken and exists(dbPath + TOKEN_CACHE_SUFFIX):
+		remove(dbPath + TOKEN_CACHE_SUFFIX)
+	fake.stats.firstPullAt = None
+	tokenPages = fake.stats.tokenPages
+	begin = time()
+	pm = PresenceMonitor(configPath, dbPath, loadInBackground=loadInBackground)
+	constructed = time()
+	pm.query()
+	processed = time()
+	# the first presence query needs the token
+	pm.queryManager.getToken()
+	pm.saveAll()
+	pm.storage.close()
+	return constructed - begin, fake.stats.firstPullAt - begin, processed - begin, fake.stats.tokenPages - tokenPages
+
+def BenchmarkStartup(args: Namespace):
+	# restart of the monitor against the stand-in server with a db of STARTUP_USERS users:
+	# reading the db before the first /pull against reading it while the /pull is out,
+	# with and without the fb_dtsg token cached on disk
+	print("import core.monitor: {:.1f} ms".format(MeasureImport() * 1e3))
+	workDir = mkdtemp()
+	fake = FakeFacebook(args.friends, holdTime=0, eventRate=0, burstChance=0, latency=(STARTUP_LATENCY, STARTUP_LATENCY))
+	server = StartFakeFacebook(fake, port=0)
+	try:
+		configPath = path.join(workDir, "startup.conf")
+		with open(configPath, 'w') as configFile:
+			configFile.write(FakeFacebookConfig(*server.server_address) + "bus_port=0\nmetrics_port=0\n")
+		dbPath = path.join(workDir, "database.json")
+		CreateStartupDatabase(dbPath)
+		print("{:>34} {:>10} {:>14} {:>16} {:>8}".format("", "init ms", "first pull ms", "processed ms", "tokens"))
+		for label, loadInBackground, cachedToken in [
+			("db before pull, no cached token", False, False),
+			("db during pull, no cached token", True, False),
+			("db during pull, cached token", True, True)
+		]:
+			initTime, pullTime, processedTime, tokenPages = StartupOnce(configPath, dbPath, fake, loadInBackground, cachedToken)
+			print("{:>34} {:>10.1f} {:>14.1f} {:>16.1f} {:>8}".format(
+				label, initTime * 1e3, pullTime * 1e3, processedTime * 1e3, tokenPages
+			))
+	finally:
+		fake.stop()
+		server.shutdown()
+		rmtree(workDir)
+
+class LatencyProbe:
+	# wrapped around processMessageContent: when each pushed message was handled.
+	# the pushed messages are "inbox" ones with a marker in seen_timestamp
+
+	def __init__(self, pm: PresenceMonitor):
+		self.handledAt = {} # type: Dict[int, float]
+		self.processMessageContent = pm.processMessageContent
+		pm.processMessageContent = self.process
+
+	def process(self, msContent: List):
+		self.processMessageContent(msContent)
+		handledAt = perf_counter()
+		for msItem in msContent:
+			if msItem.get("type") == "inbox":
+				self.handledAt[msItem["seen_timestamp"]] = handledAt
+
+def LatencyOnce(workDir: str, pullMode: str) -> List[float]:
+	# the server.py loop in a thread, messages pushed at random moments,
+	# returns the seconds from the push until the monitor handled the message
+	fake = FakeFacebook(100, holdTime=LATENCY_HOLD_TIME, eventRate=0, burstChance=0)
+	server = StartFakeFacebook(fake, port=0)
+	running = True
+	try:
+		configPath = path.join(workDir, pullMode + ".conf")
+		with open(configPath, 'w') as configFile:
+			configFile.write(FakeFacebookConfig(*server.server_address) + "bus_port=0\nmetrics_port=0\npull_mode={}\n".format(pullMode))
+		pm = PresenceMonitor(configPath, path.join(workDir, pullMode + ".json"))
+		probe = LatencyProbe(pm)
+
+		def loop():
+			while running:
+				pm.query()
+				sleep(pm.nextCycleDelay(LATENCY_SLEEP_TIME))
+
+		thread = Thread(target=loop, daemon=True)
+		thread.start()
+		random = Random(0)
+		pushedAt = {}
+		for marker in range(LATENCY_PUSHES):
+			sleep(random.uniform(*LATENCY_PUSH_GAP))
+			pushedAt[marker] = perf_counter()
+			fake.push([{"type": "inbox", "unseen": 1, "unread": 0, "seen_timestamp": marker}])
+		sleep(LATENCY_SLEEP_TIME + 1)
+		running = False
+		# releases the held request
+		fake.push([{"type": "inbox", "unseen": 0, "unread": 0, "seen_timestamp": -1}])
+		thread.join()
+		pm.saveAll()
+		pm.storage.close()
+		return [probe.handledAt[marker] - pushedAt[marker] for marker in pushedAt if marker in probe.handledAt]
+	finally:
+		fake.stop()
+		server.shutdown()
+
+def BenchmarkLatency(args: Namespace):
+	# time from an event on the stand-in server to its handling in the monitor:
+	# a request per payload plus the loop's sleep against the open stream
+	workDir = mkdtemp()
+	try:
+		print("{:>8} {:>8} {:>10} {:>10} {:>10}".format("mode", "events", "mean ms", "p50 ms", "max ms"))
+		for pullMode in ["poll", "stream"]:
+			latencies = LatencyOnce(workDir, pullMode)
+			print("{:>8} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+				pullMode, len(latencies), sum(latencies) / len(latencies) * 1e3,
+				Percentile(latencies, 0.5) * 1e3, max(latencies) * 1e3
+			))
+	finally:
+		rmtree(workDir)
+
+BENCHMARKS = {
+	"transitions": BenchmarkTransitions,
+	"replay": BenchmarkReplay,
+	"soak": BenchmarkSoak,
+	"stale": BenchmarkStale,
+	"buddylist": BenchmarkBuddyList,
+	"index": BenchmarkIndex,
+	"startup": BenchmarkStartup,
+	"latency": BenchmarkLatency
+}
+DEFAULT_BENCHMARKS = ["buddylist", "index", "latency", "replay", "stale", "startup", "transitions"] # soak runs for --duration, only on request
+
+def InitArguments() -> Namespace:
+	parser = ArgumentParser(
+		prog="python " + path.basename(__file__),
+		description="Micro-benchmarks of the presence monitor. "
+		            "Nothing is sent to facebook."
+	)
+	parser.add_argument(
+		"benchmark",
+		metavar='BENCHMARK', nargs='*',
+		help="Benchmarks to run: {} (default: {})".format(
+			", ".join(sorted(BENCHMARKS.keys())), ", ".join(DEFAULT_BENCHMARKS)
+		)
+	)
+	parser.add_argument(
+		"-n", "--events",
+		metavar='EVENTS', type=int, default=20000,
+		help="Number of presence events per measurement"
+	)
+	parser.add_argument(
+		"-p", "--payloads",
+		metavar='PAYLOADS', type=int, default=2000,
+		help="Number of synthetic /pull payloads replayed per buddy list size"
+	)
+	parser.add_argument(
+		"-f", "--feed",
+		metavar='RECORD_FILE', default=None,
+		help="Replay this recorded feed instead of the synthetic ones"
+	)
+	parser.add_argument(
+		"--duration",
+		metavar='SECONDS', type=float, default=60,
+		help="Length of the soak test against the stand-in server"
+	)
+	parser.add_argument(
+		"--report",
+		metavar='SECONDS', type=float, default=10,
+		help="Soak test report interval"
+	)
+	parser.add_argument(
+		"--friends",
+		metavar='FRIENDS', type=int, default=10000,
+		help="Simulated friends of the soak test"
+	)
+	parser.add_argument(
+		"--hold",
+		metavar='SECONDS', type=float, default=50,
+		help="Long-poll hold time of the stand-in server"
+	)
+	parser.add_argument(
+		"--error-rate",
+		metavar='RATE', type=float, default=0.01,
+		help="Share of the stand-in server's responses that fail"
+	)
+	return parser.parse_args()
+
+def main():
+	globals.LOG_LEVEL = ErrorLevel.warning
+	args = InitArguments()
+	unknown = [name for name in args.benchmark if name not in BENCHMARKS]
+	if len(unknown) != 0:
+		Log(ErrorLevel.error, "unknown benchmark: {}", ", ".join(unknown))
+		return 1
+	for name in (args.benchmark or DEFAULT_BENCHMARKS):
+		print("### {}".format(name))
+		BENCHMARKS[name](args)
+	return 0
+
+if __name__ == "__main__":
+	exit(main())
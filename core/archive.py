@@ -0,0 +1,203 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple
+from os.path import exists, join, dirname, abspath
+from os import mkdir, stat, replace, fsync
+import os
+from time import gmtime
+from collections import OrderedDict
+import gzip
+import json
+
+from core.utils import Log, ErrorLevel
+from core.intervals import IntervalList, STATES, MergeIntervals
+
+ARCHIVE_SUFFIX          = ".archive" # directory of the segments, next to the db
+ARCHIVE_INDEX           = "index.json"
+SEGMENT_EXTENSION       = ".json.gz"
+SEGMENT_TMP_SUFFIX      = ".tmp"
+DEFAULT_RETENTION_DAYS  = 0  # days of raw intervals kept in the db, 0: everything stays
+DEFAULT_MERGE_GAP       = 60 # seconds, closer intervals are merged when they are archived
+MAX_LOADED_SEGMENTS     = 12 # months kept in memory by a reader
+
+class RetentionPolicy:
+	# how much history the db keeps: closed intervals that ended more than `rawDays` ago
+	# are merged (gaps shorter than `mergeGap` filled) and moved into the archive
+
+	def __init__(self, rawDays: float = DEFAULT_RETENTION_DAYS, mergeGap: int = DEFAULT_MERGE_GAP):
+		self.rawDays = rawDays
+		self.mergeGap = mergeGap
+
+	@staticmethod
+	def fromConfig(secrets: Dict[str, str]) -> 'RetentionPolicy':
+		return RetentionPolicy(
+			rawDays=float(secrets.get("retention_days", DEFAULT_RETENTION_DAYS)),
+			mergeGap=int(secrets.get("archive_merge_gap", DEFAULT_MERGE_GAP))
+		)
+
+	def isEnabled(self) -> bool:
+		return self.rawDays > 0
+
+	def cutoff(self, now: int) -> int:
+		return int(now - self.rawDays * 24 * 60 * 60)
+
+def ArchiveDirectory(dbPath: str) -> str:
+	return dbPath + ARCHIVE_SUFFIX
+
+def SegmentName(timeStamp: int) -> str:
+	# an interval belongs to the month it started in
+	date = gmtime(timeStamp)
+	return "{:04}-{:02}".format(date.tm_year, date.tm_mon)
+
+def DropExpired(db: Dict, cutoff: int) -> Dict[str, Dict[str, IntervalList]]:
+	# removes the closed intervals that ended before the cutoff from the db, returns them
+	expired = {}
+	for uid in db:
+		for state in STATES:
+			intervals = db[uid][state].dropBefore(cutoff)
+			if len(intervals) != 0:
+				expired.setdefault(uid, {})[state] = intervals
+	return expired
+
+def LoadArchiveIndex(archivePath: str) -> Dict:
+	# {"archivedUntil": timestamp, "segments": {name: [first start, last end]}}
+	indexPath = join(archivePath, ARCHIVE_INDEX)
+	if not exists(indexPath):
+		return { "archivedUntil": None, "segments": {} }
+	with open(indexPath, 'r') as indexFile:
+		return json.loads(indexFile.read())
+
+def LoadSegment(segmentPath: str) -> Dict[str, Dict[str, IntervalList]]:
+	with gzip.open(segmentPath, 'rt', encoding='utf-8') as segmentFile:
+		segment = json.loads(segmentFile.read())
+	return {
+		uid: {state: IntervalList.fromList(intervals) for state, intervals in states.items()}
+		for uid, states in segment.items()
+	}
+
+def SyncDirectory(directory: str):
+	try:
+		directoryFd = os.open(directory, os.O_RDONLY)
+	except OSError:
+		# directories can't be opened on windows, the rename is durable there
+		return
+	try:
+		fsync(directoryFd)
+	finally:
+		os.close(directoryFd)
+
+def WriteSegment(segmentPath: str, segment: Dict[str, Dict[str, IntervalList]]):
+	# durable before it returns: the snapshot drops these intervals right after
+	tmpPath = segmentPath + SEGMENT_TMP_SUFFIX
+	content = {uid: {state: intervals.toList() for state, intervals in states.items()} for uid, states in segment.items()}
+	with open(tmpPath, 'wb') as tmpFile:
+		with gzip.GzipFile(fileobj=tmpFile, mode='wb') as segmentFile:
+			segmentFile.write(json.dumps(content).encode('utf-8'))
+		tmpFile.flush()
+		fsync(tmpFile.fileno())
+	replace(tmpPath, segmentPath)
+
+def WriteArchiveIndex(archivePath: str, archiveIndex: Dict):
+	indexPath = join(archivePath, ARCHIVE_INDEX)
+	tmpPath = indexPath + SEGMENT_TMP_SUFFIX
+	with open(tmpPath, 'w') as indexFile:
+		indexFile.write(json.dumps(archiveIndex))
+		indexFile.flush()
+		fsync(indexFile.fileno())
+	replace(tmpPath, indexPath)
+
+def ArchiveIntervals(dbPath: str, expired: Dict[str, Dict[str, IntervalList]], cutoff: int, mergeGap: int):
+	# merges the expired intervals into their month segments. segments are rewritten
+	# before the snapshot drops the intervals, so after a crash in between they are
+	# archived again, merging them into what is there already makes that a no-op
+	archivePath = ArchiveDirectory(dbPath)
+	if not exists(archivePath):
+		mkdir(archivePath)
+		SyncDirectory(dirname(abspath(archivePath)))
+	archiveIndex = LoadArchiveIndex(archivePath)
+	byMonth = {} # type: Dict[str, Dict[str, Dict[str, List[Tuple[int, int]]]]]
+	for uid, states in expired.items():
+		for state, intervals in states.items():
+			for start, end in intervals:
+				byMonth.setdefault(SegmentName(start), {}).setdefault(uid, {}).setdefault(state, []).append((start, end))
+	for name, users in sorted(byMonth.items()):
+		segmentPath = join(archivePath, name + SEGMENT_EXTENSION)
+		segment = LoadSegment(segmentPath) if exists(segmentPath) else {}
+		first, last = archiveIndex["segments"].get(name, [None, None])
+		for uid, states in users.items():
+			for state, intervals in states.items():
+				if uid in segment and state in segment[uid]:
+					intervals = intervals + list(segment[uid][state])
+				# a gap of at least one second so archiving the same interval twice can't duplicate it
+				merged = MergeIntervals(sorted([list(interval) for interval in intervals]), max(1, mergeGap))
+				segment.setdefault(uid, {})[state] = IntervalList.fromList(merged)
+				segmentFirst, segmentLast = merged[0][0], max(end for _, end in merged)
+				first = segmentFirst if first is None else min(first, segmentFirst)
+				last = segmentLast if last is None else max(last, segmentLast)
+		WriteSegment(segmentPath, segment)
+		archiveIndex["segments"][name] = [first, last]
+	archivedUntil = archiveIndex["archivedUntil"]
+	archiveIndex["archivedUntil"] = cutoff if archivedUntil is None else max(archivedUntil, cutoff)
+	WriteArchiveIndex(archivePath, archiveIndex)
+	# the renames of the segments and the index, before the snapshot is written without them
+	SyncDirectory(archivePath)
+	Log(ErrorLevel.info, "{} users archived into {} segments", len(expired), len(byMonth))
+
+class ArchiveReader:
+	# the month segments of a db, loaded when a query reaches back into them and
+	# dropped again least recently used first, so only the hot window stays in memory
+
+	def __init__(self, dbPath: str, maxLoaded: int = MAX_LOADED_SEGMENTS):
+		self.archivePath = ArchiveDirectory(dbPath)
+		self.maxLoaded = maxLoaded
+		self.archiveIndex = { "archivedUntil": None, "segments": {} }
+		self.indexStamp = None
+		# (name, modification time) -> segment
+		self.loaded = OrderedDict() # type: OrderedDict
+
+	def refresh(self):
+		indexPath = join(self.archivePath, ARCHIVE_INDEX)
+		if not exists(indexPath):
+			return
+		indexStamp = stat(indexPath).st_mtime_ns
+		if indexStamp != self.indexStamp:
+			self.archiveIndex = LoadArchiveIndex(self.archivePath)
+			self.indexStamp = indexStamp
+
+	def archivedUntil(self) -> int:
+		# None if nothing was archived yet
+		return self.archiveIndex["archivedUntil"]
+
+	def isNeeded(self, fromTs: int = None) -> bool:
+		# a query without a start covers the hot window only
+		archivedUntil = self.archivedUntil()
+		return archivedUntil is not None and fromTs is not None and fromTs < archivedUntil
+
+	def segment(self, name: str) -> Dict[str, Dict[str, IntervalList]]:
+		segmentPath = join(self.archivePath, name + SEGMENT_EXTENSION)
+		if not exists(segmentPath):
+			return {}
+		key = (name, stat(segmentPath).st_mtime_ns)
+		segment = self.loaded.get(key)
+		if segment is None:
+			Log(ErrorLevel.debug, "loading archive segment {}", name)
+			segment = self.loaded[key] = LoadSegment(segmentPath)
+			while len(self.loaded) > self.maxLoaded:
+				self.loaded.popitem(last=False)
+		self.loaded.move_to_end(key)
+		return segment
+
+	def segmentNames(self, fromTs: int = None, toTs: int = None) -> List[str]:
+		return sorted(
+			name for name, (first, last) in self.archiveIndex["segments"].items()
+			if (fromTs is None or last >= fromTs) and (toTs is None or first <= toTs)
+		)
+
+	def intervals(self, uid: str, state: str, fromTs: int = None, toTs: int = None) -> List[List[int]]:
+		# archived intervals of the user overlapping [fromTs, toTs], in time order
+		result = []
+		for name in self.segmentNames(fromTs, toTs):
+			intervals = self.segment(name).get(uid, {}).get(state)
+			if intervals is not None:
+				result += intervals.slice(fromTs, toTs).toList()
+		return result
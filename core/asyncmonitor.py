@@ -0,0 +1,131 @@
+# coding=utf-8
+
+from typing import List
+from traceback import format_exc
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+from core import globals
+from core.utils import Log, ErrorLevel
+from core.monitor import PresenceMonitor, DatabaseLoadError
+
+DEFAULT_QUERY_CONCURRENCY   = 8   # direct presence requests in flight at once
+QUERY_INTERVAL              = 2   # seconds between two stale user checks
+SAVE_INTERVAL               = 20  # seconds between two db saves
+RETRY_INTERVAL              = 2   # seconds to wait after a failed /pull
+STOP_CHECK_INTERVAL         = 1   # seconds between two checks of globals.RUN_PROGRAM
+
+class AsyncPresenceMonitor:
+	# runs the long-poll, the stale user queries, the profile resolving and the saves
+	# as independent tasks. blocking http calls go to a thread pool, every db change
+	# happens on the event loop thread so the monitor state needs no locking
+
+	def __init__(self, pm: PresenceMonitor, queryConcurrency: int = None):
+		if queryConcurrency is None:
+			queryConcurrency = int(pm.secrets.get("query_concurrency", DEFAULT_QUERY_CONCURRENCY))
+		self.pm = pm
+		self.queryConcurrency = queryConcurrency
+		# +1 thread for the long-poll and +1 for the disk writes
+		self.executor = ThreadPoolExecutor(max_workers=queryConcurrency + 2)
+		self.loop = None # type: asyncio.AbstractEventLoop
+		self.semaphore = None # type: asyncio.Semaphore
+		self.inFlight = set()
+
+	def runBlocking(self, function, *args):
+		return self.loop.run_in_executor(self.executor, function, *args)
+
+	async def limited(self, function, *args):
+		async with self.semaphore:
+			return await self.runBlocking(function, *args)
+
+	async def pullLoop(self):
+		# in stream mode every frame is handled as soon as it is read
+		readFeed = self.pm.nextFeedFrame if self.pm.isStreaming() else self.pm.getRawFeedResponse
+		while True:
+			try:
+				responseObj = await self.runBlocking(readFeed)
+				# the db may still be loading, waiting for it must not block the loop
+				await self.runBlocking(self.pm.waitForDatabase)
+				if responseObj is not None and self.pm.isStreaming():
+					self.pm.handleFeedFrame(responseObj)
+				else:
+					self.pm.handleFeedResponse(responseObj)
+				if responseObj is None:
+					await asyncio.sleep(RETRY_INTERVAL)
+			except asyncio.CancelledError:
+				raise
+			except DatabaseLoadError:
+				# stops the engine, the final save raises it again
+				globals.RUN_PROGRAM = False
+				return
+			except:
+				Log(ErrorLevel.warning, "{}", format_exc())
+				self.pm.resetParameters()
+				await asyncio.sleep(RETRY_INTERVAL)
+
+	async def queryUser(self, uid: str):
+		try:
+			presenceData = await self.limited(self.pm.queryManager.getPresence, uid)
+			self.pm.presenceQueries.inc()
+			self.pm.applyQueriedPresence(uid, presenceData)
+		except asyncio.CancelledError:
+			raise
+		except:
+			Log(ErrorLevel.warning, "presence query of {} failed: {}", uid, format_exc())
+		finally:
+			self.inFlight.discard(uid)
+
+	async def staleLoop(self):
+		while True:
+			staleUsers = [uid for uid in self.pm.getStaleUsers() if uid not in self.inFlight]
+			self.inFlight.update(staleUsers)
+			for uid in staleUsers:
+				self.loop.create_task(self.queryUser(uid))
+			await asyncio.sleep(QUERY_INTERVAL)
+
+	async def profileLoop(self):
+		# the resolver has its own worker threads, this only feeds and drains it
+		await self.runBlocking(self.pm.waitForDatabase)
+		while True:
+			self.pm.resolveProfiles()
+			await asyncio.sleep(QUERY_INTERVAL)
+
+	async def saveLoop(self):
+		await self.runBlocking(self.pm.waitForDatabase)
+		while True:
+			await asyncio.sleep(SAVE_INTERVAL)
+			Log(ErrorLevel.info, "saving finished records to db")
+			try:
+				# saveDB() split up: the append waits on the disk in the executor
+				await self.runBlocking(self.pm.saveRecords, self.pm.takePendingRecords())
+				self.pm.applyRetentionIfDue()
+			except asyncio.CancelledError:
+				raise
+			except:
+				Log(ErrorLevel.warning, "{}", format_exc())
+
+	async def run(self):
+		self.loop = asyncio.get_event_loop()
+		self.semaphore = asyncio.Semaphore(self.queryConcurrency)
+		tasks = [
+			self.loop.create_task(self.pullLoop()),
+			self.loop.create_task(self.staleLoop()),
+			self.loop.create_task(self.profileLoop()),
+			self.loop.create_task(self.saveLoop())
+		] # type: List[asyncio.Task]
+		while globals.RUN_PROGRAM:
+			await asyncio.sleep(STOP_CHECK_INTERVAL)
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		# don't wait for the pending long-poll, the final save doesn't need it
+		self.executor.shutdown(wait=False)
+		self.pm.saveAll()
+
+def StartAsyncPresenceMonitor(pm: PresenceMonitor):
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	try:
+		loop.run_until_complete(AsyncPresenceMonitor(pm).run())
+	finally:
+		loop.close()
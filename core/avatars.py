@@ -0,0 +1,57 @@
+# coding=utf-8
+
+from os.path import join, dirname, exists
+from os import makedirs, replace
+from hashlib import sha1
+import base64
+import re
+
+AVATAR_DIR_NAME     = "avatars"
+AVATAR_TMP_SUFFIX   = ".tmp"
+AVATAR_KEY_REGEX    = re.compile("^[0-9a-f]{40}$")
+IMAGE_SIGNATURES    = [
+	(b"\xff\xd8\xff", "image/jpeg"),
+	(b"\x89PNG\r\n\x1a\n", "image/png"),
+	(b"GIF87a", "image/gif"),
+	(b"GIF89a", "image/gif"),
+	(b"RIFF", "image/webp")
+]
+
+def AvatarDirectory(dbPath: str) -> str:
+	# avatars live next to the database so the monitor and the interface agree on it
+	return join(dirname(dbPath), AVATAR_DIR_NAME)
+
+def IsAvatarKey(value: str) -> bool:
+	return (value is not None) and (AVATAR_KEY_REGEX.match(value) is not None)
+
+def GuessImageType(imageBin: bytes) -> str:
+	for signature, mimeType in IMAGE_SIGNATURES:
+		if imageBin.startswith(signature):
+			return mimeType
+	return "application/octet-stream"
+
+class AvatarCache:
+	# content addressed: an image is stored once, the db only keeps its key
+
+	def __init__(self, directory: str):
+		self.directory = directory
+		if not exists(directory):
+			makedirs(directory)
+
+	def path(self, key: str) -> str:
+		return join(self.directory, key)
+
+	def store(self, imageBin: bytes) -> str:
+		key = sha1(imageBin).hexdigest()
+		path = self.path(key)
+		if not exists(path):
+			# written under a temporary name so readers never see half an image
+			tmpPath = path + AVATAR_TMP_SUFFIX
+			with open(tmpPath, 'wb') as imageFile:
+				imageFile.write(imageBin)
+			replace(tmpPath, path)
+		return key
+
+	def storeBase64(self, image64: str) -> str:
+		# avatars of databases written before the cache existed
+		return self.store(base64.b64decode(image64))
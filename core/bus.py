@@ -0,0 +1,69 @@
+# coding=utf-8
+
+from typing import Callable, List
+from threading import Thread
+from traceback import format_exc
+from os import urandom
+import socket
+import json
+
+from core.utils import Log, ErrorLevel
+
+BUS_HOST            = "127.0.0.1"
+DEFAULT_BUS_PORT    = 47200
+MAX_DATAGRAM_SIZE   = 65507
+IDLE_INTERVAL       = 1 # seconds, onIdle is called when nothing arrived for this long
+
+class PresencePublisher:
+	# fire and forget: the monitor never waits for the interface, a lost datagram
+	# is picked up from the journal by the reader.
+	# records are published before they are saved, a monitor that crashes in between
+	# hands out their versions again after the restart. every datagram carries the
+	# epoch of the publisher, [epoch, record], so the reader can tell and reload
+
+	def __init__(self, port: int = DEFAULT_BUS_PORT, host: str = BUS_HOST):
+		self.address = (host, port)
+		self.epoch = urandom(8).hex() # new with every process
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.setblocking(False)
+
+	def publish(self, record: List):
+		try:
+			self.socket.sendto(json.dumps([self.epoch, record]).encode('utf-8'), self.address)
+		except OSError:
+			# nobody listening or the buffer is full, the journal has it anyway
+			pass
+
+	def close(self):
+		self.socket.close()
+
+class PresenceSubscriber:
+
+	def __init__(
+		self, onRecord: Callable[[List, str], None], onIdle: Callable[[], None] = None,
+		port: int = DEFAULT_BUS_PORT, host: str = BUS_HOST
+	):
+		self.onRecord = onRecord
+		self.onIdle = onIdle
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.bind((host, port))
+		self.socket.settimeout(IDLE_INTERVAL)
+		self.thread = Thread(target=self.listen, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def listen(self):
+		while True:
+			try:
+				data = self.socket.recv(MAX_DATAGRAM_SIZE)
+			except socket.timeout:
+				data = None
+			try:
+				if data is not None:
+					epoch, record = json.loads(data.decode('utf-8'))
+					self.onRecord(record, epoch)
+				elif self.onIdle is not None:
+					self.onIdle()
+			except:
+				Log(ErrorLevel.warning, "bus message {} failed: {}", data, format_exc())
@@ -0,0 +1,73 @@
+# coding=utf-8
+
+from typing import Tuple
+from threading import Lock
+from hashlib import blake2b
+from time import time
+import gzip
+
+from core.storage import DumpDatabase
+from core.store import PresenceStore
+
+GZIP_LEVEL      = 6 # compressed once per version, the higher levels cost a lot more for a few percent
+ETAG_SIZE       = 8 # bytes of the hash in the etag
+
+class DatabaseSnapshot:
+	# the whole db as /db serves it, only ever kept gzipped
+	__slots__ = ("key", "version", "gzipped", "etag", "lastModified")
+
+	def __init__(self, key: Tuple[int, int], version: int, gzipped: bytes, etag: str, lastModified: int):
+		self.key = key
+		self.version = version
+		self.gzipped = gzipped
+		self.etag = etag
+		self.lastModified = lastModified # epoch seconds
+
+	def json(self) -> bytes:
+		# for the clients that don't take gzip
+		return gzip.decompress(self.gzipped)
+
+class DatabaseCache:
+	# serializes and compresses the db of the store once per version, the requests in
+	# between get the same bytes from memory. the etag is a hash of the json, so a
+	# rebuild that comes out the same (or another interface process) keeps it.
+	# Last-Modified is the second a different json was first built, never the same
+	# second twice: dates have no finer resolution and two versions within a second
+	# would look unchanged to If-Modified-Since
+
+	def __init__(self, store: PresenceStore):
+		self.store = store
+		self.snapshot = None # type: DatabaseSnapshot
+		# one build at a time, the requests arriving meanwhile wait and take its result
+		self.buildLock = Lock()
+
+	def currentKey(self) -> Tuple[int, int]:
+		return self.store.generation, self.store.version
+
+	def get(self) -> DatabaseSnapshot:
+		# the bus subscriber (or the refresh loop without a bus) keeps the store current,
+		# a request only reads the disk when the store isn't loaded yet
+		if self.store.db is None:
+			self.store.refresh()
+		snapshot = self.snapshot
+		if snapshot is not None and snapshot.key == self.currentKey():
+			return snapshot
+		with self.buildLock:
+			if self.snapshot is None or self.snapshot.key != self.currentKey():
+				self.snapshot = self.build(self.snapshot)
+			return self.snapshot
+
+	def build(self, previous: DatabaseSnapshot) -> DatabaseSnapshot:
+		store = self.store
+		with store.lock:
+			key = (store.generation, store.version)
+			content = DumpDatabase(store.db).encode('utf-8')
+		# the store keeps changing while this compresses, the next request builds again
+		etag = blake2b(content, digest_size=ETAG_SIZE).hexdigest()
+		if previous is not None and previous.etag == etag:
+			lastModified = previous.lastModified
+		elif previous is not None:
+			lastModified = max(int(time()), previous.lastModified + 1)
+		else:
+			lastModified = int(time())
+		return DatabaseSnapshot(key, key[1], gzip.compress(content, GZIP_LEVEL, mtime=0), etag, lastModified)
@@ -0,0 +1,93 @@
+# coding=utf-8
+
+from typing import Callable, Dict, List, Tuple, Union
+import json
+
+from core.statusbatch import ExtractStatuses
+
+# optional, decodes straight from bytes several times faster than the json module
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+JSON_PAYLOAD_PREFIX     = "for (;;);"
+PAYLOAD_PREFIX_BYTES    = JSON_PAYLOAD_PREFIX.encode('ascii')
+JSON_WHITESPACE         = " \t\r\n"
+STDLIB_DECODER          = json.JSONDecoder()
+
+# a single presence seen in a message: (uid, active, mobile), always online,
+# active/mobile None when the message doesn't tell
+Presence = Tuple[str, bool, bool]
+
+class StatusBatch:
+	# the buddy list/overlay entries of a message in parallel lists (see core.statusbatch),
+	# evaluated against the online cutoff when they are applied
+	__slots__ = ("uids", "lastActive", "active")
+
+	def __init__(self, uids: List[str], lastActive: List[int], active: List[int]):
+		self.uids = uids
+		self.lastActive = lastActive
+		self.active = active
+
+def JsonBackend() -> str:
+	return "orjson" if orjson is not None else "json"
+
+def DecodePayload(rawResponse: Union[bytes, str]) -> Dict:
+	# a /pull response or frame, with or without the "for (;;);" prefix, None if empty.
+	# bytes are decoded as they came from the socket, the prefix is skipped without a copy
+	if not rawResponse:
+		return None
+	if orjson is not None:
+		if isinstance(rawResponse, str):
+			rawResponse = rawResponse.encode('utf-8')
+		start = len(PAYLOAD_PREFIX_BYTES) if rawResponse.startswith(PAYLOAD_PREFIX_BYTES) else 0
+		return orjson.loads(memoryview(rawResponse)[start:])
+	if not isinstance(rawResponse, str):
+		rawResponse = rawResponse.decode('utf-8')
+	start = len(JSON_PAYLOAD_PREFIX) if rawResponse.startswith(JSON_PAYLOAD_PREFIX) else 0
+	# raw_decode reads from an offset instead of a sliced copy, it only has to start on the value
+	while start < len(rawResponse) and rawResponse[start] in JSON_WHITESPACE:
+		start += 1
+	return STDLIB_DECODER.raw_decode(rawResponse, start)[0]
+
+def ExtractBuddyList(msItem: Dict) -> StatusBatch:
+	# "chatproxy-presence": the whole buddy list
+	return StatusBatch(*ExtractStatuses(msItem["buddyList"], "lat", "p"))
+
+def ExtractOverlay(msItem: Dict) -> StatusBatch:
+	# "buddylist_overlay": the buddies that changed
+	return StatusBatch(*ExtractStatuses(msItem["overlay"], "la", "a"))
+
+def ExtractPhone(msItem: Dict) -> List[Presence]:
+	# "t_tp": someone is calling or texting from a phone
+	return [(msItem["from"], True, True)]
+
+def ExtractDelta(msItem: Dict) -> List[Presence]:
+	# "delta": a message sent to us, the sender is online
+	try:
+		return [(msItem["delta"]["threadKey"]["otherUserFbId"], True, None)]
+	except (KeyError, TypeError):
+		return []
+
+def ExtractTyping(msItem: Dict) -> List[Presence]:
+	# "typ": typing notifications, our own ones ("u") aren't presence
+	ownFBID = msItem.get("u")
+	if ownFBID is None:
+		return []
+	return [
+		(typing["from"], True, typing.get("from_mobile"))
+		for typing in msItem.get("ms", ())
+		if typing.get("type") == "typ" and "from" in typing and typing["from"] != ownFBID
+	]
+
+# message type -> extractor turning the raw message into a StatusBatch or a list of
+# Presence tuples, None for the types we know and don't need (their payload is never read)
+MESSAGE_EXTRACTORS = {
+	"chatproxy-presence": ExtractBuddyList,
+	"buddylist_overlay": ExtractOverlay,
+	"t_tp": ExtractPhone,
+	"delta": ExtractDelta,
+	"typ": ExtractTyping,
+	"inbox": None
+} # type: Dict[str, Callable[[Dict], Union[StatusBatch, List[Presence]]]]
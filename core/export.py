@@ -0,0 +1,185 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple, Iterator
+from array import array
+from io import StringIO
+from os import mkdir
+from os.path import exists, join
+import sys
+import csv
+import json
+import struct
+import re
+
+from core.intervals import UserRecord, STATES, OPEN_END, TIMESTAMP_TYPE
+from core.storage import ReadSnapshotUsers, IterJournalRecords, ApplyRecord, JOURNAL_SUFFIX, COMPACTING_SUFFIX
+from core.archive import ArchiveReader
+
+EXPORT_FORMATS      = ["csv", "ndjson", "npy"]
+EXPORT_COLUMNS      = ["uid", "state", "start", "end"]
+ROWS_PER_CHUNK      = 10000 # rows formatted (or buffered per column) before they are handed on
+NPY_MAGIC           = b"\x93NUMPY\x01\x00" # format version 1.0
+NPY_HEADER_LENGTH   = 128 # fixed, so the row count can be written after the rows; a multiple of 64 keeps the data aligned
+NPY_COLUMNS         = ["user", "state", "start", "end"] # the uid and state columns hold numbers, see the dictionary
+NPY_EXTENSION       = ".npy"
+DICTIONARY_NAME     = "dictionary.json"
+
+# an export row: (uid, state, start, end), end is None for an ongoing interval
+ExportRow = Tuple[str, str, int, int]
+
+def ReadJournals(dbPath: str) -> Dict[str, List[List]]:
+	# uid -> its records of the compacting journal and the journal, in the order they are replayed
+	records = {} # type: Dict[str, List[List]]
+	for journalPath in [dbPath + COMPACTING_SUFFIX, dbPath + JOURNAL_SUFFIX]:
+		for record in IterJournalRecords(journalPath):
+			records.setdefault(record[1], []).append(record)
+	return records
+
+def UserHistories(dbPath: str, journals: Dict[str, List[List]]) -> Iterator[Tuple[str, UserRecord]]:
+	# every user of the db, one at a time: the snapshot read from the file with the journal
+	# records of the user applied, then the users that are only in the journals
+	remaining = set(journals)
+	for uid, user in ReadSnapshotUsers(dbPath):
+		db = { uid: UserRecord.fromDict(user) }
+		for record in journals.get(uid, ()):
+			ApplyRecord(db, record)
+		remaining.discard(uid)
+		yield uid, db[uid]
+	for uid in sorted(remaining):
+		db = {}
+		for record in journals[uid]:
+			ApplyRecord(db, record)
+		yield uid, db[uid]
+
+def HistoryRows(
+	dbPath: str, users: List[str] = None, regex: str = None,
+	states: List[str] = None, fromTs: int = None, toTs: int = None
+) -> Iterator[ExportRow]:
+	# the rows of PresenceStore.exportRows() read from the files without loading the db:
+	# the archive a month segment at a time, then the snapshot a user at a time. only the
+	# journals are held, grouped by user, the compaction keeps them small
+	states = states if states is not None else STATES
+	journals = ReadJournals(dbPath)
+	wanted = set(users) if users is not None else None
+	if regex is not None:
+		# names can only be matched in the snapshot, the archive comes before it
+		pattern = re.compile(regex)
+		wanted = {
+			uid for uid, user in UserHistories(dbPath, journals)
+			if (wanted is None or uid in wanted) and (pattern.search(uid) or pattern.search(user["fullname"] or ""))
+		}
+	archive = ArchiveReader(dbPath, maxLoaded=1)
+	archive.refresh()
+	archivedUntil = archive.archivedUntil()
+	if archivedUntil is not None and (fromTs is None or fromTs < archivedUntil):
+		for name in archive.segmentNames(fromTs, toTs):
+			segment = archive.segment(name)
+			for uid in sorted(segment):
+				if wanted is not None and uid not in wanted:
+					continue
+				for state in states:
+					intervals = segment[uid].get(state)
+					if intervals is not None:
+						for start, end in intervals.slice(fromTs, toTs):
+							yield uid, state, start, end
+	for uid, user in UserHistories(dbPath, journals):
+		if wanted is not None and uid not in wanted:
+			continue
+		for state in states:
+			for start, end in user[state].slice(fromTs, toTs):
+				# archived already, still in the snapshot when the compaction was cut by a crash
+				if archivedUntil is not None and end is not None and end < archivedUntil:
+					continue
+				yield uid, state, start, end
+
+def CsvChunks(rows: Iterator[ExportRow]) -> Iterator[str]:
+	# header, then ROWS_PER_CHUNK lines at a time, an ongoing interval has an empty end
+	buffer = StringIO()
+	writer = csv.writer(buffer, lineterminator="\n")
+	writer.writerow(EXPORT_COLUMNS)
+	count = 0
+	for uid, state, start, end in rows:
+		writer.writerow([uid, state, start, "" if end is None else end])
+		count += 1
+		if count == ROWS_PER_CHUNK:
+			yield buffer.getvalue()
+			buffer.seek(0)
+			buffer.truncate()
+			count = 0
+	yield buffer.getvalue()
+
+def NdjsonChunks(rows: Iterator[ExportRow]) -> Iterator[str]:
+	lines = []
+	for uid, state, start, end in rows:
+		lines.append(json.dumps({ "uid": uid, "state": state, "start": start, "end": end }) + "\n")
+		if len(lines) == ROWS_PER_CHUNK:
+			yield "".join(lines)
+			lines = []
+	yield "".join(lines)
+
+def NpyHeader(count: int) -> bytes:
+	# header of a one dimensional little endian int64 array of `count` items
+	header = "{{'descr': '<i8', 'fortran_order': False, 'shape': ({},), }}".format(count)
+	header = header.ljust(NPY_HEADER_LENGTH - len(NPY_MAGIC) - 3) + "\n"
+	return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode('latin1')
+
+class ColumnarWriter:
+	# writes the rows into a directory as one .npy file per column: int64 arrays that
+	# numpy.load(path, mmap_mode='r') maps without copying. uids and states are numbers,
+	# dictionary.json maps them back, an ongoing interval ends with OPEN_END (-1).
+	# the rows are buffered ROWS_PER_CHUNK at a time and the row count goes into the
+	# fixed size headers at the end, so memory doesn't grow with the export
+
+	def __init__(self, directory: str):
+		if not exists(directory):
+			mkdir(directory)
+		self.directory = directory
+		self.count = 0
+		self.userNumbers = {} # type: Dict[str, int]
+		self.uids = [] # type: List[str]
+		self.stateNumbers = {state: number for number, state in enumerate(STATES)}
+		self.files = {}
+		self.buffers = {} # type: Dict[str, array]
+		for column in NPY_COLUMNS:
+			self.files[column] = open(join(directory, column + NPY_EXTENSION), 'wb')
+			self.files[column].write(NpyHeader(0))
+			self.buffers[column] = array(TIMESTAMP_TYPE)
+
+	def userNumber(self, uid: str) -> int:
+		number = self.userNumbers.get(uid)
+		if number is None:
+			number = self.userNumbers[uid] = len(self.uids)
+			self.uids.append(uid)
+		return number
+
+	def write(self, rows: Iterator[ExportRow]):
+		user, state, start, end = (self.buffers[column] for column in NPY_COLUMNS)
+		for uid, stateName, startTs, endTs in rows:
+			user.append(self.userNumber(uid))
+			state.append(self.stateNumbers[stateName])
+			start.append(startTs)
+			end.append(OPEN_END if endTs is None else endTs)
+			if len(user) == ROWS_PER_CHUNK:
+				self.flush()
+
+	def flush(self):
+		for column in NPY_COLUMNS:
+			buffer = self.buffers[column]
+			if sys.byteorder == "big":
+				buffer.byteswap()
+			self.files[column].write(buffer.tobytes())
+		self.count += len(self.buffers[NPY_COLUMNS[0]])
+		for column in NPY_COLUMNS:
+			del self.buffers[column][:]
+
+	def close(self) -> int:
+		# returns the number of rows written
+		self.flush()
+		for column in NPY_COLUMNS:
+			columnFile = self.files[column]
+			columnFile.seek(0)
+			columnFile.write(NpyHeader(self.count))
+			columnFile.close()
+		with open(join(self.directory, DICTIONARY_NAME), 'w') as dictionaryFile:
+			dictionaryFile.write(json.dumps({ "user": self.uids, "state": STATES, "openEnd": OPEN_END }))
+		return self.count
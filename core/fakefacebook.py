@@ -0,0 +1,291 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple, Iterator
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+from threading import Thread, Condition, Lock
+from random import Random
+from time import time, sleep
+import json
+
+from core.utils import Log, ErrorLevel
+from core.replay import SyntheticFeed
+from core.decoders import JSON_PAYLOAD_PREFIX
+
+DEFAULT_FAKE_PORT       = 47300
+DEFAULT_FRIEND_COUNT    = 10000
+DEFAULT_HOLD_TIME       = 50    # seconds a /pull is held open when there is nothing to send
+DEFAULT_EVENT_RATE      = 20    # messages per second
+DEFAULT_BURST_CHANCE    = 0.01  # chance per second of a burst
+DEFAULT_BURST_SIZE      = 500   # messages in one burst
+DEFAULT_STICKY_INTERVAL = 600   # seconds between two load balancer changes
+MAX_MESSAGES_PER_PULL   = 1000
+STREAM_HEARTBEAT        = 5     # seconds between two heartbeat frames of an idle stream
+FAKE_TOKEN              = "AQFakeTokenForTheStandInServer"
+# 1x1 transparent png, every fake avatar
+FAKE_AVATAR = bytes.fromhex(
+	"89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+	"1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)
+
+class FakeFacebookStats:
+
+	def __init__(self):
+		self.pulls = 0
+		self.streams = 0
+		self.heartbeats = 0
+		self.lbResponses = 0
+		self.messages = 0
+		self.errors = 0
+		self.userInfoRequests = 0
+		self.presenceRequests = 0
+		self.tokenPages = 0
+		self.firstPullAt = None # type: float
+
+	def toDict(self) -> Dict:
+		return dict(self.__dict__)
+
+class FakeFacebook:
+	# state of the stand-in server: a synthetic friend list producing presence messages
+	# at a steady rate with occasional bursts, a sticky token that changes now and then
+	# and the knobs for latency and injected errors. messages queue up until a /pull
+	# takes them, a /pull with nothing to take is held like facebook's long-poll
+
+	def __init__(
+		self, friendCount: int = DEFAULT_FRIEND_COUNT, holdTime: float = DEFAULT_HOLD_TIME,
+		eventRate: float = DEFAULT_EVENT_RATE, burstChance: float = DEFAULT_BURST_CHANCE,
+		burstSize: int = DEFAULT_BURST_SIZE, stickyInterval: float = DEFAULT_STICKY_INTERVAL,
+		latency: Tuple[float, float] = (0, 0), errorRate: float = 0, seed: int = 0
+	):
+		self.feed = SyntheticFeed(friendCount, seed)
+		self.holdTime = holdTime
+		self.eventRate = eventRate
+		self.burstChance = burstChance
+		self.burstSize = burstSize
+		self.stickyInterval = stickyInterval
+		self.latency = latency
+		self.errorRate = errorRate
+		self.random = Random(seed)
+		self.randomLock = Lock()
+		self.pending = [] # type: List[Dict]
+		self.seq = 0
+		self.sticky = None # type: str
+		self.stickyChangedAt = 0
+		self.condition = Condition()
+		self.stats = FakeFacebookStats()
+		self.running = False
+		self.changeSticky()
+		# the first pull gets the whole buddy list, like a fresh session does
+		self.pending.append(self.feed.buddyList())
+
+	def changeSticky(self):
+		with self.randomLock:
+			self.sticky = "fake{:08x}".format(self.random.getrandbits(32))
+		self.stickyChangedAt = time()
+
+	def start(self):
+		self.running = True
+		Thread(target=self.generate, daemon=True).start()
+
+	def stop(self):
+		self.running = False
+
+	def generate(self):
+		# produces the messages of one second, then sleeps for the rest of it
+		carry = 0.0
+		while self.running:
+			begin = time()
+			carry += self.eventRate
+			count = int(carry)
+			carry -= count
+			if self.chance(self.burstChance):
+				count += self.burstSize
+			with self.condition:
+				self.feed.now = begin
+				self.pending.extend(self.feed.message() for _ in range(count))
+				if time() - self.stickyChangedAt > self.stickyInterval:
+					self.changeSticky()
+				if len(self.pending) != 0:
+					self.condition.notify_all()
+			sleep(max(0, 1 - (time() - begin)))
+
+	def chance(self, probability: float) -> bool:
+		with self.randomLock:
+			return self.random.random() < probability
+
+	def pick(self, choices: List):
+		with self.randomLock:
+			return self.random.choice(choices)
+
+	def delay(self):
+		with self.randomLock:
+			seconds = self.random.uniform(*self.latency)
+		if seconds > 0:
+			sleep(seconds)
+
+	def push(self, messages: List[Dict]):
+		# queued right away, next to the generated ones
+		with self.condition:
+			self.pending.extend(messages)
+			self.condition.notify_all()
+
+	def pull(self, params: Dict[str, str], holdTime: float = None) -> Dict:
+		self.stats.pulls += 1
+		if params.get("sticky_token") != self.sticky:
+			# unknown or outdated sticky, the client has to come back to the given pool
+			self.stats.lbResponses += 1
+			return {"t": "lb", "lb_info": {"sticky": self.sticky, "pool": "fake_pool"}}
+		with self.condition:
+			self.condition.wait_for(lambda: len(self.pending) != 0, self.holdTime if holdTime is None else holdTime)
+			if len(self.pending) == 0:
+				self.stats.heartbeats += 1
+				return {"t": "heartbeat"}
+			messages = self.pending[:MAX_MESSAGES_PER_PULL]
+			del self.pending[:MAX_MESSAGES_PER_PULL]
+			self.seq += 1
+			self.stats.messages += len(messages)
+			return {"t": "msg", "seq": self.seq, "ms": messages}
+
+	def stream(self, params: Dict[str, str]) -> Iterator[Dict]:
+		# mode=stream: the payloads of consecutive pulls on one connection for holdTime
+		# seconds, a heartbeat when nothing happened for STREAM_HEARTBEAT seconds.
+		# a sticky change ends the stream with the lb frame
+		self.stats.streams += 1
+		end = time() + self.holdTime
+		while True:
+			responseObj = self.pull(params, max(0, min(STREAM_HEARTBEAT, end - time())))
+			yield responseObj
+			if "lb_info" in responseObj or time() >= end:
+				return
+
+	def userInfo(self, form: Dict[str, str], thumbnailBase: str) -> Dict:
+		self.stats.userInfoRequests += 1
+		profiles = {}
+		for key, uid in form.items():
+			if key.startswith("ids["):
+				profiles[uid] = {"name": "Friend " + uid, "thumbSrc": thumbnailBase + uid + ".png"}
+		return {"payload": {"profiles": profiles}}
+
+	def presence(self, form: Dict[str, str]) -> Dict:
+		self.stats.presenceRequests += 1
+		uid = form.get("target_id")
+		return {"payload": {"availability": {uid: 2 if self.chance(0.5) else 0}}}
+
+	def tokenPage(self) -> str:
+		self.stats.tokenPages += 1
+		return '<html><body><form><input type="hidden" name="fb_dtsg" value="{}" /></form></body></html>'.format(FAKE_TOKEN)
+
+class FakeFacebookHandler(BaseHTTPRequestHandler):
+	fake = None # type: FakeFacebook
+	protocol_version = "HTTP/1.1" # keep-alive, like the real thing
+
+	def log_message(self, format: str, *args):
+		Log(ErrorLevel.debug, "fake facebook: " + format, *args)
+
+	def sendBody(self, body: bytes, contentType: str, status: int = 200):
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendPayload(self, responseObj: Dict):
+		self.sendBody((JSON_PAYLOAD_PREFIX + json.dumps(responseObj)).encode('utf-8'), "application/javascript")
+
+	def sendStream(self, frames: Iterator[Dict]):
+		# chunked, one chunk per frame, written as soon as the frame is there
+		self.send_response(200)
+		self.send_header("Content-Type", "application/javascript")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+		try:
+			for responseObj in frames:
+				frame = (JSON_PAYLOAD_PREFIX + json.dumps(responseObj) + "\r\n").encode('utf-8')
+				self.wfile.write("{:x}\r\n".format(len(frame)).encode('ascii') + frame + b"\r\n")
+				self.wfile.flush()
+			self.wfile.write(b"0\r\n\r\n")
+		except OSError:
+			# the client went away
+			self.close_connection = True
+
+	def injectError(self) -> bool:
+		# server errors, unparsable payloads and dropped connections at the configured rate
+		if not self.fake.chance(self.fake.errorRate):
+			return False
+		self.fake.stats.errors += 1
+		kind = self.fake.pick(["status", "garbage", "drop"])
+		if kind == "status":
+			self.sendBody(b"<html>error</html>", "text/html", 500)
+		elif kind == "garbage":
+			self.sendBody((JSON_PAYLOAD_PREFIX + '{"t": "msg", "ms": [').encode('utf-8'), "application/javascript")
+		else:
+			self.close_connection = True
+		return True
+
+	def readForm(self) -> Dict[str, str]:
+		length = int(self.headers.get("Content-Length") or 0)
+		form = parse_qs(self.rfile.read(length).decode('utf-8'))
+		return {key: values[0] for key, values in form.items()}
+
+	def do_GET(self):
+		url = urlsplit(self.path)
+		if url.path == "/pull" and self.fake.stats.firstPullAt is None:
+			# arrival time, before the simulated latency
+			self.fake.stats.firstPullAt = time()
+		self.fake.delay()
+		if self.injectError():
+			return
+		if url.path == "/pull":
+			params = {key: values[0] for key, values in parse_qs(url.query).items()}
+			if params.get("mode") == "stream":
+				self.sendStream(self.fake.stream(params))
+			else:
+				self.sendPayload(self.fake.pull(params))
+		elif url.path.startswith("/avatar/"):
+			self.sendBody(FAKE_AVATAR, "image/png")
+		elif url.path == "/":
+			self.sendBody(self.fake.tokenPage().encode('utf-8'), "text/html")
+		elif url.path == "/stats":
+			self.sendBody(json.dumps(self.fake.stats.toDict()).encode('utf-8'), "application/json")
+		else:
+			self.sendBody(b"", "text/plain", 404)
+
+	def do_POST(self):
+		url = urlsplit(self.path)
+		form = self.readForm()
+		self.fake.delay()
+		if self.injectError():
+			return
+		if url.path == "/chat/user_info/":
+			host = self.headers.get("Host") or "{}:{}".format(*self.server.server_address)
+			self.sendPayload(self.fake.userInfo(form, "http://{}/avatar/".format(host)))
+		elif url.path == "/ajax/mercury/tabs_presence.php":
+			self.sendPayload(self.fake.presence(form))
+		else:
+			self.sendBody(b"", "text/plain", 404)
+
+class FakeFacebookServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+def StartFakeFacebook(fake: FakeFacebook, port: int = DEFAULT_FAKE_PORT, host: str = "127.0.0.1") -> FakeFacebookServer:
+	# serves on a background thread, port 0 picks a free one (see server.server_address)
+	handler = type("BoundFakeFacebookHandler", (FakeFacebookHandler,), {"fake": fake})
+	server = FakeFacebookServer((host, port), handler)
+	fake.start()
+	Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def FakeFacebookConfig(host: str, port: int) -> str:
+	# config lines pointing the monitor at the stand-in server
+	base = "http://{}:{}".format(host, port)
+	return "\n".join([
+		"uid=1",
+		"cookie=fake",
+		"client_id=fake",
+		"useragent=fake",
+		"pull_url={}/pull".format(base),
+		"website_url={}/".format(base),
+		"information_url={}/chat/user_info/?dpr=1".format(base),
+		"presence_url={}/ajax/mercury/tabs_presence.php?dpr=1".format(base)
+	]) + "\n"
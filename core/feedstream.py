@@ -0,0 +1,151 @@
+# coding=utf-8
+
+from typing import Dict, List
+from collections import deque
+from threading import Thread, Condition
+import re
+
+from core.decoders import DecodePayload, JSON_PAYLOAD_PREFIX
+
+PULL_MODES           = ["poll", "stream"]
+DEFAULT_PULL_MODE    = "poll"
+DEFAULT_STREAM_CYCLE = 10 # seconds of frames handled before the presence queries and saves get their turn
+RECONNECT_FRAMES     = ["lb", "refresh", "fullReload"] # frame types ("t") after which the server wants a new connection
+FRAME_PREFIX         = JSON_PAYLOAD_PREFIX.encode('ascii')
+SPACE_PATTERN        = re.compile(rb"\s*")
+OUTSIDE_PATTERN      = re.compile(rb'[{}"]') # the bytes that matter outside of a string
+INSIDE_PATTERN       = re.compile(rb'["\\]') # the ones that matter inside
+OPEN_BRACE           = ord("{")
+QUOTE                = ord('"')
+
+class FrameParser:
+	# splits the body of a streamed /pull into its payloads: "for (;;);{...}" frames
+	# written one after the other and cut anywhere by the network. every byte is looked
+	# at once, only the braces outside of strings are counted, and a frame is handed out
+	# undecoded as soon as its closing brace arrives. json keeps its structure in ascii,
+	# so the utf-8 sequences in between never need decoding here
+
+	def __init__(self):
+		self.buffer = bytearray()
+		self.position = 0 # scanned up to here
+		self.frameStart = None # type: int
+		self.depth = 0
+		self.inString = False
+
+	def feed(self, chunk: bytes) -> List[bytes]:
+		# returns the frames the chunk completed
+		buffer = self.buffer
+		buffer += chunk
+		frames = []
+		position = self.position
+		while position < len(buffer):
+			if self.frameStart is None:
+				# between two frames: whitespace, the prefix, then the opening brace
+				position = SPACE_PATTERN.match(buffer, position).end()
+				if position == len(buffer):
+					break
+				if buffer.startswith(FRAME_PREFIX, position):
+					position += len(FRAME_PREFIX)
+				elif buffer[position] == OPEN_BRACE:
+					self.frameStart = position
+					self.depth = 1
+					position += 1
+				elif FRAME_PREFIX.startswith(buffer[position:]):
+					# the prefix is cut in two
+					break
+				else:
+					raise ValueError("unexpected {!r} between two frames".format(bytes(buffer[position:position + 16])))
+			elif self.inString:
+				match = INSIDE_PATTERN.search(buffer, position)
+				if match is None:
+					position = len(buffer)
+				elif buffer[match.start()] == QUOTE:
+					self.inString = False
+					position = match.end()
+				elif match.end() == len(buffer):
+					# the escaped byte is still to come, scan the backslash again
+					position = match.start()
+					break
+				else:
+					position = match.end() + 1
+			else:
+				match = OUTSIDE_PATTERN.search(buffer, position)
+				if match is None:
+					position = len(buffer)
+					continue
+				position = match.end()
+				byte = buffer[match.start()]
+				if byte == QUOTE:
+					self.inString = True
+				elif byte == OPEN_BRACE:
+					self.depth += 1
+				else:
+					self.depth -= 1
+					if self.depth == 0:
+						frames.append(bytes(buffer[self.frameStart:position]))
+						self.frameStart = None
+		# keep the unfinished frame only
+		keepFrom = position if self.frameStart is None else self.frameStart
+		del buffer[:keepFrom]
+		self.position = position - keepFrom
+		if self.frameStart is not None:
+			self.frameStart = 0
+		return frames
+
+class FeedStream:
+	# one open /pull connection in stream mode, read frame by frame. the connection
+	# stays open across monitor cycles until the server ends it or it is closed.
+	# a thread of its own reads it, so a cycle can wait for the next frame with a
+	# deadline instead of blocking in the socket until the pull timeout
+
+	def __init__(self, response, chunkSize: int = None):
+		self.response = response
+		# chunkSize None: whatever the network delivered
+		self.chunks = response.iter_content(chunk_size=chunkSize)
+		self.parser = FrameParser()
+		self.frames = deque()
+		self.frameCount = 0
+		self.byteCount = 0
+		self.isEnded = False
+		self.error = None # type: BaseException
+		self.arrived = Condition()
+		Thread(target=self.readLoop, name="pull-stream", daemon=True).start()
+
+	def readLoop(self):
+		try:
+			for chunk in self.chunks:
+				self.byteCount += len(chunk)
+				frames = self.parser.feed(chunk)
+				if len(frames) != 0:
+					with self.arrived:
+						self.frames.extend(frames)
+						self.arrived.notify_all()
+		except BaseException as error:
+			# raised by nextFrame(), the reader that asked for the frame handles it
+			self.error = error
+		with self.arrived:
+			self.isEnded = True
+			self.arrived.notify_all()
+
+	def waitFrame(self, timeout: float = None) -> bool:
+		# True when nextFrame() won't block: a frame arrived or the stream ended
+		with self.arrived:
+			return self.arrived.wait_for(lambda: len(self.frames) != 0 or self.isEnded, timeout)
+
+	def nextFrame(self) -> bytes:
+		# blocks until the next frame arrived, None when the server ended the stream
+		self.waitFrame()
+		with self.arrived:
+			if len(self.frames) != 0:
+				self.frameCount += 1
+				return self.frames.popleft()
+		if self.error is not None:
+			raise self.error
+		return None
+
+	def close(self):
+		# the reader thread ends with the failed read
+		self.response.close()
+
+def DecodeFrame(frame: bytes) -> Dict:
+	return DecodePayload(frame)
@@ -0,0 +1,252 @@
+# coding=utf-8
+
+from typing import Dict, List, Set, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+
+from core.intervals import IntervalList, STATES, TIMESTAMP_TYPE
+from core.storage import RECORD_OPEN, RECORD_INTERVAL, RECORD_DROP
+
+NO_START    = 2 ** 62  # start of a removed slot, never <= a real timestamp
+NO_END      = -2 ** 62 # end of a removed slot
+OPEN_UNTIL  = 2 ** 62  # end of an ongoing interval, it overlaps everything after its start
+MIN_CAPACITY = 64
+
+class IntervalIndex:
+	# every interval of one state, of every user, in a flat binary tree: the leaves are
+	# the intervals ordered by start, every inner node keeps the smallest start and the
+	# largest end below it. a search only walks into nodes that can hold a match, so
+	# finding the k intervals overlapping a time range costs about (k + 1) * log(n).
+	# the monitor's records come in start order, adding one is an append to the leaves
+	# and closing or dropping one only touches the path to its leaf. an older interval
+	# is inserted at its place and shifts the leaves after it
+
+	def __init__(self):
+		self.count = 0
+		self.capacity = MIN_CAPACITY
+		self.owners = array('l') # user number of every leaf
+		self.starts = array(TIMESTAMP_TYPE) # start of every leaf, removed ones included
+		self.minStarts = array(TIMESTAMP_TYPE, [NO_START]) * (2 * self.capacity)
+		self.maxEnds = array(TIMESTAMP_TYPE, [NO_END]) * (2 * self.capacity)
+
+	def __len__(self) -> int:
+		return self.count
+
+	def refreshNodes(self, first: int, last: int):
+		# recomputes the inner nodes above the leaves [first, last]
+		low, high = (self.capacity + first) // 2, (self.capacity + last) // 2
+		while low != 0:
+			for node in range(low, high + 1):
+				self.minStarts[node] = min(self.minStarts[2 * node], self.minStarts[2 * node + 1])
+				self.maxEnds[node] = max(self.maxEnds[2 * node], self.maxEnds[2 * node + 1])
+			low, high = low // 2, high // 2
+
+	def build(self, capacity: int, starts: array, ends: array):
+		# leaves of `capacity` slots holding the given ones, the rest empty
+		self.capacity = capacity
+		self.minStarts = array(TIMESTAMP_TYPE, [NO_START]) * (2 * self.capacity)
+		self.maxEnds = array(TIMESTAMP_TYPE, [NO_END]) * (2 * self.capacity)
+		self.minStarts[self.capacity:self.capacity + len(starts)] = starts
+		self.maxEnds[self.capacity:self.capacity + len(ends)] = ends
+		self.refreshNodes(0, self.capacity - 1)
+
+	def update(self, position: int, start: int, end: int):
+		node = self.capacity + position
+		self.minStarts[node] = start
+		self.maxEnds[node] = end
+		node //= 2
+		while node != 0:
+			self.minStarts[node] = min(self.minStarts[2 * node], self.minStarts[2 * node + 1])
+			self.maxEnds[node] = max(self.maxEnds[2 * node], self.maxEnds[2 * node + 1])
+			node //= 2
+
+	def add(self, owner: int, start: int, end: int = None):
+		if self.count == self.capacity:
+			leaves = slice(self.capacity, self.capacity + self.count)
+			self.build(2 * self.capacity, self.minStarts[leaves], self.maxEnds[leaves])
+		end = OPEN_UNTIL if end is None else end
+		position = bisect_right(self.starts, start)
+		if position == self.count:
+			self.count += 1
+			self.owners.append(owner)
+			self.starts.append(start)
+			self.update(position, start, end)
+			return
+		# shift the leaves after it by one
+		first, last = self.capacity + position, self.capacity + self.count
+		self.minStarts[first + 1:last + 1] = self.minStarts[first:last]
+		self.maxEnds[first + 1:last + 1] = self.maxEnds[first:last]
+		self.minStarts[first] = start
+		self.maxEnds[first] = end
+		self.owners.insert(position, owner)
+		self.starts.insert(position, start)
+		self.count += 1
+		self.refreshNodes(position, self.count - 1)
+
+	def find(self, owner: int, start: int) -> int:
+		# position of the interval of the owner starting at start, None if there is none
+		position = bisect_left(self.starts, start)
+		while position < self.count and self.starts[position] == start:
+			if self.owners[position] == owner and self.minStarts[self.capacity + position] != NO_START:
+				return position
+			position += 1
+		return None
+
+	def close(self, owner: int, start: int, end: int):
+		position = self.find(owner, start)
+		if position is not None:
+			self.update(position, start, end)
+
+	def remove(self, owner: int, start: int):
+		position = self.find(owner, start)
+		if position is not None:
+			self.update(position, NO_START, NO_END)
+
+	def dropBefore(self, timeStamp: int):
+		# removes the closed intervals that ended before timeStamp, as IntervalList.dropBefore
+		# does, and the removed slots among them. they all start before timeStamp
+		edge = bisect_left(self.starts, timeStamp)
+		kept = [position for position in range(edge) if self.maxEnds[self.capacity + position] >= timeStamp]
+		if len(kept) == edge:
+			return
+		kept.extend(range(edge, self.count))
+		self.owners = array('l', (self.owners[position] for position in kept))
+		self.starts = array(TIMESTAMP_TYPE, (self.starts[position] for position in kept))
+		starts = array(TIMESTAMP_TYPE, (self.minStarts[self.capacity + position] for position in kept))
+		ends = array(TIMESTAMP_TYPE, (self.maxEnds[self.capacity + position] for position in kept))
+		self.count = len(kept)
+		capacity = MIN_CAPACITY
+		while capacity < self.count:
+			capacity *= 2
+		self.build(capacity, starts, ends)
+
+	def interval(self, position: int) -> Tuple[int, int]:
+		end = self.maxEnds[self.capacity + position]
+		return self.minStarts[self.capacity + position], (None if end == OPEN_UNTIL else end)
+
+	def search(self, fromTs: int = None, toTs: int = None) -> List[int]:
+		# positions of the intervals overlapping [fromTs, toTs], in start order
+		fromTs = NO_END + 1 if fromTs is None else fromTs
+		toTs = NO_START - 1 if toTs is None else toTs
+		positions = []
+		if self.count == 0:
+			return positions
+		stack = [1]
+		while len(stack) != 0:
+			node = stack.pop()
+			if self.minStarts[node] > toTs or self.maxEnds[node] < fromTs:
+				continue
+			if node >= self.capacity:
+				positions.append(node - self.capacity)
+			else:
+				# right child first so the left one is popped first
+				stack.append(2 * node + 1)
+				stack.append(2 * node)
+		return positions
+
+class PresenceIndex:
+	# an IntervalIndex per state over the whole db, kept in sync by feeding it the
+	# same journal records the db gets (see core.storage), so it is built once and
+	# never rebuilt. answers "who was online at T", "who was around between A and B"
+	# and "how long were these two online together"
+
+	def __init__(self):
+		self.indexes = {state: IntervalIndex() for state in STATES} # type: Dict[str, IntervalIndex]
+		self.uids = [] # type: List[str]
+		self.userNumbers = {} # type: Dict[str, int]
+		# (uid, state) of the ongoing intervals
+		self.openKeys = set() # type: Set[Tuple[str, str]]
+		# (uid, state) -> latest start added, older records were applied already
+		self.lastStarts = {} # type: Dict[Tuple[str, str], int]
+
+	@staticmethod
+	def fromDatabase(db: Dict) -> 'PresenceIndex':
+		# added in start order, every add is an append
+		index = PresenceIndex()
+		for state in STATES:
+			intervals = [(start, end, uid) for uid in db for start, end in db[uid][state]]
+			intervals.sort(key=lambda interval: interval[0])
+			for start, end, uid in intervals:
+				index.add(uid, state, start, end)
+		return index
+
+	def userNumber(self, uid: str) -> int:
+		number = self.userNumbers.get(uid)
+		if number is None:
+			number = self.userNumbers[uid] = len(self.uids)
+			self.uids.append(uid)
+		return number
+
+	def add(self, uid: str, state: str, start: int, end: int = None):
+		self.indexes[state].add(self.userNumber(uid), start, end)
+		self.lastStarts[(uid, state)] = start
+		if end is None:
+			self.openKeys.add((uid, state))
+
+	def applyRecord(self, record: List):
+		# same rules as core.storage.ApplyRecord, applying a record twice is a no-op
+		recordType = record[0]
+		if recordType not in (RECORD_OPEN, RECORD_INTERVAL, RECORD_DROP):
+			return
+		uid, state, start = record[1], record[2], record[3]
+		key = (uid, state)
+		isNewer = key not in self.lastStarts or self.lastStarts[key] < start
+		isOpenOne = key in self.openKeys and self.lastStarts[key] == start
+		if recordType == RECORD_OPEN:
+			if isNewer:
+				self.add(uid, state, start)
+		elif recordType == RECORD_INTERVAL:
+			if isNewer:
+				self.add(uid, state, start, record[4])
+			elif isOpenOne:
+				self.indexes[state].close(self.userNumbers[uid], start, record[4])
+				self.openKeys.remove(key)
+		elif isOpenOne:
+			self.indexes[state].remove(self.userNumbers[uid], start)
+			self.openKeys.remove(key)
+
+	def dropBefore(self, timeStamp: int):
+		# follows core.archive.DropExpired on the db, the ongoing intervals stay
+		for index in self.indexes.values():
+			index.dropBefore(timeStamp)
+
+	def overlapping(self, state: str, fromTs: int = None, toTs: int = None) -> Dict[str, List[List[int]]]:
+		# uid -> its intervals overlapping [fromTs, toTs], ongoing ones end with None
+		index = self.indexes[state]
+		result = {}
+		for position in index.search(fromTs, toTs):
+			start, end = index.interval(position)
+			result.setdefault(self.uids[index.owners[position]], []).append([start, end])
+		return result
+
+	def usersAt(self, state: str, timeStamp: int) -> List[str]:
+		# who was in the state at that moment
+		index = self.indexes[state]
+		return sorted(set(self.uids[index.owners[position]] for position in index.search(timeStamp, timeStamp)))
+
+def CoPresence(
+	first: IntervalList, second: IntervalList, now: int, fromTs: int = None, toTs: int = None
+) -> Tuple[int, List[List[int]]]:
+	# seconds two users spent in the same state at the same time within [fromTs, toTs]
+	# and the common intervals. both lists are sorted, so it is a bisect into each
+	# and a merge of the overlapping parts, ongoing intervals count until now
+	firstBegin, firstEnd = first.sliceIndices(fromTs, toTs)
+	secondBegin, secondEnd = second.sliceIndices(fromTs, toTs)
+	fromTs = NO_END if fromTs is None else fromTs
+	toTs = NO_START if toTs is None else toTs
+	common = []
+	i, j = firstBegin, secondBegin
+	while i < firstEnd and j < secondEnd:
+		firstStart, firstStop = first[i]
+		secondStart, secondStop = second[j]
+		firstStop = now if firstStop is None else firstStop
+		secondStop = now if secondStop is None else secondStop
+		start = max(firstStart, secondStart, fromTs)
+		stop = min(firstStop, secondStop, toTs)
+		if start < stop:
+			common.append([start, stop])
+		if firstStop < secondStop:
+			i += 1
+		else:
+			j += 1
+	return sum(stop - start for start, stop in common), common
@@ -0,0 +1,144 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple, Iterator
+from array import array
+from bisect import bisect_left, bisect_right
+
+OPEN_END        = -1 # sentinel end timestamp of the ongoing interval
+TIMESTAMP_TYPE  = 'q' # int64
+STATES          = ["online", "active", "mobile"]
+
+class IntervalList:
+	# time ordered, non-overlapping [start, end] intervals of one (uid, state)
+	# only the last interval can be open (end == OPEN_END)
+	__slots__ = ("starts", "ends")
+
+	def __init__(self, starts: array = None, ends: array = None):
+		self.starts = starts if starts is not None else array(TIMESTAMP_TYPE)
+		self.ends = ends if ends is not None else array(TIMESTAMP_TYPE)
+
+	@staticmethod
+	def fromList(intervalList: List[List[int]]) -> 'IntervalList':
+		intervals = IntervalList()
+		for start, end in intervalList:
+			intervals.append(start, end)
+		return intervals
+
+	def toList(self) -> List[List[int]]:
+		return [[start, None if end == OPEN_END else end] for start, end in zip(self.starts, self.ends)]
+
+	def copy(self) -> 'IntervalList':
+		return IntervalList(array(TIMESTAMP_TYPE, self.starts), array(TIMESTAMP_TYPE, self.ends))
+
+	def __len__(self) -> int:
+		return len(self.starts)
+
+	def __getitem__(self, index: int) -> Tuple[int, int]:
+		end = self.ends[index]
+		return self.starts[index], (None if end == OPEN_END else end)
+
+	def __iter__(self) -> Iterator[Tuple[int, int]]:
+		for index in range(len(self.starts)):
+			yield self[index]
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, IntervalList) and self.starts == other.starts and self.ends == other.ends
+
+	def append(self, start: int, end: int = None):
+		self.starts.append(start)
+		self.ends.append(OPEN_END if end is None else end)
+
+	def appendOpen(self, start: int):
+		self.append(start, None)
+
+	def closeLast(self, end: int):
+		self.ends[-1] = end
+
+	def isLastOpen(self) -> bool:
+		return len(self.ends) != 0 and self.ends[-1] == OPEN_END
+
+	def lastStart(self) -> int:
+		return self.starts[-1]
+
+	def popOpen(self):
+		if self.isLastOpen():
+			self.starts.pop()
+			self.ends.pop()
+
+	def dropBefore(self, timeStamp: int) -> 'IntervalList':
+		# removes the closed intervals that ended before timeStamp and returns them
+		closedCount = len(self.ends) - 1 if self.isLastOpen() else len(self.ends)
+		count = bisect_left(self.ends, timeStamp, 0, closedCount)
+		dropped = IntervalList(self.starts[:count], self.ends[:count])
+		del self.starts[:count]
+		del self.ends[:count]
+		return dropped
+
+	def sliceIndices(self, fromTs: int = None, toTs: int = None) -> Tuple[int, int]:
+		# [first, last) index range of the intervals overlapping [fromTs, toTs]
+		first, last = 0, len(self.starts)
+		if toTs is not None:
+			last = bisect_right(self.starts, toTs)
+		if fromTs is not None and last != 0:
+			# ends are ordered as well, except the open sentinel which can only be the last one
+			closedCount = last - 1 if self.ends[last - 1] == OPEN_END else last
+			first = bisect_left(self.ends, fromTs, 0, closedCount)
+		return first, max(first, last)
+
+	def slice(self, fromTs: int = None, toTs: int = None) -> 'IntervalList':
+		first, last = self.sliceIndices(fromTs, toTs)
+		return IntervalList(self.starts[first:last], self.ends[first:last])
+
+def MergeIntervals(intervals: List[List[int]], gap: int) -> List[List[int]]:
+	# [start, end] lists with the gaps shorter than `gap` filled, ongoing intervals (end None) are kept as
+	# they are: clients close them by their start when the close record arrives
+	merged = []
+	for start, end in intervals:
+		if end is not None and len(merged) != 0 and merged[-1][1] is not None and start - merged[-1][1] < gap:
+			merged[-1][1] = max(merged[-1][1], end)
+		else:
+			merged.append([start, end])
+	return merged
+
+class UserRecord:
+	__slots__ = ("online", "active", "mobile", "fullname", "image", "thumbnail")
+
+	def __init__(self, fullname: str = None, image: str = None, thumbnail: str = None):
+		self.online = IntervalList()
+		self.active = IntervalList()
+		self.mobile = IntervalList()
+		self.fullname = fullname
+		self.image = image # avatar cache key
+		self.thumbnail = thumbnail # url the avatar was downloaded from
+
+	# dict style access so records can be handled like the json structure they are stored as
+	def __getitem__(self, key: str):
+		return getattr(self, key)
+
+	def __setitem__(self, key: str, value):
+		setattr(self, key, value)
+
+	@staticmethod
+	def fromDict(userDict: Dict) -> 'UserRecord':
+		user = UserRecord(userDict.get("fullname"), userDict.get("image"), userDict.get("thumbnail"))
+		for state in STATES:
+			user[state] = IntervalList.fromList(userDict.get(state, []))
+		return user
+
+	def toDict(self) -> Dict:
+		return {
+			"online": self.online.toList(),
+			"active": self.active.toList(),
+			"mobile": self.mobile.toList(),
+			"fullname": self.fullname,
+			"image": self.image,
+			"thumbnail": self.thumbnail
+		}
+
+def EncodeRecord(obj):
+	# json.dumps default hook, records are encoded one by one while the dump is written
+	if isinstance(obj, UserRecord):
+		return obj.toDict()
+	if isinstance(obj, IntervalList):
+		return obj.toList()
+	raise TypeError("{} is not json serializable".format(type(obj).__name__))
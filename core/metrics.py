@@ -0,0 +1,285 @@
+# coding=utf-8
+
+from typing import Callable, Dict, List, Tuple
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+from threading import Thread, Lock, enumerate as enumerateThreads, get_ident
+from collections import Counter as StackCounter
+from bisect import bisect_left
+from time import perf_counter, sleep
+import resource
+import json
+import sys
+
+from core.utils import Log, ErrorLevel
+
+METRICS_HOST            = "127.0.0.1"
+DEFAULT_METRICS_PORT    = 0 # off unless metrics_port is set, every monitor process needs a port of its own
+# seconds, from a parsed message to a held long-poll
+LATENCY_BUCKETS         = [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+DEFAULT_SAMPLE_INTERVAL = 0.005 # seconds between two samples of the profiler
+MAX_STACK_DEPTH         = 64
+PAGE_SIZE               = resource.getpagesize()
+
+def LabelKey(labels: Dict[str, str]) -> Tuple:
+	return tuple(sorted(labels.items()))
+
+def FormatLabels(labels: Tuple, extra: Tuple = ()) -> str:
+	pairs = list(labels) + list(extra)
+	if len(pairs) == 0:
+		return ""
+	return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+class MetricCounter:
+	# only goes up
+	__slots__ = ("value", "lock")
+
+	def __init__(self):
+		self.value = 0
+		self.lock = Lock()
+
+	def inc(self, amount: float = 1):
+		with self.lock:
+			self.value += amount
+
+class MetricHistogram:
+	# counts of the observations per bucket (upper bounds), plus their sum
+	__slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+	def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+		self.lock = Lock()
+
+	def observe(self, value: float):
+		bucket = bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[bucket] += 1
+			self.sum += value
+			self.count += 1
+
+	def time(self) -> 'MetricTimer':
+		return MetricTimer(self)
+
+class MetricTimer:
+	# with histogram.time(): ... observes the seconds spent in the block
+
+	__slots__ = ("histogram", "begin")
+
+	def __init__(self, histogram: MetricHistogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.begin = perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.histogram.observe(perf_counter() - self.begin)
+		return False
+
+def ResidentMemory() -> int:
+	# bytes, the current rss where /proc is available, the peak one elsewhere
+	try:
+		with open("/proc/self/statm", 'r') as statmFile:
+			return int(statmFile.read().split()[1]) * PAGE_SIZE
+	except (OSError, ValueError, IndexError):
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return peak if sys.platform == "darwin" else peak * 1024
+
+class MetricsRegistry:
+	# counters, histograms and gauges by name and labels. the hot paths keep the metric
+	# objects they got from here, a lookup only happens when a metric is created.
+	# gauges are functions evaluated when the metrics are read
+
+	def __init__(self):
+		self.lock = Lock()
+		self.descriptions = {} # type: Dict[str, str]
+		self.kinds = {} # type: Dict[str, str]
+		self.metrics = {} # type: Dict[str, Dict[Tuple, object]]
+
+	def get(self, kind: str, name: str, description: str, labels: Dict[str, str], create: Callable):
+		key = LabelKey(labels)
+		with self.lock:
+			if name not in self.metrics:
+				self.metrics[name] = {}
+				self.kinds[name] = kind
+				self.descriptions[name] = description
+			metric = self.metrics[name].get(key)
+			if metric is None:
+				metric = self.metrics[name][key] = create()
+			return metric
+
+	def counter(self, name: str, description: str, **labels) -> MetricCounter:
+		return self.get("counter", name, description, labels, MetricCounter)
+
+	def histogram(self, name: str, description: str, buckets: List[float] = LATENCY_BUCKETS, **labels) -> MetricHistogram:
+		return self.get("histogram", name, description, labels, lambda: MetricHistogram(buckets))
+
+	def gauge(self, name: str, description: str, function: Callable[[], float], **labels):
+		self.get("gauge", name, description, labels, lambda: function)
+
+	def items(self) -> List[Tuple[str, str, str, List[Tuple[Tuple, object]]]]:
+		with self.lock:
+			return [
+				(name, self.kinds[name], self.descriptions[name], list(metrics.items()))
+				for name, metrics in sorted(self.metrics.items())
+			]
+
+	def render(self) -> str:
+		# prometheus text exposition format
+		lines = []
+		for name, kind, description, metrics in self.items():
+			lines.append("# HELP {} {}".format(name, description))
+			lines.append("# TYPE {} {}".format(name, kind))
+			for labels, metric in metrics:
+				if kind == "counter":
+					lines.append("{}{} {}".format(name, FormatLabels(labels), metric.value))
+				elif kind == "gauge":
+					lines.append("{}{} {}".format(name, FormatLabels(labels), metric()))
+				else:
+					cumulative = 0
+					for bound, count in zip(metric.buckets + ["+Inf"], metric.counts):
+						cumulative += count
+						lines.append("{}_bucket{} {}".format(name, FormatLabels(labels, (("le", bound),)), cumulative))
+					lines.append("{}_sum{} {}".format(name, FormatLabels(labels), metric.sum))
+					lines.append("{}_count{} {}".format(name, FormatLabels(labels), metric.count))
+		return "\n".join(lines) + "\n"
+
+	def toDict(self) -> Dict:
+		# name -> list of {labels, value} or {labels, count, sum, buckets}
+		result = {}
+		for name, kind, description, metrics in self.items():
+			values = []
+			for labels, metric in metrics:
+				entry = { "labels": dict(labels) }
+				if kind == "counter":
+					entry["value"] = metric.value
+				elif kind == "gauge":
+					entry["value"] = metric()
+				else:
+					entry["count"] = metric.count
+					entry["sum"] = metric.sum
+					entry["buckets"] = dict(zip([str(bound) for bound in metric.buckets] + ["+Inf"], metric.counts))
+				values.append(entry)
+			result[name] = values
+		return result
+
+class SamplingProfiler:
+	# takes the stack of every other thread at a fixed interval while it is running and
+	# counts the stacks in the collapsed "thread;outer;...;inner count" format that
+	# flame graph tools read. costs nothing while stopped, can be started and stopped any time
+
+	def __init__(self):
+		self.samples = StackCounter()
+		self.sampleCount = 0
+		self.interval = DEFAULT_SAMPLE_INTERVAL
+		self.thread = None # type: Thread
+		self.running = False
+		self.lock = Lock()
+		# the sampler adds to the counter while /profiler reads it
+		self.samplesLock = Lock()
+
+	def start(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+		with self.lock:
+			if self.running:
+				return
+			if self.thread is not None:
+				# stopped but maybe still asleep
+				self.thread.join()
+			with self.samplesLock:
+				self.samples = StackCounter()
+			self.sampleCount = 0
+			self.interval = interval
+			self.running = True
+			self.thread = Thread(target=self.run, name="sampling-profiler", daemon=True)
+			self.thread.start()
+		Log(ErrorLevel.info, "sampling profiler started, every {}s", interval)
+
+	def stop(self):
+		with self.lock:
+			self.running = False
+		Log(ErrorLevel.info, "sampling profiler stopped after {} samples", self.sampleCount)
+
+	def run(self):
+		ownIdent = get_ident()
+		while self.running:
+			names = {thread.ident: thread.name for thread in enumerateThreads()}
+			stacks = []
+			for ident, frame in sys._current_frames().items():
+				if ident == ownIdent:
+					continue
+				stack = []
+				while frame is not None and len(stack) < MAX_STACK_DEPTH:
+					code = frame.f_code
+					stack.append("{} ({}:{})".format(code.co_name, code.co_filename, frame.f_lineno))
+					frame = frame.f_back
+				stack.append(names.get(ident, str(ident)))
+				stacks.append(";".join(reversed(stack)))
+			with self.samplesLock:
+				self.samples.update(stacks)
+			self.sampleCount += 1
+			sleep(self.interval)
+
+	def collapsed(self) -> str:
+		with self.samplesLock:
+			samples = StackCounter(dict(self.samples))
+		return "".join("{} {}\n".format(stack, count) for stack, count in samples.most_common())
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	# /metrics (prometheus text), /metrics.json, /profiler/start?interval=SECONDS,
+	# /profiler/stop and /profiler (collapsed stacks sampled so far)
+	registry = None # type: MetricsRegistry
+	profiler = None # type: SamplingProfiler
+
+	def log_message(self, format: str, *args):
+		Log(ErrorLevel.debug, "metrics: " + format, *args)
+
+	def sendBody(self, body: str, contentType: str, status: int = 200):
+		data = body.encode('utf-8')
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		url = urlsplit(self.path)
+		query = parse_qs(url.query)
+		if url.path == "/metrics":
+			self.sendBody(self.registry.render(), "text/plain; version=0.0.4")
+		elif url.path == "/metrics.json":
+			self.sendBody(json.dumps(self.registry.toDict()), "application/json")
+		elif url.path == "/profiler/start":
+			try:
+				interval = float(query.get("interval", [DEFAULT_SAMPLE_INTERVAL])[0])
+			except ValueError:
+				return self.sendBody("bad interval\n", "text/plain", 400)
+			self.profiler.start(max(0.001, interval))
+			self.sendBody("started\n", "text/plain")
+		elif url.path == "/profiler/stop":
+			self.profiler.stop()
+			self.sendBody("stopped\n", "text/plain")
+		elif url.path == "/profiler":
+			self.sendBody(self.profiler.collapsed(), "text/plain")
+		else:
+			self.sendBody("", "text/plain", 404)
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+def StartMetricsServer(
+	registry: MetricsRegistry, profiler: SamplingProfiler, port: int, host: str = METRICS_HOST
+) -> MetricsServer:
+	# serves on a background thread, None if the port is taken
+	handler = type("BoundMetricsHandler", (MetricsHandler,), {"registry": registry, "profiler": profiler})
+	try:
+		server = MetricsServer((host, port), handler)
+	except OSError as error:
+		Log(ErrorLevel.warning, "metrics endpoint can't listen on {}:{}: {}", host, port, error)
+		return None
+	Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+	Log(ErrorLevel.info, "metrics on http://{}:{}/metrics", host, port)
+	return server
@@ -1,18 +1,31 @@
 # coding=utf-8
 
 from typing import Dict, List
-import copy
 import sys
-import datetime
+from traceback import format_exc
+from time import time, perf_counter
 from os.path import join, dirname, realpath, exists
 from os import mkdir
-import json
-import requests
-import argparse
-import base64
+from threading import Thread
 
 from core.utils import GetTimeStamp, Log, ErrorLevel
-from core.userinfo import UserQueryManager
+from core.userinfo import (
+	UserQueryManager, TokenCache, WEBSITE_URL, INFORMATION_URL, PRESENCE_URL, TOKEN_CACHE_SUFFIX, TOKEN_MAX_AGE
+)
+from core.transport import HttpTransport
+from core.profiles import ProfileResolver, DEFAULT_AVATAR_WORKERS
+from core.avatars import AvatarCache, AvatarDirectory, IsAvatarKey
+from core.bus import PresencePublisher, DEFAULT_BUS_PORT
+from core.storage import JournalStorage, CreateUserRecord, RECORD_USER, RECORD_OPEN, RECORD_INTERVAL, RECORD_DROP
+from core.intervals import IntervalList, STATES
+from core.statusbatch import EvaluateStatuses, LoadNumpy
+from core.decoders import DecodePayload, StatusBatch, MESSAGE_EXTRACTORS
+from core.index import PresenceIndex
+from core.rollups import Rollups
+from core.scheduler import StaleScheduler, DEFAULT_QUERY_RATE
+from core.archive import RetentionPolicy, DropExpired
+from core.feedstream import FeedStream, DecodeFrame, PULL_MODES, DEFAULT_PULL_MODE, RECONNECT_FRAMES, DEFAULT_STREAM_CYCLE
+from core.metrics import MetricsRegistry, MetricHistogram, SamplingProfiler, StartMetricsServer, ResidentMemory, DEFAULT_METRICS_PORT
 
 # header to send with every request.
 PULL_REQUEST_HEADER_SKELETON = {
@@ -24,7 +37,6 @@ PULL_REQUEST_HEADER_SKELETON = {
 	'Referer': 'https://www.facebook.com/',
 	'User-Agent': None
 }
-JSON_PAYLOAD_PREFIX     = "for (;;);"
 ONLINE_DELTA            = 3 # maybe 3 mins is when you become offline
 START                   = 0 #
 END                     = 1 # these two are offset for start and end timestamps
@@ -33,56 +45,210 @@ RESOURCE_DIR            = join(ROOT_DIR, "resources")
 DEFAULT_DB_PATH         = join(RESOURCE_DIR, "database.json")
 DEFAULT_CONFIG_PATH     = join(ROOT_DIR, "default.conf")
 DEFAULT_UID2NAME_PATH   = join(RESOURCE_DIR, "uid2name.json")
-DB_DEFAULT_STRUCTURE    = {}
 DEFAULT_PULL_URL        = "https://5-edge-chat.facebook.com/pull"
+PROFILE_REFRESH_AGE     = 24 * 60 * 60 # seconds before the name and avatar of a user are checked again
+TRANSITION_NONE         = 0 # presence did not change the state
+TRANSITION_OPEN         = 1 # a new interval was started
+TRANSITION_CLOSE        = 2 # the ongoing interval was closed
+RETENTION_INTERVAL      = 60 * 60 # seconds between two checks for intervals past the retention period
+UNKNOWN_EXTRACTOR       = object() # MESSAGE_EXTRACTORS.get() default of an unknown message type
+
+class DatabaseLoadError(Exception):
+	# the db could not be loaded in the background, raised by every waitForDatabase() call
+	pass
+
+def LoadConfig(configPath: str) -> Dict[str, str]:
+	if not exists(configPath):
+		Log(ErrorLevel.error, "config file path ({}) does not exist", configPath)
+		sys.exit(1)
+	secrets = {}
+	with open(configPath) as configFile:
+		for line in configFile:
+			vals = line.strip().split('=', 1)
+			secrets[vals[0].lower()] = vals[1]
+	return secrets
 
 class PresenceMonitor:
 
-	def __init__(self, configPath: str, dbPath: str = DEFAULT_DB_PATH):
+	def __init__(
+		self, configPath: str, dbPath: str = DEFAULT_DB_PATH, queryManager: UserQueryManager = None,
+		publisher: PresencePublisher = None, loadInBackground: bool = False
+	):
 
 		### init folder structure
 		self.resourcePath = RESOURCE_DIR
 		if not exists(self.resourcePath):
 			mkdir(self.resourcePath)
 
-		### load DB from file
-		dbFile = None
-		if exists(dbPath):
-			dbFile = open(dbPath, 'r')
-		else:
-			tmpFile = open(dbPath, 'w')
-			tmpFile.write(json.dumps(DB_DEFAULT_STRUCTURE))
-			tmpFile.close()
-			dbFile = open(dbPath, 'r')
-		self.db = json.loads(dbFile.read())
-		dbFile.close()
-		self.dbPath = dbPath
-		Log(ErrorLevel.info, "db loaded")
+		### clocks, replaced by the replay driver
+		self.clock = GetTimeStamp # interval timestamps
+		self.epochClock = time # compared to the timestamps sent by facebook
+		# raw /pull responses are written here when set (see core.replay.FeedRecorder)
+		self.recorder = None
 
 		### load config file
-		self.secrets = {}
-		if not exists(configPath):
-			Log(ErrorLevel.error, "config file path ({}) does not exist", configPath)
-			sys.exit(1)
-		with open(configPath) as configFile:
-			for line in configFile:
-				vals = line.strip().split('=', 1)
-				self.secrets[vals[0].lower()] = vals[1]
+		self.secrets = LoadConfig(configPath)
+
+		### counters, latency histograms and gauges of every stage, served on a local port
+		self.metrics = MetricsRegistry()
+		# sampled stacks of every thread, started and stopped through the metrics endpoint
+		self.profiler = SamplingProfiler()
+		self.initMetrics()
+		metricsPort = int(self.secrets.get("metrics_port", DEFAULT_METRICS_PORT))
+		self.metricsServer = StartMetricsServer(self.metrics, self.profiler, metricsPort) if metricsPort != 0 else None
+
+		### every change is pushed to the web interface right away, the journal follows later
+		busPort = int(self.secrets.get("bus_port", DEFAULT_BUS_PORT))
+		self.publisher = publisher
+		if self.publisher is None and busPort != 0:
+			self.publisher = PresencePublisher(busPort)
+		# online users waiting for a direct presence query, ordered by when they are due
+		self.staleScheduler = StaleScheduler(
+			staleAfter=ONLINE_DELTA * 60,
+			queryRate=float(self.secrets.get("query_rate", DEFAULT_QUERY_RATE))
+		)
+
 		### fill up request header with valid informations from secret
 		self.PullRequestHeader = PULL_REQUEST_HEADER_SKELETON
 		self.PullRequestHeader["Cookie"] = self.secrets["cookie"]
 		self.PullRequestHeader["User-Agent"] = self.secrets["useragent"]
+		# endpoints can be overridden in the config, e.g. to run against fakeserver.py
+		self.pullURL = self.secrets.get("pull_url", DEFAULT_PULL_URL)
+		# poll: one request per payload, stream: one connection the payloads arrive on as they happen
+		self.pullMode = self.secrets.get("pull_mode", DEFAULT_PULL_MODE)
+		if self.pullMode not in PULL_MODES:
+			Log(ErrorLevel.error, "unknown pull_mode {}, use one of {}", self.pullMode, ", ".join(PULL_MODES))
+			sys.exit(1)
+		# seconds of frames processed before a cycle goes on with the presence queries
+		self.streamCycle = float(self.secrets.get("stream_cycle", DEFAULT_STREAM_CYCLE))
+		# the open /pull connection in stream mode
+		self.feedStream = None # type: FeedStream
+		self.streamFailed = False
 		Log(ErrorLevel.info, "config loaded")
 
 		### reset params of request header
 		self.resetParameters()
 
+		### pooled http sessions shared with the user manager
+		self.transport = HttpTransport.fromConfig(self.secrets)
+
 		### load user manager that handles unique query logic
-		self.queryManager = UserQueryManager(
-			userFBID= self.secrets["uid"],
-			cookie = self.secrets["cookie"],
-			userAgent = self.secrets["useragent"]
+		if queryManager is None:
+			queryManager = UserQueryManager(
+				userFBID= self.secrets["uid"],
+				cookie = self.secrets["cookie"],
+				userAgent = self.secrets["useragent"],
+				transport = self.transport,
+				websiteURL = self.secrets.get("website_url", WEBSITE_URL),
+				informationURL = self.secrets.get("information_url", INFORMATION_URL),
+				presenceURL = self.secrets.get("presence_url", PRESENCE_URL),
+				tokenCache = TokenCache(
+					dbPath + TOKEN_CACHE_SUFFIX, float(self.secrets.get("token_max_age", TOKEN_MAX_AGE))
+				)
+			)
+			# the /pull doesn't need the token, it is ready by the time a query does
+			queryManager.prefetchToken()
+		self.queryManager = queryManager
+		self.avatarCache = AvatarCache(AvatarDirectory(dbPath))
+		self.profileResolver = ProfileResolver(
+			self.queryManager, self.transport, self.avatarCache,
+			avatarWorkers=int(self.secrets.get("avatar_workers", DEFAULT_AVATAR_WORKERS)),
+			metrics=self.metrics
 		)
+		# uid -> when its profile was last looked up, used for the lazy avatar refresh
+		self.profileCheckedAt = {} # type: Dict[str, int]
+
+		### load DB from snapshot + journal
+		# history older than the retention period is moved to the archive (see core.archive)
+		self.retention = RetentionPolicy.fromConfig(self.secrets)
+		self.storage = JournalStorage(dbPath, retention=self.retention)
+		self.dbPath = dbPath
+		self.db = None # type: Dict
+		# every change gets the next version so readers can ask for what changed since
+		self.version = 0
+		# records (new users, opened and closed intervals) waiting for the next save
+		self.pendingRecords = []
+		# interval index over the whole db, built on the first getIndex() call
+		self.index = None # type: PresenceIndex
+		# hourly/daily rollups, built on the first getRollups() call
+		self.rollups = None # type: Rollups
+		# users tracked by another monitor (see core.supervisor), their presence is ignored here
+		self.foreignUids = set()
+		# (uid, state) -> start of its ongoing interval
+		self.openIntervals = {} # type: Dict[tuple, int]
+		# when set, new users get an empty record and their profile is fetched in the background
+		self.deferProfiles = True
+		# users whose profile is looked up at the end of the cycle
+		self.unresolvedProfiles = [] # type: List[str]
+		# when the expired intervals were last dropped from memory
+		self.retainedAt = None # type: int
+		# with loadInBackground the first /pull goes out while the db is read,
+		# everything that touches the db waits for it in waitForDatabase()
+		self.loadThread = None # type: Thread
+		self.loadError = None # type: BaseException
+		if loadInBackground:
+			self.loadThread = Thread(target=self.loadInThread, name="db-loader", daemon=True)
+			self.loadThread.start()
+		else:
+			self.loadDatabase()
+
+	def initMetrics(self):
+		metrics = self.metrics
+		self.cycleTime = metrics.histogram("presence_cycle_seconds", "One query() cycle: /pull, presence queries and profiles")
+		self.pullTime = metrics.histogram("presence_pull_seconds", "Round trip of a /pull long-poll")
+		self.pullBytes = metrics.counter("presence_pull_bytes_total", "Bytes of /pull responses")
+		self.pullErrors = metrics.counter("presence_pull_errors_total", "Failed or unreadable /pull requests")
+		self.decodeTime = metrics.histogram("presence_decode_seconds", "JSON decode of a /pull response")
+		self.unknownMessages = metrics.counter("presence_unknown_messages_total", "/pull messages of an unknown type")
+		self.streamFrames = metrics.counter("presence_stream_frames_total", "Frames read from the /pull stream")
+		self.streamReconnects = metrics.counter("presence_stream_reconnects_total", "Stream connections ended for new parameters")
+		# message type -> its handling time, created when the type shows up first
+		self.messageTimes = {} # type: Dict[str, MetricHistogram]
+		self.queryTime = metrics.histogram("presence_query_cycle_seconds", "Direct presence queries of one cycle")
+		self.presenceQueries = metrics.counter("presence_queries_total", "Direct presence queries sent")
+		self.saveTime = metrics.histogram("presence_save_seconds", "Journal append of a save")
+		self.saveBytes = metrics.counter("presence_save_bytes_total", "Bytes appended to the journal")
+		self.savedRecords = metrics.counter("presence_saved_records_total", "Records appended to the journal")
+		metrics.gauge("presence_tracked_users", "Users in the db", lambda: len(self.db) if self.db is not None else 0)
+		metrics.gauge("presence_open_intervals", "Ongoing intervals", lambda: len(self.openIntervals))
+		metrics.gauge("presence_pending_records", "Records waiting for the next save", lambda: len(self.pendingRecords))
+		metrics.gauge("process_resident_memory_bytes", "Resident memory of the monitor process", ResidentMemory)
+
+	def messageTime(self, itemType: str) -> MetricHistogram:
+		histogram = self.messageTimes.get(itemType)
+		if histogram is None:
+			histogram = self.messageTimes[itemType] = self.metrics.histogram(
+				"presence_message_seconds", "Handling of one /pull message by type", type=itemType
+			)
+		return histogram
+
+	def loadDatabase(self):
+		self.db = self.storage.load()
+		self.version = self.storage.version
+		# including users whose lookup didn't finish before the last shutdown
+		self.unresolvedProfiles += [uid for uid in self.db if self.db[uid]["fullname"] is None]
+		self.applyRetention()
+		self.dropDanglingIntervals()
+		self.migrateAvatars()
+		Log(ErrorLevel.info, "db loaded")
+
+	def loadInThread(self):
+		try:
+			self.loadDatabase()
+			# warmed up while nothing waits for it, the first buddy list needs it
+			LoadNumpy()
+		except BaseException as error:
+			Log(ErrorLevel.error, "db could not be loaded from {}: {}", self.dbPath, format_exc())
+			self.loadError = error
+
+	def waitForDatabase(self):
+		# the error of a failed load is kept, nothing may go on with an empty db
+		loadThread = self.loadThread
+		if loadThread is not None:
+			loadThread.join()
+			self.loadThread = None
+		if self.loadError is not None:
+			raise DatabaseLoadError(self.dbPath) from self.loadError
 
 	def createPresence(
 		self, uid: str, lastactive: int,
@@ -96,111 +262,319 @@ class PresenceMonitor:
 			"active": active
 		}
 
+	def takePendingRecords(self, isFullSave = False) -> List[List]:
+		if isFullSave:
+			# close every ongoing recording
+			timeStamp = self.clock()
+			for (uid, userState), start in self.openIntervals.items():
+				self.record(RECORD_INTERVAL, uid, userState, start, timeStamp)
+		records = self.pendingRecords
+		self.pendingRecords = []
+		return records
+
+	def record(self, recordType: str, *fields) -> List:
+		self.version += 1
+		record = [recordType, *fields, self.version]
+		self.pendingRecords.append(record)
+		if self.index is not None:
+			self.index.applyRecord(record)
+		if self.rollups is not None:
+			self.rollups.applyRecord(record)
+		if self.publisher is not None:
+			self.publisher.publish(record)
+		return record
+
+	def getIndex(self) -> PresenceIndex:
+		# kept up to date by record() from then on
+		self.waitForDatabase()
+		if self.index is None:
+			self.index = PresenceIndex.fromDatabase(self.db)
+		return self.index
+
+	def getRollups(self) -> Rollups:
+		# kept up to date by record() from then on
+		self.waitForDatabase()
+		if self.rollups is None:
+			self.rollups = Rollups.fromDatabase(self.db)
+		return self.rollups
+
+	def dropDanglingIntervals(self):
+		# an interval still open on disk was cut by a crash, we don't know when it ended
+		for uid in self.db:
+			for state in STATES:
+				intervals = self.db[uid][state]
+				if intervals.isLastOpen():
+					self.record(RECORD_DROP, uid, state, intervals.lastStart())
+					intervals.popOpen()
+
 	def saveDB(self, isFullSave = False):
+		self.waitForDatabase()
 		if isFullSave:
 			Log(ErrorLevel.info, "saving every record to db")
 		else:
 			Log(ErrorLevel.info, "saving finished records to db")
-		timeStamp = GetTimeStamp()
-		copiedDB = copy.deepcopy(self.db)
-		for uid in copiedDB:
-			for userState in ["online", "mobile", "active"]:
-				user = copiedDB[uid][userState]
-				if len(user) != 0:
-					lastEntry = user[-1]
-					if lastEntry[END] is None:
-						if not isFullSave:
-							# ongoing records ignored
-							copiedDB[uid][userState].pop()
-						else:
-							# close every ongoing recording
-							modifiedLastEntry = user.pop()
-							modifiedLastEntry[END] = timeStamp
-							user.append(modifiedLastEntry)
-							copiedDB[uid][userState] = user
-		# export db to json file
-		with open(self.dbPath, 'w') as dbFile:
-			dbFile.write(json.dumps(copiedDB))
+		self.resolveProfiles()
+		# only the changes since the last save go to disk
+		self.saveRecords(self.takePendingRecords(isFullSave))
+		self.applyRetentionIfDue()
+		if isFullSave:
+			self.storage.compact(wait=True)
+
+	def saveRecords(self, records: List[List]):
+		# the journal append of a save, the engines run it on a thread of their own;
+		# taking the records and the retention pass stay with the thread that owns the db
+		try:
+			with self.saveTime.time():
+				self.saveBytes.inc(self.storage.append(records))
+		except:
+			# saved with the next ones, in front of the records made meanwhile
+			self.pendingRecords[0:0] = records
+			raise
+		self.savedRecords.inc(len(records))
+
+	def applyRetentionIfDue(self):
+		if self.retainedAt is None or self.clock() - self.retainedAt >= RETENTION_INTERVAL:
+			self.applyRetention()
+
+	def applyRetention(self):
+		# only the hot window is kept in memory: intervals past the retention period are
+		# dropped here and the compaction they trigger moves them from the snapshot to the archive
+		self.retainedAt = self.clock()
+		if not self.retention.isEnabled():
+			return
+		cutoff = self.retention.cutoff(self.retainedAt)
+		expired = DropExpired(self.db, cutoff)
+		if len(expired) == 0:
+			return
+		Log(ErrorLevel.info, "history of {} users is past the retention period", len(expired))
+		if self.index is not None:
+			self.index.dropBefore(cutoff)
+		if self.rollups is not None:
+			self.rollups.dropBefore(cutoff)
+		self.storage.compact()
 
 	def saveAll(self):
 		self.saveDB(isFullSave = True)
 
 	def getRawFeedResponse(self) -> Dict:
-		responseObj = None
+		raw_response = self.fetchFeedResponse()
+		return self.decodeFeedResponse(raw_response) if raw_response is not None else None
+
+	def fetchFeedResponse(self) -> bytes:
+		# one /pull round trip, the response body or None if it failed
 		try:
-			response_obj = requests.get(DEFAULT_PULL_URL, params=self.params, headers=self.PullRequestHeader)
-			raw_response = response_obj.text
-			if not raw_response:
-				return None
-			if raw_response.startswith(JSON_PAYLOAD_PREFIX):
-				responseObj = raw_response[len(JSON_PAYLOAD_PREFIX):].strip()
-				responseObj = json.loads(responseObj)
-			else:
-				# If it didn't start with for (;;); then something weird is happening.
-				responseObj = json.loads(raw_response)
+			begin = perf_counter()
+			response_obj = self.transport.pull(
+				self.pullURL,
+				params=self.params,
+				headers=self.PullRequestHeader
+			)
+			raw_response = response_obj.content
 		except:
+			self.pullErrors.inc()
 			Log(ErrorLevel.warning, "error happened while requesting json: {}", sys.exc_info()[0])
+			return None
+		self.pullTime.observe(perf_counter() - begin)
+		self.pullBytes.inc(len(raw_response))
+		if self.recorder is not None:
+			self.recorder.record(raw_response.decode('utf-8', 'replace'))
+		return raw_response
+
+	def decodeFeedResponse(self, raw_response: bytes) -> Dict:
+		try:
+			with self.decodeTime.time():
+				return self.parseFeedResponse(raw_response)
+		except:
+			self.pullErrors.inc()
+			Log(ErrorLevel.warning, "error happened while decoding json: {}", sys.exc_info()[0])
+			return None
+
+	def openFeedStream(self) -> FeedStream:
+		response = self.transport.pull(
+			self.pullURL,
+			params=self.params,
+			headers=self.PullRequestHeader,
+			stream=True
+		)
+		response.raise_for_status()
+		return FeedStream(response)
+
+	def closeFeedStream(self):
+		if self.feedStream is not None:
+			self.feedStream.close()
+			self.feedStream = None
+
+	def nextFeedFrame(self, timeout: float = None) -> Dict:
+		# stream mode: the next payload of the open /pull connection, decoded
+		frame = self.nextRawFrame(timeout)
+		if frame is None:
+			return None
+		responseObj = self.decodeFeedFrame(frame)
+		if responseObj is None:
+			# the stream is out of step, start over
+			self.closeFeedStream()
+			self.streamFailed = True
 		return responseObj
 
+	def nextRawFrame(self, timeout: float = None) -> bytes:
+		# a new connection is opened right away when there is none or the server ended
+		# the last one. None if the connection failed or ended without a single frame,
+		# the caller waits a bit then. with a timeout also None if no frame arrived in
+		# time, streamFailed tells the two apart
+		deadline = None if timeout is None else perf_counter() + timeout
+		try:
+			while True:
+				if self.feedStream is None:
+					with self.pullTime.time():
+						self.feedStream = self.openFeedStream()
+				if deadline is not None and not self.feedStream.waitFrame(deadline - perf_counter()):
+					self.streamFailed = False
+					return None
+				frame = self.feedStream.nextFrame()
+				if frame is not None:
+					break
+				frameCount = self.feedStream.frameCount
+				self.closeFeedStream()
+				if frameCount == 0:
+					self.streamFailed = True
+					return None
+		except:
+			self.pullErrors.inc()
+			self.closeFeedStream()
+			self.streamFailed = True
+			Log(ErrorLevel.warning, "error happened while reading the /pull stream: {}", sys.exc_info()[0])
+			return None
+		self.streamFailed = False
+		self.streamFrames.inc()
+		self.pullBytes.inc(len(frame))
+		if self.recorder is not None:
+			self.recorder.record(frame.decode('utf-8'))
+		return frame
+
+	def decodeFeedFrame(self, frame: bytes) -> Dict:
+		try:
+			with self.decodeTime.time():
+				return DecodeFrame(frame)
+		except:
+			self.pullErrors.inc()
+			Log(ErrorLevel.warning, "error happened while decoding a /pull frame: {}", sys.exc_info()[0])
+			return None
+
+	def isStreaming(self) -> bool:
+		return self.pullMode == "stream"
+
+	def nextCycleDelay(self, delay: float) -> float:
+		# seconds to sleep before the next cycle: none while the stream works, reading it waits for the events
+		return 0 if self.isStreaming() and not self.streamFailed else delay
+
+	@staticmethod
+	def parseFeedResponse(raw_response: bytes) -> Dict:
+		# If it didn't start with for (;;); then something weird is happening, it is parsed anyway
+		return DecodePayload(raw_response)
+
 	def createNewUserDB(self, uid: str):
-		self.db[uid] = {
-			"online": [],
-			"active": [],
-			"mobile": [],
-			"fullname": None,
-			"image": None
-		}
-		# get misc user info
-		userInfo = self.queryManager.getUserInfo(uid)
-		self.db[uid]["fullname"] = userInfo["fullname"]
-		# download image, convert to 64 and save
-		imageBin = requests.get(userInfo["thumbnailURL"]).content
-		image64Bin = base64.b64encode(imageBin)
-		image64 = image64Bin.decode('utf-8')
-		self.db[uid]["image"] = image64
-
-	def getUser(self, uid: str, state: str) -> List[List[int]]:
+		self.db[uid] = CreateUserRecord()
+		if self.deferProfiles:
+			# resolved in bulk at the end of the cycle, presence processing goes on meanwhile
+			self.unresolvedProfiles.append(uid)
+		else:
+			self.applyProfile(uid, *self.profileResolver.fetchOne(uid))
+		self.profileCheckedAt[uid] = self.clock()
+
+	def resolveProfiles(self):
+		# hand the uids seen since the last call to the resolver and apply the finished lookups
+		self.waitForDatabase()
+		knownThumbnails = {uid: self.db[uid]["thumbnail"] for uid in self.unresolvedProfiles}
+		self.profileResolver.request(self.unresolvedProfiles, knownThumbnails)
+		self.unresolvedProfiles = []
+		for uid, fullname, thumbnailURL, avatarKey in self.profileResolver.takeResolved():
+			self.applyProfile(uid, fullname, thumbnailURL, avatarKey)
+
+	def applyProfile(self, uid: str, fullname: str, thumbnailURL: str, avatarKey: str):
+		user = self.db[uid]
+		if avatarKey is None:
+			# picture didn't change (or couldn't be downloaded), keep the one we have
+			avatarKey = user["image"]
+			thumbnailURL = user["thumbnail"]
+		if (user["fullname"], user["image"], user["thumbnail"]) == (fullname, avatarKey, thumbnailURL):
+			return
+		user["fullname"] = fullname
+		user["image"] = avatarKey
+		user["thumbnail"] = thumbnailURL
+		self.record(RECORD_USER, uid, fullname, avatarKey, thumbnailURL)
+
+	def refreshProfileIfOld(self, uid: str, timeStamp: int):
+		# avatars are only checked again when the user shows up and the last check is old
+		if timeStamp - self.profileCheckedAt.get(uid, 0) > PROFILE_REFRESH_AGE:
+			self.profileCheckedAt[uid] = timeStamp
+			self.unresolvedProfiles.append(uid)
+
+	def migrateAvatars(self):
+		# databases written before the avatar cache hold the base64 image itself
+		for uid in self.db:
+			user = self.db[uid]
+			if (user["image"] is not None) and not IsAvatarKey(user["image"]):
+				user["image"] = self.avatarCache.storeBase64(user["image"])
+				self.record(RECORD_USER, uid, user["fullname"], user["image"], user["thumbnail"])
+				Log(ErrorLevel.info, "avatar of {} moved to the avatar cache", uid)
+
+	def getUser(self, uid: str, state: str) -> IntervalList:
+		# returns the live interval list, change it only through transition()
 		if uid not in self.db:
 			self.createNewUserDB(uid)
-		return copy.deepcopy(self.db[uid][state])
+		return self.db[uid][state]
 
-	def setUser(self, uid: str, state: str, intervalList: List[List]):
-		newValue = intervalList[-1]
-		if (len(self.db[uid][state]) == 0) or (self.db[uid][state][0] != intervalList[-1][0]):
-			oldValue = []
-		else:
-			oldValue = self.db[uid][state]
-		Log(ErrorLevel.debug, "changing {}'s {} state from {} to {}", uid, state, oldValue, newValue)
-		self.db[uid][state] = intervalList
-
-	def processPresence(self, presence: Dict, state: str):
-		timeIntervals = self.getUser(presence["uid"], state)
-		if presence[state] is True:
-			if len(timeIntervals) == 0:
-				# user has no records yet of this state
-				Log(ErrorLevel.debug, "{} with state {} has no records yet, create one", presence["uid"], state)
-				timeIntervals.append([presence["lastactive"], None])
-				self.setUser(presence["uid"], state, timeIntervals)
-			else:
-				# so the array is not empty
-				isLastIntervalClosed = timeIntervals[-1][END] is not None
-				if isLastIntervalClosed:
-					# user has no open entry, start new
-					Log(ErrorLevel.debug, "{} with state {} has no open entry, create new", presence["uid"], state)
-					timeIntervals.append([presence["lastactive"], None])
-					self.setUser(presence["uid"], state, timeIntervals)
-		elif presence[state] is False:
-			if len(timeIntervals) != 0:
-				lastEntryOpen = timeIntervals[-1][END] is None
-				if lastEntryOpen:
-					modifiedLastEntry = timeIntervals.pop()
-					#print("[debug]: end value of LAT: {}".format(str(presenceData["lastactive"])))
-					modifiedLastEntry[END] = presence["lastactive"]
-					timeIntervals.append(modifiedLastEntry)
-					#print("[debug]: {} ->{} left".format(presenceType, userName))
-					self.setUser(presence["uid"], state, timeIntervals)
-		else:
-			Log(ErrorLevel.warning, "presence value is not valid in object: {}", presence)
+	def transition(self, uid: str, state: str, isOn: bool, timeStamp: int) -> int:
+		key = (uid, state)
+		if isOn:
+			if key in self.openIntervals:
+				return TRANSITION_NONE
+			self.db[uid][state].appendOpen(timeStamp)
+			self.openIntervals[key] = timeStamp
+			self.record(RECORD_OPEN, uid, state, timeStamp)
+			if state == "online":
+				self.staleScheduler.opened(uid, timeStamp)
+				self.refreshProfileIfOld(uid, timeStamp)
+			Log(ErrorLevel.debug, "{} with state {} has no open entry, create new", uid, state)
+			return TRANSITION_OPEN
+		start = self.openIntervals.pop(key, None)
+		if start is None:
+			return TRANSITION_NONE
+		self.db[uid][state].closeLast(timeStamp)
+		if state == "online":
+			self.staleScheduler.closed(uid)
+		self.record(RECORD_INTERVAL, uid, state, start, timeStamp)
+		Log(ErrorLevel.debug, "{} with state {} closed [{}, {}]", uid, state, start, timeStamp)
+		return TRANSITION_CLOSE
+
+	def releaseUsers(self, uids: List[str]):
+		# stop tracking users another monitor took over, their ongoing intervals are dropped
+		self.waitForDatabase()
+		for uid in uids:
+			self.foreignUids.add(uid)
+			if uid not in self.db:
+				continue
+			for state in STATES:
+				start = self.openIntervals.pop((uid, state), None)
+				if start is not None:
+					self.db[uid][state].popOpen()
+					self.record(RECORD_DROP, uid, state, start)
+			self.staleScheduler.closed(uid)
+
+	def adoptUsers(self, uids: List[str]):
+		# the monitor that tracked these users is gone, track them here again
+		self.foreignUids.difference_update(uids)
+
+	def processPresence(self, presence: Dict, state: str) -> int:
+		uid = presence["uid"]
+		if uid in self.foreignUids:
+			return TRANSITION_NONE
+		if uid not in self.db:
+			self.createNewUserDB(uid)
+		if (presence[state] is True) or (presence[state] is False):
+			return self.transition(uid, state, presence[state], presence["lastactive"])
+		Log(ErrorLevel.warning, "presence value is not valid in object: {}", presence)
+		return TRANSITION_NONE
 
 	def processByMatchingStates(self, presence: Dict):
 		self.processPresence(presence, "online")
@@ -209,104 +583,112 @@ class PresenceMonitor:
 		if presence["mobile"] is not None:
 			self.processPresence(presence, "mobile")
 
-	def processFriendStatusList(self, chatProxyData: Dict):
-		for uid in chatProxyData["buddyList"]:
-			uidContent = chatProxyData["buddyList"][uid]
-			if "lat" in uidContent:
-				timeStamp = uidContent["lat"]
-				isOnline = not self.isOlderThanDelta(timeStamp)
-				if "p" in uidContent:
-					isActive = (uidContent["p"] != 0) and isOnline
-				elif isOnline is False:
-					isActive = False # it cannot be active if not online
-				else:
-					isActive = None # if its still online but no presence data, we don't know
-				# cancel mobile
-				if isOnline is False:
-					isMobile = False
-				else:
-					isMobile = None
-				self.processByMatchingStates(self.createPresence(uid, GetTimeStamp(), isOnline, isActive, isMobile))
-
-	def processUniqueFriendStatus(self, buddyListData: Dict):
-		for uid in buddyListData["overlay"]:
-			uidData = buddyListData["overlay"][uid]
-			if "la" in uidData:
-				timeStamp = uidData["la"]
-				isOnline = not self.isOlderThanDelta(timeStamp)
-				# cancel active
-				if "a" in uidData:
-					isActive = (uidData["a"] != 0) and isOnline
-				elif isOnline is False:
-					isActive = False # it cannot be active if not online
-				else:
-					isActive = None # still online but no presence data, we don't know
-				# cancel mobile
-				if isOnline is False:
-					isMobile = False
-				else:
-					isMobile = None
-				self.processByMatchingStates(self.createPresence(uid, GetTimeStamp(), isOnline, isActive, isMobile))
-
-	def processPhoneInfo(self, phoneInfo: Dict):
-		uid = phoneInfo["from"]
-		self.processByMatchingStates(self.createPresence(uid, GetTimeStamp(), online=True, active=True, mobile=True))
-
-	def processDelta(self, deltaInfo):
-		if "delta" in deltaInfo:
-			deltaKeyContent = deltaInfo["delta"]
-			if "threadKey" in deltaKeyContent:
-				threadKeyContent = deltaKeyContent["threadKey"]
-				if "otherUserFbId" in threadKeyContent:
-					uid = threadKeyContent["otherUserFbId"]
-					self.processByMatchingStates(self.createPresence(uid, GetTimeStamp(), online=True, active=True))
-
-	def processTyping(self, typingInfo):
-		if ("u" in typingInfo) and ("ms" in typingInfo):
-			ownFBID = typingInfo["u"]
-			for msItem in typingInfo["ms"]:
-				if (    "type" in msItem) \
-					and (msItem["type"] == "typ") \
-					and ("from" in msItem) \
-					and (msItem["from"] != ownFBID
-				):
-					uid = msItem["from"]
-					if ("from_mobile" in msItem["from_mobile"]):
-						isMobile = msItem["from_mobile"]
-					else:
-						isMobile = None
-					self.processByMatchingStates(self.createPresence(
-						uid,
-						GetTimeStamp(),
-						online=True, active=True, mobile=isMobile)
-					)
-
-	def processMessageContent(self, msContent: Dict):
+	def applyStatuses(self, uids: List[str], online: List[bool], active: List[bool], timeStamp: int) -> int:
+		# bulk processByMatchingStates for the buddy list messages, returns the number of transitions
+		# active None means unknown, mobile is only known to be off when the user is offline
+		transitions = 0
+		for uid, isOnline, isActive in zip(uids, online, active):
+			if uid in self.foreignUids:
+				continue
+			if uid not in self.db:
+				self.createNewUserDB(uid)
+			transitions += self.transition(uid, "online", isOnline, timeStamp) != TRANSITION_NONE
+			if isActive is not None:
+				transitions += self.transition(uid, "active", isActive, timeStamp) != TRANSITION_NONE
+			if not isOnline:
+				transitions += self.transition(uid, "mobile", False, timeStamp) != TRANSITION_NONE
+		return transitions
+
+	def applyStatusBatch(self, batch: StatusBatch):
+		# the whole message is evaluated against one cutoff, see core.statusbatch
+		online, active = EvaluateStatuses(batch.lastActive, batch.active, self.onlineCutoff())
+		self.applyStatuses(batch.uids, online, active, self.clock())
+
+	def applyExtracted(self, extracted):
+		# what an extractor of core.decoders got out of a message
+		if isinstance(extracted, StatusBatch):
+			self.applyStatusBatch(extracted)
+			return
+		timeStamp = self.clock()
+		for uid, isActive, isMobile in extracted:
+			self.processByMatchingStates(self.createPresence(uid, timeStamp, online=True, active=isActive, mobile=isMobile))
+
+	def processMessageContent(self, msContent: List[Dict]):
+		# every message type has its extractor (core.decoders.MESSAGE_EXTRACTORS),
+		# the types we don't need aren't read, the ones we don't know are only counted
 		for msItem in msContent:
-			itemType = msItem["type"]
-			if itemType == "chatproxy-presence":
-				self.processFriendStatusList(msItem)
-			elif itemType == "buddylist_overlay":
-				self.processUniqueFriendStatus(msItem)
-			elif itemType == "t_tp":
-				self.processPhoneInfo(msItem)
-			elif itemType == "delta":
-				self.processDelta(msItem)
-			elif itemType == "typ":
-				self.processTyping(msItem)
-			elif itemType == "inbox":
-				pass # we are not interested in inbox info
-			else:
-				Log(ErrorLevel.debug, "unknown message type {}", msItem["type"])
+			itemType = msItem.get("type")
+			begin = perf_counter()
+			extractor = MESSAGE_EXTRACTORS.get(itemType, UNKNOWN_EXTRACTOR)
+			if extractor is UNKNOWN_EXTRACTOR:
+				self.unknownMessages.inc()
+				continue
+			if extractor is not None:
+				self.applyExtracted(extractor(msItem))
+			self.messageTime(itemType).observe(perf_counter() - begin)
 
 	def processFeedResponse(self):
+		if self.isStreaming():
+			self.processFeedStream()
+			return
 		# first we make a request to fb
-		responseObj = self.getRawFeedResponse()
+		self.handleFeedResponse(self.getRawFeedResponse())
+
+	def processFeedStream(self):
+		# frames are handled as they arrive for streamCycle seconds, an idle stream
+		# doesn't hold up the cycle. the connection stays open for the next one
+		deadline = perf_counter() + self.streamCycle
+		while True:
+			remaining = deadline - perf_counter()
+			if remaining <= 0:
+				return
+			responseObj = self.nextFeedFrame(remaining)
+			if responseObj is None:
+				if self.streamFailed:
+					self.handleFeedResponse(None)
+				return
+			self.handleFeedFrame(responseObj)
+
+	def handleFeedFrame(self, responseObj: Dict):
+		# one frame of the stream. a new sticky pool/token, a sequence number going back
+		# or a refresh request end the connection: the next frame comes on a new one
+		# with the new parameters, without waiting
+		self.waitForDatabase()
+		if self.applyFeedParameters(responseObj):
+			self.streamReconnects.inc()
+			self.closeFeedStream()
+		self.handleFeedMessages(responseObj)
+
+	def handleFeedResponse(self, responseObj: Dict):
+		self.waitForDatabase()
 		# if its empty there is a problem
 		if responseObj is None:
 			print("[error]: request error, restarting")
 			self.resetParameters()
 			return
+		self.handleFeedParameters(responseObj)
+		self.handleFeedMessages(responseObj)
+
+	def handleFeedMessages(self, responseObj: Dict):
+		# ms contains the friends infos
+		if "ms" in responseObj:
+			self.processMessageContent(responseObj["ms"])
+		else:
+			Log(ErrorLevel.debug, "'ms' was not found in response. content: {}", responseObj)
+
+	def applyFeedParameters(self, responseObj: Dict) -> bool:
+		# True if a stream connection has to be replaced: a new sticky pool/token,
+		# a sequence number going back or a refresh request
+		sticky = (self.params["sticky_pool"], self.params["sticky_token"])
+		seq = int(self.params["seq"])
+		self.handleFeedParameters(responseObj)
+		return (
+			sticky != (self.params["sticky_pool"], self.params["sticky_token"])
+			or int(self.params["seq"]) < seq
+			or responseObj.get("t") in RECONNECT_FRAMES
+		)
+
+	def handleFeedParameters(self, responseObj: Dict):
 		# We got info about which pool/sticky we should be using I think??? Something to do with load balancers?
 		if "lb_info" in responseObj:
 			self.params["sticky_pool"] = responseObj["lb_info"]["pool"]
@@ -314,45 +696,48 @@ class PresenceMonitor:
 		# seq apparently isn't tcp seq, does nothing
 		if "seq" in responseObj:
 			self.params["seq"] = responseObj["seq"]
-		# ms contains the friends infos
-		if "ms" in responseObj:
-			self.processMessageContent(responseObj["ms"])
-		else:
-			Log(ErrorLevel.debug, "'ms' was not found in response. content: {}", responseObj)
+
+	def onlineCutoff(self) -> float:
+		# users last active before this are offline
+		return self.epochClock() - ONLINE_DELTA * 60
 
 	def isOlderThanDelta(self, secsFromEpoch: int) -> bool:
-		userTimeStamp = datetime.datetime.fromtimestamp(secsFromEpoch)
-		return \
-			userTimeStamp < (datetime.datetime.now() - datetime.timedelta(minutes=ONLINE_DELTA))
-
-	def isUserStateOpenedButOld(self, uid: str, state: str) -> bool:
-		intervalsRef = self.getUser(uid, state)
-		if len(intervalsRef) != 0:
-			lastInterval = intervalsRef[-1]
-			if (lastInterval[END] is None) and self.isOlderThanDelta(lastInterval[START]):
-				return True
-		return False
+		return secsFromEpoch < self.onlineCutoff()
+
+	def getStaleUsers(self) -> List[str]:
+		# get presence IF the user has been online for longer than time delta (3mins)
+		# we don't want to be suspicious by querying every uid every time,
+		# the scheduler only hands out the due ones within the query rate
+		return self.staleScheduler.takeDue(self.epochClock())
+
+	def applyQueriedPresence(self, uid: str, presenceData: Dict):
+		self.waitForDatabase()
+		isOnline = presenceData["isOnline"]
+		isActive = None
+		isMobile = None
+		if isOnline is False:
+			isActive = False
+			isMobile = False
+		Log(ErrorLevel.debug, "query response: {} is {}", uid, ("online" if isOnline else "offline"))
+		self.processByMatchingStates(self.createPresence(uid, self.clock(), isOnline, isActive, isMobile))
+		# still online (or no answer): check again later, less often each time
+		self.staleScheduler.confirmed(uid, self.epochClock())
 
 	def processQueryResponse(self):
-		# get presence IF the last user status is older than time delta (3mins)
-		# we don't want to be suspicious by querying every uid every time
-		for uid in self.db.keys():
-			if self.isUserStateOpenedButOld(uid, "online"):
-				presenceData = self.queryManager.getPresence(uid)
-				isOnline = presenceData["isOnline"]
-				isActive = None
-				isMobile = None
-				if isOnline is False:
-					isActive = False
-					isMobile = False
-				Log(ErrorLevel.debug, "query response: {} is {}", uid, ("online" if isOnline else "offline"))
-				self.processByMatchingStates(self.createPresence(uid, GetTimeStamp(), isOnline, isActive, isMobile))
+		with self.queryTime.time():
+			for uid in self.getStaleUsers():
+				self.applyQueriedPresence(uid, self.queryManager.getPresence(uid))
+				self.presenceQueries.inc()
 
 	def query(self):
-		self.processFeedResponse()
-		self.processQueryResponse()
+		with self.cycleTime.time():
+			self.processFeedResponse()
+			self.processQueryResponse()
+			self.resolveProfiles()
 
 	def resetParameters(self):
+		# new parameters need a new stream connection
+		self.closeFeedStream()
 		self.params = {
 			# No idea what this is.
 			'cap': '8',
@@ -366,7 +751,7 @@ class PresenceMonitor:
 			'idle': '0',
 			# No idea what this is.
 			'isq': '173180',
-			# Whether to stream the HTTP GET request. We don't want to!
+			# Whether to stream the HTTP GET request, set below with pull_mode=stream
 			# 'mode': 'stream',
 			# Is this how many messages we have got from Facebook in this session so far?
 			# Previous value: 26
@@ -386,4 +771,6 @@ class PresenceMonitor:
 			'uid': self.secrets["uid"],
 			'viewer_uid': self.secrets["uid"],
 			'wtc': '171%2C170%2C0.000%2C171%2C171'
-		}
\ No newline at end of file
+		}
+		if self.isStreaming():
+			self.params['mode'] = 'stream'
\ No newline at end of file
@@ -0,0 +1,256 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple
+from traceback import format_exc
+from threading import Thread, Event
+from queue import Queue, Full, Empty
+from time import perf_counter, sleep
+
+from core import globals
+from core.utils import Log, ErrorLevel
+from core.monitor import PresenceMonitor, DatabaseLoadError
+from core.metrics import MetricsRegistry
+
+DEFAULT_QUEUE_SIZE      = 64  # items a stage can get ahead of the next one before it has to wait
+DEFAULT_QUERY_WORKERS   = 4   # threads sending the direct presence queries
+QUERY_INTERVAL          = 2   # seconds between two stale user checks
+SAVE_INTERVAL           = 20  # seconds between two db saves
+RETRY_INTERVAL          = 2   # seconds to wait after a failed /pull
+PARAMETERS_TIMEOUT      = 10  # seconds a poll request waits for the decoder before it goes without new parameters
+STOP_CHECK_INTERVAL     = 1   # seconds between two checks of globals.RUN_PROGRAM
+EVENT_MESSAGES          = "messages" # the "ms" list of a /pull response or frame
+EVENT_PRESENCE          = "presence" # (uid, presence data or None) of a direct query
+STOP                    = None # ends the stage reading it
+
+class StageQueue:
+	# bounded queue in front of a stage: put() waits while the stage is behind, so a
+	# slow stage holds back the ones feeding it instead of piling up memory.
+	# the depth, the deepest it got and the time the producers waited are kept as metrics
+
+	def __init__(self, stage: str, maxSize: int, metrics: MetricsRegistry):
+		self.stage = stage
+		self.queue = Queue(maxSize)
+		self.maxDepth = 0
+		self.blockedTime = metrics.counter(
+			"pipeline_blocked_seconds_total", "Time spent waiting for room in the queue of the stage", stage=stage
+		)
+		metrics.gauge("pipeline_queue_depth", "Items waiting for the stage", self.queue.qsize, stage=stage)
+		metrics.gauge("pipeline_queue_max_depth", "Most items that waited for the stage", lambda: self.maxDepth, stage=stage)
+
+	def put(self, item):
+		try:
+			self.queue.put_nowait(item)
+		except Full:
+			begin = perf_counter()
+			self.queue.put(item)
+			self.blockedTime.inc(perf_counter() - begin)
+		self.maxDepth = max(self.maxDepth, self.queue.qsize())
+
+	def offer(self, item) -> bool:
+		# False instead of waiting when the queue is full
+		try:
+			self.queue.put_nowait(item)
+		except Full:
+			return False
+		self.maxDepth = max(self.maxDepth, self.queue.qsize())
+		return True
+
+	def get(self, timeout: float = None):
+		# raises Empty after the timeout
+		return self.queue.get(timeout=timeout)
+
+	def stats(self) -> Dict:
+		return {
+			"depth": self.queue.qsize(),
+			"maxDepth": self.maxDepth,
+			"blockedSeconds": self.blockedTime.value
+		}
+
+class PresencePipeline:
+	# the monitor cycle split into stages on their own threads, connected by bounded queues:
+	# fetcher (/pull requests or the stream) -> decoder (json, sticky/seq parameters) ->
+	# state machine -> persister (journal appends). the direct presence queries go to a
+	# few query workers and come back to the state machine. the state machine thread is
+	# the only one touching the db, intervals change exactly like in the single threaded
+	# loop; the feed parameters belong to the fetcher and the decoder. a poll request
+	# waits for the decoder to apply the sticky and seq of the previous response, the
+	# protocol needs them, but never for the state machine or the disk
+
+	def __init__(self, pm: PresenceMonitor, queueSize: int = None, queryWorkers: int = None):
+		if queueSize is None:
+			queueSize = int(pm.secrets.get("pipeline_queue_size", DEFAULT_QUEUE_SIZE))
+		if queryWorkers is None:
+			queryWorkers = int(pm.secrets.get("query_concurrency", DEFAULT_QUERY_WORKERS))
+		self.pm = pm
+		self.queryWorkers = queryWorkers
+		self.decodeQueue = StageQueue("decode", queueSize, pm.metrics)
+		self.stateQueue = StageQueue("state", queueSize, pm.metrics)
+		self.queryQueue = StageQueue("query", queueSize, pm.metrics)
+		self.persistQueue = StageQueue("persist", queueSize, pm.metrics)
+		# poll mode: set when the decoder applied the parameters of the last response
+		self.parametersApplied = Event()
+		# stream mode: set by the decoder when the connection has to be replaced
+		self.reconnect = Event()
+		# uids with a direct query on its way, only the state machine uses it
+		self.inFlight = set()
+		self.running = False
+		self.threads = [] # type: List[Thread]
+
+	def stats(self) -> Dict[str, Dict]:
+		return {queue.stage: queue.stats() for queue in [self.decodeQueue, self.stateQueue, self.queryQueue, self.persistQueue]}
+
+	def fetchLoop(self):
+		pm = self.pm
+		while self.running:
+			if pm.isStreaming():
+				if self.reconnect.is_set():
+					self.reconnect.clear()
+					pm.streamReconnects.inc()
+					pm.closeFeedStream()
+				raw = pm.nextRawFrame()
+			else:
+				self.parametersApplied.clear()
+				raw = pm.fetchFeedResponse()
+			if raw is None:
+				pm.resetParameters()
+				sleep(RETRY_INTERVAL)
+				continue
+			self.decodeQueue.put(raw)
+			if not pm.isStreaming():
+				# the next request carries the sticky token and seq of this response,
+				# a stalled decoder only costs the parameters, not the polling
+				if not self.parametersApplied.wait(PARAMETERS_TIMEOUT):
+					Log(ErrorLevel.warning, "decoder didn't answer in {}s, polling without new parameters", PARAMETERS_TIMEOUT)
+					pm.resetParameters()
+
+	def decodeLoop(self):
+		pm = self.pm
+		while True:
+			raw = self.decodeQueue.get()
+			try:
+				if pm.isStreaming():
+					responseObj = pm.decodeFeedFrame(raw)
+					if responseObj is not None and pm.applyFeedParameters(responseObj):
+						self.reconnect.set()
+				else:
+					responseObj = pm.decodeFeedResponse(raw)
+					if responseObj is None:
+						pm.resetParameters()
+					else:
+						pm.handleFeedParameters(responseObj)
+			except:
+				Log(ErrorLevel.warning, "{}", format_exc())
+				responseObj = None
+				if pm.isStreaming():
+					self.reconnect.set()
+				else:
+					pm.resetParameters()
+			finally:
+				# the fetcher never waits for a decoder that gave up on the response
+				self.parametersApplied.set()
+			if responseObj is not None and "ms" in responseObj:
+				self.stateQueue.put((EVENT_MESSAGES, responseObj["ms"]))
+
+	def queryLoop(self):
+		pm = self.pm
+		while True:
+			uid = self.queryQueue.get()
+			try:
+				presenceData = pm.queryManager.getPresence(uid)
+				pm.presenceQueries.inc()
+			except:
+				Log(ErrorLevel.warning, "presence query of {} failed: {}", uid, format_exc())
+				presenceData = None
+			self.stateQueue.put((EVENT_PRESENCE, uid, presenceData))
+
+	def stateLoop(self):
+		pm = self.pm
+		try:
+			# the first /pull is already out while the db loads
+			pm.waitForDatabase()
+		except DatabaseLoadError:
+			# nothing to keep the state in, the pipeline stops like the other engines
+			Log(ErrorLevel.error, "state stage stopped: {}", format_exc())
+			globals.RUN_PROGRAM = False
+			self.persistQueue.put(STOP)
+			return
+		nextQuery = nextSave = perf_counter()
+		while self.running:
+			try:
+				event = self.stateQueue.get(timeout=QUERY_INTERVAL)
+			except Empty:
+				event = None
+			try:
+				if event is not None:
+					self.handleEvent(event)
+				now = perf_counter()
+				if now >= nextQuery:
+					nextQuery = now + QUERY_INTERVAL
+					self.scheduleQueries()
+					pm.resolveProfiles()
+				if now >= nextSave:
+					nextSave = now + SAVE_INTERVAL
+					self.persistQueue.put(pm.takePendingRecords())
+					pm.applyRetentionIfDue()
+			except:
+				Log(ErrorLevel.warning, "{}", format_exc())
+		self.persistQueue.put(STOP)
+
+	def handleEvent(self, event: Tuple):
+		if event[0] == EVENT_MESSAGES:
+			self.pm.processMessageContent(event[1])
+		elif event[0] == EVENT_PRESENCE:
+			_, uid, presenceData = event
+			self.inFlight.discard(uid)
+			if presenceData is not None:
+				self.pm.applyQueriedPresence(uid, presenceData)
+
+	def scheduleQueries(self):
+		pm = self.pm
+		for uid in pm.getStaleUsers():
+			if uid in self.inFlight:
+				continue
+			if self.queryQueue.offer(uid):
+				self.inFlight.add(uid)
+			else:
+				# the workers are behind, ask again later
+				pm.staleScheduler.confirmed(uid, pm.epochClock())
+
+	def persistLoop(self):
+		pm = self.pm
+		while True:
+			records = self.persistQueue.get()
+			if records is STOP:
+				return
+			try:
+				pm.saveRecords(records)
+			except:
+				Log(ErrorLevel.warning, "{}", format_exc())
+
+	def start(self):
+		self.running = True
+		targets = [("fetcher", self.fetchLoop), ("decoder", self.decodeLoop), ("state", self.stateLoop), ("persister", self.persistLoop)]
+		targets += [("query-{}".format(worker), self.queryLoop) for worker in range(self.queryWorkers)]
+		for name, target in targets:
+			thread = Thread(target=target, name="pipeline-" + name, daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+	def stop(self):
+		# waits for the state machine and the persister, the network stages are left
+		# behind with their pending requests, the final save doesn't need them
+		self.running = False
+		for thread in self.threads:
+			if thread.name in ("pipeline-state", "pipeline-persister"):
+				thread.join()
+		Log(ErrorLevel.info, "pipeline stopped: {}", self.stats())
+		self.pm.saveAll()
+
+	def run(self):
+		self.start()
+		while globals.RUN_PROGRAM:
+			sleep(STOP_CHECK_INTERVAL)
+		self.stop()
+
+def StartPresencePipeline(pm: PresenceMonitor):
+	PresencePipeline(pm).run()
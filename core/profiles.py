@@ -0,0 +1,99 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple
+from traceback import format_exc
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from core.utils import Log, ErrorLevel
+from core.userinfo import UserQueryManager, PROFILE_CHUNK_SIZE
+from core.transport import HttpTransport
+from core.avatars import AvatarCache
+from core.metrics import MetricsRegistry
+
+DEFAULT_AVATAR_WORKERS = 4 # parallel avatar downloads
+
+class ProfileResolver:
+	# resolves the name and avatar of newly seen users in the background:
+	# uids collected during a feed cycle go out in a few bulk user_info requests,
+	# the avatars are downloaded by a worker pool into the avatar cache, only when
+	# the thumbnail url changed. the results are handed back through takeResolved()
+	# as (uid, fullname, thumbnailURL, avatar key or None if unchanged/failed)
+	# so only the monitor thread writes the db
+
+	def __init__(
+		self, queryManager: UserQueryManager, transport: HttpTransport, avatarCache: AvatarCache,
+		avatarWorkers: int = DEFAULT_AVATAR_WORKERS, chunkSize: int = PROFILE_CHUNK_SIZE,
+		metrics: MetricsRegistry = None
+	):
+		self.queryManager = queryManager
+		self.transport = transport
+		self.avatarCache = avatarCache
+		self.chunkSize = chunkSize
+		# a single lookup thread keeps the bulk requests in order, avatars go in parallel
+		self.lookupExecutor = ThreadPoolExecutor(max_workers=1)
+		self.avatarExecutor = ThreadPoolExecutor(max_workers=avatarWorkers)
+		self.resolved = [] # type: List[Tuple[str, str, str, str]]
+		self.lock = Lock()
+		metrics = metrics or MetricsRegistry()
+		self.lookupTime = metrics.histogram("profile_lookup_seconds", "Bulk user_info request of a batch")
+		self.lookups = metrics.counter("profile_lookups_total", "Profiles requested")
+		self.lookupErrors = metrics.counter("profile_lookup_errors_total", "Failed bulk user_info requests")
+		self.avatarTime = metrics.histogram("avatar_fetch_seconds", "Download and store of an avatar")
+		self.avatarErrors = metrics.counter("avatar_fetch_errors_total", "Failed avatar downloads")
+
+	def fetchAvatar(self, thumbnailURL: str) -> str:
+		# download image, save it to the cache and return its key
+		if thumbnailURL is None:
+			return None
+		with self.avatarTime.time():
+			return self.avatarCache.store(self.transport.get(thumbnailURL).content)
+
+	def fetchOne(self, uid: str) -> Tuple[str, str, str]:
+		userInfo = self.queryManager.getUserInfo(uid)
+		return userInfo["fullname"], userInfo["thumbnailURL"], self.fetchAvatar(userInfo["thumbnailURL"])
+
+	def request(self, uids: List[str], knownThumbnails: Dict[str, str] = None):
+		if len(uids) != 0:
+			self.lookupExecutor.submit(self.lookupBatch, list(uids), knownThumbnails or {})
+
+	def lookupBatch(self, uids: List[str], knownThumbnails: Dict[str, str]):
+		Log(ErrorLevel.info, "resolving {} profiles", len(uids))
+		self.lookups.inc(len(uids))
+		try:
+			with self.lookupTime.time():
+				userInfos = self.queryManager.getAllUserInfo(uids, self.chunkSize)
+		except:
+			self.lookupErrors.inc()
+			Log(ErrorLevel.warning, "profile lookup failed: {}", format_exc())
+			return
+		for uid in uids:
+			if uid not in userInfos:
+				Log(ErrorLevel.warning, "no profile returned for {}", uid)
+				continue
+			userInfo = userInfos[uid]
+			if userInfo["thumbnailURL"] == knownThumbnails.get(uid):
+				# same picture as before, nothing to download
+				with self.lock:
+					self.resolved.append((uid, userInfo["fullname"], userInfo["thumbnailURL"], None))
+				continue
+			self.avatarExecutor.submit(self.downloadAvatar, uid, userInfo)
+
+	def downloadAvatar(self, uid: str, userInfo: dict):
+		try:
+			avatarKey = self.fetchAvatar(userInfo["thumbnailURL"])
+		except:
+			self.avatarErrors.inc()
+			Log(ErrorLevel.warning, "avatar download of {} failed: {}", uid, format_exc())
+			avatarKey = None
+		with self.lock:
+			self.resolved.append((uid, userInfo["fullname"], userInfo["thumbnailURL"], avatarKey))
+
+	def takeResolved(self) -> List[Tuple[str, str, str, str]]:
+		with self.lock:
+			resolved, self.resolved = self.resolved, []
+		return resolved
+
+	def shutdown(self):
+		self.lookupExecutor.shutdown(wait=False)
+		self.avatarExecutor.shutdown(wait=False)
@@ -0,0 +1,172 @@
+# coding=utf-8
+
+from typing import Dict, Iterator, List
+from os import path
+from time import time, perf_counter
+from random import Random
+import json
+
+from core.monitor import PresenceMonitor
+from core.decoders import JSON_PAYLOAD_PREFIX
+
+OFFLINE_CONFIG  = "uid=0\ncookie=\nclient_id=0\nuseragent=offline\nbus_port=0\nmetrics_port=0\n"
+OWN_UID         = "0"
+
+class OfflineQueryManager:
+	# stands in for UserQueryManager so nothing touches the network
+
+	def getUserInfo(self, uid: str) -> Dict:
+		return {"fullname": uid, "thumbnailURL": None}
+
+	def getAllUserInfo(self, uidList: list, chunkSize: int = None) -> Dict:
+		return {uid: self.getUserInfo(uid) for uid in uidList}
+
+	def getPresence(self, uid: str) -> Dict:
+		return {"isOnline": None}
+
+def CreateOfflineMonitor(workDir: str) -> PresenceMonitor:
+	configPath = path.join(workDir, "offline.conf")
+	with open(configPath, 'w') as configFile:
+		configFile.write(OFFLINE_CONFIG)
+	return PresenceMonitor(configPath, path.join(workDir, "database.json"), OfflineQueryManager())
+
+class FeedRecorder:
+	# raw /pull responses, one json object per line: {"t": capture time, "raw": response text}
+
+	def __init__(self, recordPath: str):
+		self.recordFile = open(recordPath, 'a')
+
+	def record(self, rawResponse: str):
+		self.recordFile.write(json.dumps({"t": time(), "raw": rawResponse}) + "\n")
+		self.recordFile.flush()
+
+	def close(self):
+		self.recordFile.close()
+
+def ReadRecording(recordPath: str) -> Iterator[Dict]:
+	with open(recordPath, 'r') as recordFile:
+		for line in recordFile:
+			if line.strip():
+				yield json.loads(line)
+
+def CountPresences(msItem: Dict) -> int:
+	# presence updates carried by one message
+	if msItem.get("type") == "chatproxy-presence":
+		return len(msItem.get("buddyList", {}))
+	if msItem.get("type") == "buddylist_overlay":
+		return len(msItem.get("overlay", {}))
+	return 1
+
+class ReplayStats:
+
+	def __init__(self):
+		self.payloads = 0
+		self.messages = 0
+		self.presences = 0
+		self.decodeTime = 0.0
+		self.processTime = 0.0
+		self.typeLatencies = {} # type: Dict[str, List[float]]
+
+	def addLatency(self, itemType: str, seconds: float):
+		if itemType not in self.typeLatencies:
+			self.typeLatencies[itemType] = []
+		self.typeLatencies[itemType].append(seconds)
+
+class ReplayDriver:
+	# feeds recorded (or synthetic) /pull payloads into a monitor as fast as it can,
+	# the monitor's clocks follow the capture times instead of the wall clock
+
+	def __init__(self, pm: PresenceMonitor):
+		self.pm = pm
+		self.captureTime = time()
+		pm.epochClock = lambda: self.captureTime
+		pm.clock = lambda: int(self.captureTime)
+
+	def replay(self, recording: Iterator[Dict]) -> ReplayStats:
+		stats = ReplayStats()
+		for entry in recording:
+			self.captureTime = entry["t"]
+			# the monitor gets the bytes of the response, like from the socket
+			rawResponse = entry["raw"].encode('utf-8')
+			begin = perf_counter()
+			responseObj = self.pm.parseFeedResponse(rawResponse)
+			stats.decodeTime += perf_counter() - begin
+			stats.payloads += 1
+			if responseObj is None:
+				continue
+			# same steps as handleFeedResponse, but every message is timed by type
+			self.pm.handleFeedParameters(responseObj)
+			for msItem in responseObj.get("ms", []):
+				begin = perf_counter()
+				self.pm.processMessageContent([msItem])
+				elapsed = perf_counter() - begin
+				stats.processTime += elapsed
+				stats.messages += 1
+				stats.presences += CountPresences(msItem)
+				stats.addLatency(msItem.get("type"), elapsed)
+			self.pm.resolveProfiles()
+		return stats
+
+class SyntheticFeed:
+	# /pull payloads shaped like facebook's: a full buddy list first, then
+	# overlay updates, typing, messages and the odd full list again
+
+	def __init__(self, buddyCount: int, seed: int = 0, startTime: float = None):
+		self.random = Random(seed)
+		self.uids = [str(100000000000000 + i) for i in range(buddyCount)]
+		self.now = startTime if startTime is not None else time()
+		self.seq = 0
+
+	def buddyList(self) -> Dict:
+		buddies = {}
+		for uid in self.uids:
+			buddy = {"lat": int(self.now - self.random.randint(0, 600))}
+			if self.random.random() < 0.5:
+				buddy["p"] = self.random.randint(0, 2)
+			buddies[uid] = buddy
+		return {"type": "chatproxy-presence", "buddyList": buddies}
+
+	def overlay(self) -> Dict:
+		uid = self.random.choice(self.uids)
+		overlay = {uid: {"la": int(self.now - self.random.randint(0, 400)), "a": self.random.randint(0, 2)}}
+		return {"type": "buddylist_overlay", "overlay": overlay}
+
+	def typing(self) -> Dict:
+		uid = self.random.choice(self.uids)
+		return {"type": "typ", "u": OWN_UID, "ms": [{"type": "typ", "from": uid, "from_mobile": False}]}
+
+	def delta(self) -> Dict:
+		uid = self.random.choice(self.uids)
+		return {"type": "delta", "delta": {"threadKey": {"otherUserFbId": uid}, "body": "x" * 40}}
+
+	def phone(self) -> Dict:
+		return {"type": "t_tp", "from": self.random.choice(self.uids)}
+
+	def inbox(self) -> Dict:
+		return {"type": "inbox", "unseen": self.random.randint(0, 9), "unread": 0, "seen_timestamp": int(self.now * 1000)}
+
+	def message(self) -> Dict:
+		roll = self.random.random()
+		if roll < 0.02:
+			return self.buddyList()
+		if roll < 0.70:
+			return self.overlay()
+		if roll < 0.80:
+			return self.typing()
+		if roll < 0.90:
+			return self.delta()
+		if roll < 0.95:
+			return self.phone()
+		return self.inbox()
+
+	def payload(self, messages: List[Dict]) -> Dict:
+		self.seq += 1
+		responseObj = {"t": "msg", "seq": self.seq, "ms": messages}
+		return {"t": self.now, "raw": JSON_PAYLOAD_PREFIX + json.dumps(responseObj)}
+
+	def generate(self, payloadCount: int, messagesPerPayload: int = 5) -> List[Dict]:
+		payloads = [self.payload([self.buddyList()])]
+		for _ in range(payloadCount - 1):
+			self.now += self.random.uniform(0.5, 5)
+			payloads.append(self.payload([self.message() for _ in range(messagesPerPayload)]))
+		return payloads
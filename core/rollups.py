@@ -0,0 +1,120 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple
+
+from core.intervals import IntervalList, STATES
+from core.storage import RECORD_INTERVAL
+
+# name -> (bucket length, gaps shorter than this are filled in the merged interval list)
+RESOLUTIONS = {
+	"hour": (60 * 60, 60),
+	"day": (24 * 60 * 60, 30 * 60)
+}
+RESOLUTION_ORDER = ["hour", "day"] # finest first
+RAW_RESOLUTION   = "raw"
+
+# fields of a bucket
+BUCKET_SECONDS  = 0 # time spent in the state
+BUCKET_SESSIONS = 1 # intervals started in the bucket
+BUCKET_FIRST    = 2 # first moment seen in the state
+BUCKET_LAST     = 3 # last moment seen in the state
+
+def PickResolution(seconds: int, width: int) -> Tuple[str, int]:
+	# the coarsest rollup whose merged intervals are still finer than a pixel,
+	# returned with the length of a pixel in seconds
+	pixel = max(1, seconds // max(1, width))
+	resolution = RAW_RESOLUTION
+	for name in RESOLUTION_ORDER:
+		if RESOLUTIONS[name][1] <= pixel:
+			resolution = name
+	return resolution, pixel
+
+class UserRollup:
+	# rollups of one (uid, state) at one resolution
+	__slots__ = ("buckets", "merged")
+
+	def __init__(self):
+		self.buckets = {} # type: Dict[int, List[int]]
+		self.merged = IntervalList()
+
+class Rollups:
+	# hourly and daily statistics per (uid, state) plus the interval lists with the short
+	# gaps filled, so a long range can be drawn without sending every 3 minute flicker.
+	# only closed intervals count: fed the same journal records as the db, an interval
+	# is added when it is closed, a record older than the last one of its (uid, state)
+	# was applied already
+
+	def __init__(self):
+		self.rollups = {name: {} for name in RESOLUTIONS} # type: Dict[str, Dict[Tuple[str, str], UserRollup]]
+		self.lastStarts = {} # type: Dict[Tuple[str, str], int]
+
+	@staticmethod
+	def fromDatabase(db: Dict) -> 'Rollups':
+		rollups = Rollups()
+		for uid in db:
+			for state in STATES:
+				for start, end in db[uid][state]:
+					if end is not None:
+						rollups.add(uid, state, start, end)
+		return rollups
+
+	def applyRecord(self, record: List):
+		if record[0] == RECORD_INTERVAL:
+			self.add(record[1], record[2], record[3], record[4])
+
+	def add(self, uid: str, state: str, start: int, end: int):
+		key = (uid, state)
+		if key in self.lastStarts and self.lastStarts[key] >= start:
+			return
+		self.lastStarts[key] = start
+		for name, (bucketLength, gap) in RESOLUTIONS.items():
+			rollup = self.rollups[name].get(key)
+			if rollup is None:
+				rollup = self.rollups[name][key] = UserRollup()
+			merged = rollup.merged
+			if len(merged) != 0 and start - merged[-1][1] < gap:
+				merged.closeLast(max(merged[-1][1], end))
+			else:
+				merged.append(start, end)
+			bucketStart = start - start % bucketLength
+			while True:
+				bucketEnd = bucketStart + bucketLength
+				first, last = max(start, bucketStart), min(end, bucketEnd)
+				bucket = rollup.buckets.get(bucketStart)
+				if bucket is None:
+					bucket = rollup.buckets[bucketStart] = [0, 0, first, last]
+				bucket[BUCKET_SECONDS] += last - first
+				bucket[BUCKET_SESSIONS] += int(bucketStart <= start)
+				bucket[BUCKET_FIRST] = min(bucket[BUCKET_FIRST], first)
+				bucket[BUCKET_LAST] = max(bucket[BUCKET_LAST], last)
+				if bucketEnd >= end:
+					break
+				bucketStart = bucketEnd
+
+	def dropBefore(self, timeStamp: int):
+		# follows core.archive.DropExpired on the db: the merged intervals that ended before
+		# timeStamp and the buckets that ended by then are removed
+		for name, (bucketLength, gap) in RESOLUTIONS.items():
+			rollups = self.rollups[name]
+			for key in list(rollups):
+				rollup = rollups[key]
+				rollup.merged.dropBefore(timeStamp)
+				for bucketStart in [bucketStart for bucketStart in rollup.buckets if bucketStart + bucketLength <= timeStamp]:
+					del rollup.buckets[bucketStart]
+				if len(rollup.merged) == 0 and len(rollup.buckets) == 0:
+					del rollups[key]
+
+	def merged(self, resolution: str, uid: str, state: str) -> IntervalList:
+		rollup = self.rollups[resolution].get((uid, state))
+		return rollup.merged if rollup is not None else IntervalList()
+
+	def buckets(self, resolution: str, uid: str, state: str, fromTs: int = None, toTs: int = None) -> List[List[int]]:
+		# [bucket start, seconds, sessions, first seen, last seen] of the buckets in [fromTs, toTs], in time order
+		rollup = self.rollups[resolution].get((uid, state))
+		if rollup is None:
+			return []
+		bucketLength = RESOLUTIONS[resolution][0]
+		return [
+			[bucketStart] + bucket for bucketStart, bucket in sorted(rollup.buckets.items())
+			if (fromTs is None or bucketStart + bucketLength > fromTs) and (toTs is None or bucketStart <= toTs)
+		]
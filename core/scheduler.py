@@ -0,0 +1,89 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple
+import heapq
+
+DEFAULT_STALE_AFTER     = 3 * 60  # seconds an online interval can stay open before it is checked
+DEFAULT_MIN_INTERVAL    = 30      # seconds, shortest gap between two checks of the same user
+DEFAULT_MAX_INTERVAL    = 30 * 60 # seconds, longest gap between two checks of the same user
+DEFAULT_QUERY_RATE      = 1.0     # direct presence queries per second
+DEFAULT_QUERY_BURST     = 10      # queries that can go out at once after a quiet period
+
+class StaleScheduler:
+	# decides which online users get a direct presence query and when.
+	# every user with an open online interval has a due time in a heap: first when the
+	# interval becomes stale, after that every `interval` seconds. the interval doubles
+	# each time a query finds the user unchanged and halves each time the user's state
+	# changes, so flapping users are checked often and idle tabs rarely. takeDue() only
+	# looks at the due end of the heap and hands out at most queryRate users per second
+
+	def __init__(
+		self, staleAfter: float = DEFAULT_STALE_AFTER,
+		minInterval: float = DEFAULT_MIN_INTERVAL, maxInterval: float = DEFAULT_MAX_INTERVAL,
+		queryRate: float = DEFAULT_QUERY_RATE, queryBurst: int = DEFAULT_QUERY_BURST
+	):
+		self.staleAfter = staleAfter
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.queryRate = queryRate
+		self.queryBurst = queryBurst
+		# (due, uid), entries whose due doesn't match dueAt are outdated and skipped
+		self.heap = [] # type: List[Tuple[float, str]]
+		self.dueAt = {} # type: Dict[str, float]
+		self.intervals = {} # type: Dict[str, float]
+		self.tokens = float(queryBurst)
+		self.tokensAt = None # type: float
+
+	def __len__(self) -> int:
+		return len(self.dueAt)
+
+	def __contains__(self, uid: str) -> bool:
+		return uid in self.dueAt
+
+	def interval(self, uid: str) -> float:
+		return self.intervals.get(uid, self.staleAfter)
+
+	def schedule(self, uid: str, due: float):
+		self.dueAt[uid] = due
+		heapq.heappush(self.heap, (due, uid))
+		if len(self.heap) > 2 * len(self.dueAt) + 64:
+			# too many outdated entries, rebuild from the live ones
+			self.heap = [(due, uid) for uid, due in self.dueAt.items()]
+			heapq.heapify(self.heap)
+
+	def opened(self, uid: str, start: float):
+		# the user came online: check it once the interval becomes stale
+		if uid in self.intervals:
+			self.intervals[uid] = max(self.minInterval, self.intervals[uid] / 2)
+		self.schedule(uid, start + self.staleAfter)
+
+	def closed(self, uid: str):
+		# nothing to check while the user is offline, the heap entry is skipped later
+		self.dueAt.pop(uid, None)
+
+	def confirmed(self, uid: str, now: float):
+		# a query found the user still online, back off
+		if uid not in self.dueAt:
+			return
+		self.intervals[uid] = min(self.maxInterval, self.interval(uid) * 2)
+		self.schedule(uid, now + self.intervals[uid])
+
+	def refill(self, now: float):
+		if self.tokensAt is not None:
+			self.tokens = min(float(self.queryBurst), self.tokens + (now - self.tokensAt) * self.queryRate)
+		self.tokensAt = now
+
+	def takeDue(self, now: float) -> List[str]:
+		# due users within the rate limit, the rest stay in the heap for the next call.
+		# every taken user is already rescheduled one interval later, so a query that
+		# fails or never answers is simply retried
+		self.refill(now)
+		due = []
+		while len(self.heap) != 0 and self.heap[0][0] <= now and self.tokens >= 1:
+			dueTime, uid = heapq.heappop(self.heap)
+			if self.dueAt.get(uid) != dueTime:
+				continue
+			self.tokens -= 1
+			due.append(uid)
+			self.schedule(uid, now + self.interval(uid))
+		return due
@@ -0,0 +1,65 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple
+
+# imported on first use: loading it takes longer than the whole monitor up to the first /pull
+numpy = None
+isNumpyChecked = False
+
+ACTIVE_UNKNOWN  = -1 # no active field in the message
+ACTIVE_OFF      = 0
+ACTIVE_ON       = 1
+NUMPY_MIN_BATCH = 64 # smaller messages (an overlay is mostly one buddy) are faster without the array conversions
+
+def LoadNumpy():
+	# None if numpy is not installed, it is optional: the pure python path gives the same result
+	global numpy, isNumpyChecked
+	if not isNumpyChecked:
+		try:
+			import numpy as numpyModule
+			numpy = numpyModule
+		except ImportError:
+			numpy = None
+		isNumpyChecked = True
+	return numpy
+
+def ExtractStatuses(entries: Dict[str, Dict], lastActiveKey: str, activeKey: str) -> Tuple[List[str], List[int], List[int]]:
+	# the uids of a buddy list/overlay message with their last active time and active
+	# field (ACTIVE_UNKNOWN if missing) in parallel lists, entries without a last active time are skipped
+	uids = []
+	lastActive = []
+	active = []
+	for uid, entry in entries.items():
+		if lastActiveKey in entry:
+			uids.append(uid)
+			lastActive.append(entry[lastActiveKey])
+			active.append(entry.get(activeKey, ACTIVE_UNKNOWN))
+	return uids, lastActive, active
+
+def EvaluateStatuses(
+	lastActive: List[int], active: List[int], cutoff: float, useNumpy: bool = None
+) -> Tuple[List[bool], List[bool]]:
+	# online/active flags of a whole message against one cutoff (last active before it is offline)
+	# active is None where the message doesn't tell and the user is online
+	if useNumpy is None:
+		useNumpy = len(lastActive) >= NUMPY_MIN_BATCH and LoadNumpy() is not None
+	elif useNumpy:
+		LoadNumpy()
+	if useNumpy:
+		lastActiveArray = numpy.asarray(lastActive, dtype=numpy.int64)
+		activeArray = numpy.asarray(active, dtype=numpy.int64)
+		onlineArray = lastActiveArray >= cutoff
+		activeFlags = numpy.where(
+			activeArray == ACTIVE_UNKNOWN,
+			numpy.where(onlineArray, ACTIVE_UNKNOWN, ACTIVE_OFF),
+			(activeArray != ACTIVE_OFF) & onlineArray
+		)
+		online = onlineArray.tolist()
+		activeFlags = activeFlags.tolist()
+	else:
+		online = [value >= cutoff for value in lastActive]
+		activeFlags = [
+			(ACTIVE_UNKNOWN if isOnline else ACTIVE_OFF) if value == ACTIVE_UNKNOWN else int(value != ACTIVE_OFF and isOnline)
+			for value, isOnline in zip(active, online)
+		]
+	return online, [None if value == ACTIVE_UNKNOWN else value == ACTIVE_ON for value in activeFlags]
@@ -0,0 +1,330 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple, Iterator
+from os.path import exists, dirname, abspath
+from os import fsync, remove, replace
+from threading import Thread, Lock
+import json
+import re
+
+from core.utils import Log, ErrorLevel, GetTimeStamp
+from core.intervals import UserRecord, EncodeRecord
+from core.archive import RetentionPolicy, ArchiveIntervals, DropExpired, SyncDirectory
+
+JOURNAL_SUFFIX          = ".journal"
+COMPACTING_SUFFIX       = ".journal.compacting"
+SNAPSHOT_TMP_SUFFIX     = ".tmp"
+VERSION_SUFFIX          = ".version"
+COMPACT_THRESHOLD       = 4 * 1024 * 1024 # journal size (bytes) that triggers a background compaction
+DB_DEFAULT_STRUCTURE    = {}
+WHITESPACE              = re.compile(r"[ \t\n\r]*")
+SNAPSHOT_DECODER        = json.JSONDecoder()
+SNAPSHOT_CHUNK_SIZE     = 1024 * 1024 # characters ReadSnapshotUsers reads at once
+
+# journal records are json arrays, one per line, the last item is the version of the change:
+#   ["user", uid, fullname, image, thumbnail, version]
+#   ["open", uid, state, start, version]
+#   ["interval", uid, state, start, end, version]  closes the open interval or adds a closed one
+#   ["drop", uid, state, start, version]           removes an open interval that was never closed
+RECORD_USER             = "user"
+RECORD_OPEN             = "open"
+RECORD_INTERVAL         = "interval"
+RECORD_DROP             = "drop"
+# records written before versioning don't have the last item
+RECORD_VERSION_INDEX    = {
+	RECORD_USER: 5,
+	RECORD_OPEN: 4,
+	RECORD_INTERVAL: 5,
+	RECORD_DROP: 4
+}
+
+def CreateUserRecord() -> UserRecord:
+	return UserRecord()
+
+def RecordVersion(record: List) -> int:
+	versionIndex = RECORD_VERSION_INDEX.get(record[0])
+	if versionIndex is None or len(record) <= versionIndex:
+		return 0
+	return record[versionIndex]
+
+def ApplyRecord(db: Dict, record: List) -> int:
+	# returns the version of the record
+	# intervals of one (uid, state) are journaled in time order so anything
+	# not newer than the last one was already applied (replay after a crash)
+	recordType, uid = record[0], record[1]
+	if uid not in db:
+		db[uid] = CreateUserRecord()
+	if recordType == RECORD_USER:
+		db[uid]["fullname"] = record[2]
+		db[uid]["image"] = record[3]
+		# records written before the avatar cache have no thumbnail url
+		db[uid]["thumbnail"] = record[4] if len(record) > 4 else None
+	elif recordType == RECORD_OPEN:
+		state, start = record[2], record[3]
+		intervals = db[uid][state]
+		if len(intervals) == 0 or intervals.lastStart() < start:
+			intervals.appendOpen(start)
+	elif recordType == RECORD_INTERVAL:
+		state, start, end = record[2], record[3], record[4]
+		intervals = db[uid][state]
+		if len(intervals) == 0 or intervals.lastStart() < start:
+			intervals.append(start, end)
+		elif intervals.lastStart() == start and intervals.isLastOpen():
+			intervals.closeLast(end)
+	elif recordType == RECORD_DROP:
+		state, start = record[2], record[3]
+		intervals = db[uid][state]
+		if intervals.isLastOpen() and intervals.lastStart() == start:
+			intervals.popOpen()
+	else:
+		Log(ErrorLevel.warning, "unknown journal record: {}", record)
+	return RecordVersion(record)
+
+def ParseRecordLine(line: bytes) -> List:
+	# None if the line is torn or corrupt
+	if not line.endswith(b"\n"):
+		return None
+	try:
+		return json.loads(line.decode('utf-8'))
+	except ValueError:
+		return None
+
+def ReplayJournal(db: Dict, journalPath: str) -> Tuple[int, int]:
+	# returns the offset of the last complete record so a torn write can be cut off
+	# and the highest version found in the journal
+	validOffset = 0
+	version = 0
+	if not exists(journalPath):
+		return validOffset, version
+	with open(journalPath, 'rb') as journalFile:
+		for line in journalFile:
+			record = ParseRecordLine(line)
+			if record is None:
+				Log(ErrorLevel.warning, "incomplete record at the end of {}, dropping it", journalPath)
+				break
+			version = max(version, ApplyRecord(db, record))
+			validOffset += len(line)
+	return validOffset, version
+
+def IterSnapshotUsers(content: str) -> Iterator[Tuple[str, Dict]]:
+	# (uid, user dict) pairs of the snapshot object, decoded one user at a time:
+	# a single json.loads would hold the interpreter lock for the whole file and
+	# stall the other threads (the first /pull while the db loads in the background)
+	position = WHITESPACE.match(content, 0).end()
+	if content[position] != "{":
+		raise ValueError("the snapshot is not a json object")
+	position = WHITESPACE.match(content, position + 1).end()
+	while content[position] != "}":
+		uid, position = SNAPSHOT_DECODER.raw_decode(content, position)
+		position = WHITESPACE.match(content, position).end()
+		if content[position] != ":":
+			raise ValueError("':' expected at {}".format(position))
+		position = WHITESPACE.match(content, position + 1).end()
+		user, position = SNAPSHOT_DECODER.raw_decode(content, position)
+		yield uid, user
+		position = WHITESPACE.match(content, position).end()
+		if content[position] == ",":
+			position = WHITESPACE.match(content, position + 1).end()
+
+class ChunkedSnapshot:
+	# the snapshot file read a chunk at a time, the decoded part is dropped when more is read
+
+	def __init__(self, snapshotFile, chunkSize: int):
+		self.file = snapshotFile
+		self.chunkSize = chunkSize
+		self.content = ""
+		self.position = 0
+
+	def readMore(self) -> bool:
+		# False at the end of the file. a value longer than the chunk doubles the next read,
+		# so decoding it again from its start stays linear
+		chunk = self.file.read(max(self.chunkSize, len(self.content) - self.position))
+		if chunk == "":
+			return False
+		self.content = self.content[self.position:] + chunk
+		self.position = 0
+		return True
+
+	def nextChar(self) -> str:
+		# the next character that is not whitespace, "" at the end of the file
+		while True:
+			self.position = WHITESPACE.match(self.content, self.position).end()
+			if self.position < len(self.content):
+				return self.content[self.position]
+			if not self.readMore():
+				return ""
+
+	def decode(self):
+		# the keys and users are strings and objects, once raw_decode gets one it is complete
+		while True:
+			try:
+				value, self.position = SNAPSHOT_DECODER.raw_decode(self.content, self.position)
+				return value
+			except ValueError:
+				if not self.readMore():
+					raise
+
+def ReadSnapshotUsers(snapshotPath: str, chunkSize: int = SNAPSHOT_CHUNK_SIZE) -> Iterator[Tuple[str, Dict]]:
+	# IterSnapshotUsers straight from the file: only the user being decoded and a chunk
+	# are in memory, never the whole snapshot (export.py)
+	if not exists(snapshotPath):
+		return
+	with open(snapshotPath, 'r') as snapshotFile:
+		snapshot = ChunkedSnapshot(snapshotFile, chunkSize)
+		if snapshot.nextChar() != "{":
+			raise ValueError("the snapshot is not a json object")
+		snapshot.position += 1
+		while snapshot.nextChar() != "}":
+			uid = snapshot.decode()
+			if snapshot.nextChar() != ":":
+				raise ValueError("':' expected after {}".format(uid))
+			snapshot.position += 1
+			snapshot.nextChar()
+			yield uid, snapshot.decode()
+			if snapshot.nextChar() == ",":
+				snapshot.position += 1
+
+def IterJournalRecords(journalPath: str) -> Iterator[List]:
+	# the records of a journal in order, a torn one at the end is left out
+	if not exists(journalPath):
+		return
+	with open(journalPath, 'rb') as journalFile:
+		for line in journalFile:
+			record = ParseRecordLine(line)
+			if record is None:
+				return
+			yield record
+
+def LoadSnapshot(snapshotPath: str) -> Dict:
+	if not exists(snapshotPath):
+		WriteFileAtomic(snapshotPath, json.dumps(DB_DEFAULT_STRUCTURE))
+	with open(snapshotPath, 'r') as snapshotFile:
+		content = snapshotFile.read()
+	return {uid: UserRecord.fromDict(user) for uid, user in IterSnapshotUsers(content)}
+
+def LoadSnapshotVersion(snapshotPath: str) -> int:
+	versionPath = snapshotPath + VERSION_SUFFIX
+	if not exists(versionPath):
+		return 0
+	with open(versionPath, 'r') as versionFile:
+		return int(versionFile.read().strip() or 0)
+
+def DumpDatabase(db: Dict) -> str:
+	return json.dumps(db, default=EncodeRecord)
+
+def WriteFileAtomic(path: str, content: str):
+	tmpPath = path + SNAPSHOT_TMP_SUFFIX
+	with open(tmpPath, 'w') as tmpFile:
+		tmpFile.write(content)
+		tmpFile.flush()
+		fsync(tmpFile.fileno())
+	replace(tmpPath, path)
+	# the rename is only durable once the directory entry is
+	SyncDirectory(dirname(abspath(path)))
+
+class JournalStorage:
+
+	def __init__(self, dbPath: str, compactThreshold: int = COMPACT_THRESHOLD, retention: RetentionPolicy = None):
+		self.snapshotPath = dbPath
+		self.journalPath = dbPath + JOURNAL_SUFFIX
+		self.compactingPath = dbPath + COMPACTING_SUFFIX
+		self.compactThreshold = compactThreshold
+		# old history is moved out of the snapshot into the archive when compacting
+		self.retention = retention if retention is not None else RetentionPolicy()
+		self.journalFile = None
+		self.compactThread = None # type: Thread
+		# held while a compaction is started, append() and the retention pass of the
+		# pipeline can get there from two threads at once
+		self.compactLock = Lock()
+		self.lock = Lock()
+		self.version = 0 # highest version on disk when loaded
+
+	def load(self) -> Dict:
+		db = LoadSnapshot(self.snapshotPath)
+		self.version = max(LoadSnapshotVersion(self.snapshotPath), ReplayJournal(db, self.compactingPath)[1])
+		validOffset, journalVersion = ReplayJournal(db, self.journalPath)
+		self.version = max(self.version, journalVersion)
+		self.openJournal(validOffset)
+		return db
+
+	def openJournal(self, validOffset: int = None):
+		if not exists(self.journalPath):
+			open(self.journalPath, 'wb').close()
+		self.journalFile = open(self.journalPath, 'r+b')
+		if validOffset is not None:
+			# cut off a record torn by a crash so new records don't get glued to it
+			self.journalFile.truncate(validOffset)
+		self.journalFile.seek(0, 2)
+
+	def append(self, records: List[List]) -> int:
+		# returns the number of bytes written
+		if len(records) == 0:
+			return 0
+		data = "".join([json.dumps(record) + "\n" for record in records]).encode('utf-8')
+		with self.lock:
+			journalSize = self.journalFile.tell()
+			try:
+				self.journalFile.write(data)
+				self.journalFile.flush()
+				fsync(self.journalFile.fileno())
+			except:
+				# a torn record would end the replay there and lose the ones appended after it
+				self.rollBack(journalSize)
+				raise
+			journalSize = self.journalFile.tell()
+		Log(ErrorLevel.debug, "{} records ({} bytes) appended to journal", len(records), len(data))
+		if journalSize >= self.compactThreshold:
+			self.compact()
+		return len(data)
+
+	def rollBack(self, offset: int):
+		# call with the lock held. drops what a failed append left after offset
+		try:
+			self.journalFile.close()
+		except OSError:
+			# the buffered rest of the failed write can't be flushed either
+			pass
+		self.journalFile = open(self.journalPath, 'r+b')
+		self.journalFile.truncate(offset)
+		self.journalFile.seek(0, 2)
+
+	def compact(self, wait: bool = False):
+		if not self.compactLock.acquire(blocking=wait):
+			# another thread is starting one right now
+			return
+		try:
+			if self.compactThread is not None and self.compactThread.is_alive():
+				if not wait:
+					return
+				self.compactThread.join()
+			if exists(self.compactingPath):
+				# a previous compaction did not finish, fold it into the snapshot first
+				self.mergeIntoSnapshot()
+			with self.lock:
+				self.journalFile.close()
+				replace(self.journalPath, self.compactingPath)
+				self.openJournal()
+			compactThread = self.compactThread = Thread(target=self.mergeIntoSnapshot, daemon=True)
+			compactThread.start()
+		finally:
+			self.compactLock.release()
+		if wait:
+			compactThread.join()
+
+	def mergeIntoSnapshot(self):
+		Log(ErrorLevel.info, "compacting journal into {}", self.snapshotPath)
+		db = LoadSnapshot(self.snapshotPath)
+		version = max(LoadSnapshotVersion(self.snapshotPath), ReplayJournal(db, self.compactingPath)[1])
+		if self.retention.isEnabled():
+			cutoff = self.retention.cutoff(GetTimeStamp())
+			ArchiveIntervals(self.snapshotPath, DropExpired(db, cutoff), cutoff, self.retention.mergeGap)
+		WriteFileAtomic(self.snapshotPath, DumpDatabase(db))
+		WriteFileAtomic(self.snapshotPath + VERSION_SUFFIX, str(version))
+		# the snapshot is durable now; replaying this journal again would be a no-op anyway
+		remove(self.compactingPath)
+
+	def close(self):
+		if self.compactThread is not None:
+			self.compactThread.join()
+		with self.lock:
+			self.journalFile.close()
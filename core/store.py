@@ -0,0 +1,422 @@
+# coding=utf-8
+
+from typing import Dict, List, Tuple, Iterator
+from os import stat, fstat
+from os.path import exists
+from bisect import bisect_right
+from threading import Lock
+from queue import Queue, Full
+import re
+
+from core.utils import Log, ErrorLevel, GetTimeStamp
+from core.storage import (
+	LoadSnapshot, LoadSnapshotVersion, ReplayJournal, ApplyRecord, ParseRecordLine, RecordVersion,
+	JOURNAL_SUFFIX, COMPACTING_SUFFIX, RECORD_USER, RECORD_INTERVAL
+)
+from core.intervals import STATES, MergeIntervals
+from core.index import PresenceIndex, CoPresence
+from core.rollups import Rollups, PickResolution, RAW_RESOLUTION
+from core.archive import ArchiveReader, DropExpired
+
+MAX_CHANGES             = 100000 # changes kept for /changes, clients further behind get a reset
+MAX_LIVE_RECORDS        = 10000  # out of order bus records waiting for the missing versions
+SUBSCRIPTION_QUEUE_SIZE = 10000  # changes buffered for one push client before it has to reset
+
+class ChangeSubscription:
+	# changes pushed to one streaming client
+
+	def __init__(self, maxSize: int = SUBSCRIPTION_QUEUE_SIZE):
+		self.queue = Queue(maxSize)
+		self.overflowed = False # the client missed changes and needs a new snapshot
+
+	def push(self, record: List):
+		try:
+			self.queue.put_nowait(record)
+		except Full:
+			self.overflowed = True
+
+def ChangeToDict(record: List) -> Dict:
+	recordType = record[0]
+	change = { "type": recordType, "uid": record[1], "version": RecordVersion(record) }
+	if recordType == RECORD_USER:
+		change["fullname"] = record[2]
+		change["image"] = record[3]
+	else:
+		change["state"] = record[2]
+		change["start"] = record[3]
+		if recordType == RECORD_INTERVAL:
+			change["end"] = record[4]
+	return change
+
+def ChangeOverlaps(record: List, fromTs: int, toTs: int) -> bool:
+	if record[0] == RECORD_USER:
+		return True
+	start = record[3]
+	end = record[4] if record[0] == RECORD_INTERVAL else None
+	return ((toTs is None) or (start <= toTs)) and ((fromTs is None) or (end is None) or (end >= fromTs))
+
+class PresenceStore:
+	# read side of the database for the web interface: the monitor's snapshot loaded
+	# into interval lists, then kept up to date by tailing the journal and by the
+	# records the monitor publishes on the bus. every record carries a version so
+	# clients can ask for the changes since the one they have
+
+	def __init__(self, dbPath: str, maxChanges: int = MAX_CHANGES):
+		self.dbPath = dbPath
+		self.journalPath = dbPath + JOURNAL_SUFFIX
+		self.maxChanges = maxChanges
+		self.db = None # type: Dict
+		self.version = 0
+		# goes up when the db changes without a new version: reloads and retention
+		self.generation = 0
+		self.changeVersions = [] # type: List[int]
+		self.changes = [] # type: List[List]
+		self.journalFile = None
+		self.pendingBytes = b""
+		self.liveRecords = {} # type: Dict[int, List]
+		# epoch of the publisher the live records came from (see core.bus)
+		self.publisherEpoch = None # type: str
+		self.subscriptions = [] # type: List[ChangeSubscription]
+		# built on the first index query, then updated with every change
+		self.index = None # type: PresenceIndex
+		self.rollups = None # type: Rollups
+		# history past the monitor's retention period, read when a query reaches back into it
+		self.archive = ArchiveReader(dbPath)
+		self.lock = Lock()
+
+	def load(self):
+		Log(ErrorLevel.info, "loading {}", self.dbPath)
+		if self.journalFile is not None:
+			self.journalFile.close()
+		# the journal is opened before the snapshot is read, records appended
+		# meanwhile are read by the tail and applying them twice is a no-op
+		self.journalFile = open(self.journalPath, 'rb') if exists(self.journalPath) else None
+		self.pendingBytes = b""
+		self.db = LoadSnapshot(self.dbPath)
+		self.generation += 1
+		self.version = max(LoadSnapshotVersion(self.dbPath), ReplayJournal(self.db, self.dbPath + COMPACTING_SUFFIX)[1])
+		self.changeVersions = []
+		self.changes = []
+		self.index = None
+		self.rollups = None
+		# streaming clients can't follow a reload
+		for subscription in self.subscriptions:
+			subscription.overflowed = True
+		self.tail(isReload=True)
+		self.applyRetention(isReload=True)
+
+	def readJournal(self, acceptGaps: bool = False) -> bool:
+		# applies the complete records appended since the last read
+		# returns False if versions are missing, i.e. a whole journal was compacted unseen.
+		# right after a reload a gap is on disk for good (an append that failed), it is skipped
+		if self.journalFile is None:
+			return True
+		data = self.pendingBytes + self.journalFile.read()
+		lines = data.split(b"\n")
+		self.pendingBytes = lines.pop()
+		for line in lines:
+			record = ParseRecordLine(line + b"\n")
+			if record is None:
+				Log(ErrorLevel.warning, "unreadable journal record: {}", line)
+				continue
+			version = RecordVersion(record)
+			if version > self.version + 1 and self.version != 0:
+				if not acceptGaps:
+					return False
+				Log(ErrorLevel.warning, "versions {} to {} are missing from {}", self.version + 1, version - 1, self.journalPath)
+			if version <= self.version and version != 0:
+				continue # already in the snapshot
+			self.applyChange(version, record)
+		return True
+
+	def applyChange(self, version: int, record: List):
+		ApplyRecord(self.db, record)
+		if self.index is not None:
+			self.index.applyRecord(record)
+		if self.rollups is not None:
+			self.rollups.applyRecord(record)
+		if version > self.version:
+			self.version = version
+			self.addChange(version, record)
+
+	def applyLive(self, record: List, epoch: str = None):
+		# records from the bus may arrive out of order or not at all, they are
+		# applied in version order and the journal fills the gaps
+		with self.lock:
+			if self.db is None:
+				return
+			if epoch != self.publisherEpoch:
+				if self.publisherEpoch is not None:
+					# the monitor was restarted: the records it published but never saved are
+					# gone and their versions are handed out again, only the disk is right
+					Log(ErrorLevel.info, "monitor restarted, reloading {}", self.dbPath)
+					self.liveRecords.clear()
+					self.load()
+				self.publisherEpoch = epoch
+			version = RecordVersion(record)
+			if version <= self.version:
+				return
+			if len(self.liveRecords) >= MAX_LIVE_RECORDS:
+				self.liveRecords.clear()
+			self.liveRecords[version] = record
+			self.applyLiveRecords()
+
+	def applyLiveRecords(self):
+		for version in [version for version in self.liveRecords if version <= self.version]:
+			del self.liveRecords[version]
+		while (self.version + 1) in self.liveRecords:
+			self.applyChange(self.version + 1, self.liveRecords.pop(self.version + 1))
+
+	def subscribe(self) -> ChangeSubscription:
+		subscription = ChangeSubscription()
+		with self.lock:
+			self.subscriptions.append(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription: ChangeSubscription):
+		with self.lock:
+			self.subscriptions.remove(subscription)
+
+	def addChange(self, version: int, record: List):
+		for subscription in self.subscriptions:
+			subscription.push(record)
+		self.changeVersions.append(version)
+		self.changes.append(record)
+		if len(self.changes) > self.maxChanges:
+			# trim in big steps so appending stays amortized O(1)
+			cut = len(self.changes) - self.maxChanges // 2
+			del self.changeVersions[:cut]
+			del self.changes[:cut]
+
+	def isJournalRotated(self) -> bool:
+		if not exists(self.journalPath):
+			# between the rename and the creation of the new journal
+			return False
+		if self.journalFile is None:
+			return True
+		return stat(self.journalPath).st_ino != fstat(self.journalFile.fileno()).st_ino
+
+	def tail(self, isReload: bool = False):
+		if not self.readJournal(isReload):
+			return self.load()
+		if self.isJournalRotated():
+			# the old journal is complete once it is renamed, continue in the new one
+			if self.journalFile is not None:
+				self.journalFile.close()
+			self.journalFile = open(self.journalPath, 'rb')
+			self.pendingBytes = b""
+			if not self.readJournal(isReload):
+				return self.load()
+
+	def applyRetention(self, isReload: bool = False):
+		# call with the lock held. what the monitor archived is dropped here as well,
+		# so the store holds the same hot window as the monitor
+		archivedUntil = self.archive.archivedUntil()
+		self.archive.refresh()
+		if self.archive.archivedUntil() is None or (self.archive.archivedUntil() == archivedUntil and not isReload):
+			return
+		if len(DropExpired(self.db, self.archive.archivedUntil())) != 0:
+			self.generation += 1
+			if self.index is not None:
+				self.index.dropBefore(self.archive.archivedUntil())
+			if self.rollups is not None:
+				self.rollups.dropBefore(self.archive.archivedUntil())
+
+	def refresh(self):
+		with self.lock:
+			if self.db is None:
+				self.load()
+			else:
+				self.tail()
+				self.applyRetention()
+			self.applyLiveRecords()
+
+	def matchUsers(self, users: List[str] = None, regex: str = None) -> List[str]:
+		uids = users if users is not None else self.db.keys()
+		uids = [uid for uid in uids if uid in self.db]
+		if regex is not None:
+			pattern = re.compile(regex)
+			uids = [
+				uid for uid in uids
+				if pattern.search(uid) or pattern.search(self.db[uid]["fullname"] or "")
+			]
+		return sorted(uids)
+
+	def query(
+		self, users: List[str] = None, regex: str = None,
+		states: List[str] = None, fromTs: int = None, toTs: int = None, width: int = None
+	) -> Tuple[Dict, int]:
+		# intervals overlapping [fromTs, toTs], found by bisecting each user's history
+		# returned with the version they reflect. with a width (pixels) the gaps shorter
+		# than a pixel are filled, starting from the rollup of the fitting resolution.
+		# a range starting before the retention period gets the archived intervals too
+		self.refresh()
+		states = states if states is not None else STATES
+		result = {}
+		with self.lock:
+			uids = self.matchUsers(users, regex)
+			resolution, pixel = RAW_RESOLUTION, None
+			if width is not None:
+				resolution, pixel = PickResolution(self.rangeLength(uids, states, fromTs, toTs), width)
+			for uid in uids:
+				user = self.db[uid]
+				userResult = {
+					"fullname": user["fullname"],
+					"image": user["image"]
+				}
+				for state in states:
+					if resolution == RAW_RESOLUTION:
+						intervals = user[state].slice(fromTs, toTs).toList()
+					else:
+						intervals = self.getRollups().merged(resolution, uid, state).slice(fromTs, toTs).toList()
+						if user[state].isLastOpen():
+							intervals.append([user[state].lastStart(), None])
+					if self.archive.isNeeded(fromTs):
+						intervals = self.archivedIntervals(uid, state, fromTs, toTs) + intervals
+					if pixel is not None:
+						intervals = MergeIntervals(intervals, pixel)
+					userResult[state] = intervals
+				result[uid] = userResult
+			return result, self.version
+
+	def archivedIntervals(self, uid: str, state: str, fromTs: int = None, toTs: int = None) -> List[List[int]]:
+		# call with the lock held, the archived ones before the first interval of the hot window
+		intervals = self.archive.intervals(uid, state, fromTs, toTs)
+		hot = self.db[uid][state]
+		if len(hot) != 0:
+			intervals = [interval for interval in intervals if interval[0] < hot[0][0]]
+		return intervals
+
+	def exportRows(
+		self, users: List[str] = None, regex: str = None,
+		states: List[str] = None, fromTs: int = None, toTs: int = None
+	) -> Iterator[Tuple[str, str, int, int]]:
+		# (uid, state, start, end) of the intervals overlapping [fromTs, toTs], found by
+		# bisecting like query() but produced one user at a time: the lock is only held
+		# while the intervals of a user are copied. unlike /query an export without a
+		# start includes the archive: the archived months come first, one segment at a
+		# time, then the recent window
+		self.refresh()
+		states = states if states is not None else STATES
+		with self.lock:
+			uids = self.matchUsers(users, regex)
+			archivedUntil = self.archive.archivedUntil()
+			isArchiveNeeded = archivedUntil is not None and (fromTs is None or fromTs < archivedUntil)
+			segmentNames = self.archive.segmentNames(fromTs, toTs) if isArchiveNeeded else []
+			# archived intervals from where the recent window starts are in both after a crash
+			hotStarts = {
+				(uid, state): self.db[uid][state][0][0]
+				for uid in uids for state in states if len(self.db[uid][state]) != 0
+			} if isArchiveNeeded else {}
+		for name in segmentNames:
+			with self.lock:
+				segment = self.archive.segment(name)
+			for uid in uids:
+				for state in states:
+					intervals = segment.get(uid, {}).get(state)
+					if intervals is None:
+						continue
+					hotStart = hotStarts.get((uid, state))
+					for start, end in intervals.slice(fromTs, toTs):
+						if hotStart is None or start < hotStart:
+							yield uid, state, start, end
+		for uid in uids:
+			with self.lock:
+				user = self.db[uid]
+				intervals = [(state, user[state].slice(fromTs, toTs)) for state in states]
+			for state, stateIntervals in intervals:
+				for start, end in stateIntervals:
+					yield uid, state, start, end
+
+	def rangeLength(self, uids: List[str], states: List[str], fromTs: int = None, toTs: int = None) -> int:
+		# call with the lock held, an open end of the range is where the data ends
+		if fromTs is None:
+			starts = [self.db[uid][state][0][0] for uid in uids for state in states if len(self.db[uid][state]) != 0]
+			fromTs = min(starts) if len(starts) != 0 else 0
+		if toTs is None:
+			toTs = GetTimeStamp()
+		return max(0, toTs - fromTs)
+
+	def getRollups(self) -> Rollups:
+		# call with the lock held
+		if self.rollups is None:
+			self.rollups = Rollups.fromDatabase(self.db)
+		return self.rollups
+
+	def rollupBuckets(
+		self, resolution: str, users: List[str] = None, regex: str = None,
+		states: List[str] = None, fromTs: int = None, toTs: int = None
+	) -> Tuple[Dict, int]:
+		# uid -> state -> [[bucket start, seconds, sessions, first seen, last seen], ...]
+		self.refresh()
+		states = states if states is not None else STATES
+		with self.lock:
+			rollups = self.getRollups()
+			result = {
+				uid: {state: rollups.buckets(resolution, uid, state, fromTs, toTs) for state in states}
+				for uid in self.matchUsers(users, regex)
+			}
+			return result, self.version
+
+	def filterChanges(
+		self, records: List[List], users: List[str] = None, regex: str = None,
+		states: List[str] = None, fromTs: int = None, toTs: int = None
+	) -> Dict:
+		# call with the lock held
+		states = states if states is not None else STATES
+		changedUids = set([record[1] for record in records])
+		matchingUsers = set(self.matchUsers([uid for uid in changedUids if users is None or uid in users], regex))
+		changes = []
+		changedUsers = {}
+		for record in records:
+			uid = record[1]
+			if uid not in matchingUsers:
+				continue
+			if record[0] != RECORD_USER and record[2] not in states:
+				continue
+			if not ChangeOverlaps(record, fromTs, toTs):
+				continue
+			changes.append(ChangeToDict(record))
+			changedUsers[uid] = { "fullname": self.db[uid]["fullname"], "image": self.db[uid]["image"] }
+		return { "version": self.version, "changes": changes, "users": changedUsers }
+
+	def changesSince(self, since: int, **filters) -> Dict:
+		# None if the client is too far behind (or ahead) and has to query everything again
+		self.refresh()
+		with self.lock:
+			first = bisect_right(self.changeVersions, since)
+			isBehind = since < self.version and (first == 0 and self.changeVersions[:1] != [since + 1])
+			if since > self.version or isBehind:
+				return None
+			return self.filterChanges(self.changes[first:], **filters)
+
+	def getIndex(self) -> PresenceIndex:
+		# call with the lock held
+		if self.index is None:
+			self.index = PresenceIndex.fromDatabase(self.db)
+		return self.index
+
+	def usersAt(self, timeStamp: int, states: List[str] = None) -> Tuple[Dict, int]:
+		# state -> uids in that state at the given time
+		self.refresh()
+		states = states if states is not None else STATES
+		with self.lock:
+			index = self.getIndex()
+			return {state: index.usersAt(state, timeStamp) for state in states}, self.version
+
+	def overlapping(self, states: List[str] = None, fromTs: int = None, toTs: int = None) -> Tuple[Dict, int]:
+		# state -> uid -> intervals overlapping [fromTs, toTs]
+		self.refresh()
+		states = states if states is not None else STATES
+		with self.lock:
+			index = self.getIndex()
+			return {state: index.overlapping(state, fromTs, toTs) for state in states}, self.version
+
+	def coPresence(self, first: str, second: str, state: str, fromTs: int = None, toTs: int = None) -> Dict:
+		# None if one of the users is unknown
+		self.refresh()
+		with self.lock:
+			if first not in self.db or second not in self.db:
+				return None
+			seconds, intervals = CoPresence(self.db[first][state], self.db[second][state], GetTimeStamp(), fromTs, toTs)
+			return { "seconds": seconds, "intervals": intervals, "version": self.version }
@@ -0,0 +1,257 @@
+# coding=utf-8
+
+from typing import Dict, List
+from multiprocessing import Process, Queue, RawValue
+from queue import Empty
+from os.path import basename, splitext
+from time import time, sleep
+from traceback import format_exc
+import signal
+
+from core import globals
+from core.utils import Log, ErrorLevel, GetTimeStamp
+from core.monitor import PresenceMonitor, DatabaseLoadError, LoadConfig, RETENTION_INTERVAL
+from core.storage import JournalStorage, ApplyRecord, RECORD_DROP
+from core.bus import PresencePublisher, DEFAULT_BUS_PORT
+from core.intervals import STATES
+from core.archive import RetentionPolicy, DropExpired
+
+SHARD_SAVE_COUNT    = 10  # same loop as server.py: a save every 10th cycle
+SHARD_SLEEP_TIME    = 2   # seconds between two cycles
+SAVE_INTERVAL       = 20  # seconds between two saves of the merged db
+QUEUE_TIMEOUT       = 1   # seconds the supervisor waits for records before checking the workers
+MAX_DRAIN           = 10000 # records taken from the queue before the workers are checked again
+MIN_RESTART_DELAY   = 5   # seconds before a crashed worker is started again
+MAX_RESTART_DELAY   = 300 # the delay doubles while the worker keeps crashing right away
+STABLE_RUN_TIME     = 60  # seconds a worker has to run for its restart delay to be reset
+
+# supervisor -> worker messages, (kind, uids)
+SHARD_RELEASE       = "release" # another account tracks these users
+SHARD_ADOPT         = "adopt"   # the account that tracked them is gone
+
+class ShardPublisher:
+	# stands in for the udp publisher of a worker's monitor: every record goes to the supervisor
+
+	def __init__(self, shard: str, outbox: Queue):
+		self.shard = shard
+		self.outbox = outbox
+
+	def publish(self, record: List):
+		self.outbox.put((self.shard, record))
+
+	def close(self):
+		pass
+
+def ShardDatabasePath(dbPath: str, shard: str) -> str:
+	# next to the merged db so the avatar cache is shared
+	root, extension = splitext(dbPath)
+	return "{}.{}{}".format(root, shard, extension)
+
+def ShardNames(configPaths: List[str]) -> List[str]:
+	# config file names without extension, numbered if two are the same
+	names = []
+	for configPath in configPaths:
+		name = splitext(basename(configPath))[0]
+		if name in names:
+			name = "{}{}".format(name, len(names))
+		names.append(name)
+	return names
+
+def ApplyShardMessages(pm: PresenceMonitor, inbox: Queue):
+	while True:
+		try:
+			kind, uids = inbox.get_nowait()
+		except Empty:
+			return
+		if kind == SHARD_RELEASE:
+			pm.releaseUsers(uids)
+		elif kind == SHARD_ADOPT:
+			pm.adoptUsers(uids)
+
+def RunShard(shard: str, configPath: str, dbPath: str, outbox: Queue, inbox: Queue, stopFlag: RawValue, logLevel: int):
+	# worker process: the server.py loop for one account, stopped by the supervisor
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	globals.LOG_LEVEL = logLevel
+	pm = PresenceMonitor(
+		configPath, ShardDatabasePath(dbPath, shard), publisher=ShardPublisher(shard, outbox), loadInBackground=True
+	)
+	counter = 0
+	while not stopFlag.value:
+		try:
+			ApplyShardMessages(pm, inbox)
+			pm.query()
+			counter = (counter + 1) % SHARD_SAVE_COUNT
+			if counter == 0:
+				pm.saveDB()
+		except DatabaseLoadError:
+			# the worker exits, the supervisor restarts it after a delay
+			raise
+		except:
+			Log(ErrorLevel.warning, "[{}] {}", shard, format_exc())
+			pm.resetParameters()
+		sleep(pm.nextCycleDelay(SHARD_SLEEP_TIME))
+	pm.saveAll()
+
+class ShardWorker:
+
+	def __init__(self, shard: str, configPath: str):
+		self.shard = shard
+		self.configPath = configPath
+		self.process = None # type: Process
+		self.inbox = None # type: Queue
+		self.startedAt = None # type: float
+		self.diedAt = None # type: float
+		self.restartDelay = MIN_RESTART_DELAY
+
+	def isAlive(self) -> bool:
+		return self.process is not None and self.process.is_alive()
+
+	def send(self, kind: str, uids: List[str]):
+		if self.isAlive() and len(uids) != 0:
+			self.inbox.put((kind, uids))
+
+class Supervisor:
+	# runs one monitor process per account and merges what they see into one db.
+	# the first account that reports a user owns it: the other workers are told to
+	# ignore that user, so every friend is tracked and queried by a single account,
+	# and records of a user from anyone but its owner are discarded. the records get
+	# new versions in the merged journal and go to the web interface over the bus.
+	# a crashed worker gives up its users to the others and is started again
+
+	def __init__(self, configPaths: List[str], dbPath: str, busPort: int = DEFAULT_BUS_PORT):
+		self.dbPath = dbPath
+		# the merged db follows the retention policy of the first account
+		self.retention = RetentionPolicy.fromConfig(LoadConfig(configPaths[0]))
+		self.storage = JournalStorage(dbPath, retention=self.retention)
+		self.db = self.storage.load()
+		self.retainedAt = 0
+		self.version = self.storage.version
+		self.pendingRecords = []
+		self.publisher = PresencePublisher(busPort) if busPort != 0 else None
+		self.owners = {} # type: Dict[str, str]
+		self.claims = {} # type: Dict[str, List[str]]
+		self.outbox = Queue()
+		# a plain shared flag: a lock or event could be left locked by a killed worker
+		self.stopFlag = RawValue('b', 0)
+		self.workers = {
+			shard: ShardWorker(shard, configPath)
+			for shard, configPath in zip(ShardNames(configPaths), configPaths)
+		} # type: Dict[str, ShardWorker]
+		self.dropDanglingIntervals()
+
+	def record(self, recordType: str, *fields) -> List:
+		self.version += 1
+		record = [recordType, *fields, self.version]
+		ApplyRecord(self.db, record)
+		self.pendingRecords.append(record)
+		if self.publisher is not None:
+			self.publisher.publish(record)
+		return record
+
+	def dropDanglingIntervals(self, uids: List[str] = None):
+		# intervals nobody is going to close: cut by a crash of the supervisor or of a worker
+		for uid in (uids if uids is not None else list(self.db.keys())):
+			for state in STATES:
+				intervals = self.db[uid][state]
+				if intervals.isLastOpen():
+					self.record(RECORD_DROP, uid, state, intervals.lastStart())
+
+	def startWorker(self, worker: ShardWorker):
+		Log(ErrorLevel.info, "starting monitor of {}", worker.shard)
+		worker.inbox = Queue()
+		foreignUids = [uid for uid, owner in self.owners.items() if owner != worker.shard]
+		if len(foreignUids) != 0:
+			worker.inbox.put((SHARD_RELEASE, foreignUids))
+		worker.process = Process(
+			target=RunShard,
+			args=(worker.shard, worker.configPath, self.dbPath, self.outbox, worker.inbox, self.stopFlag, globals.LOG_LEVEL),
+			name="monitor-" + worker.shard
+		)
+		worker.process.start()
+		worker.startedAt = time()
+		worker.diedAt = None
+
+	def releaseShard(self, shard: str):
+		uids = [uid for uid, owner in self.owners.items() if owner == shard]
+		for uid in uids:
+			del self.owners[uid]
+		self.dropDanglingIntervals(uids)
+		for worker in self.workers.values():
+			if worker.shard != shard:
+				worker.send(SHARD_ADOPT, uids)
+		Log(ErrorLevel.info, "{} users of {} released", len(uids), shard)
+
+	def checkWorkers(self, now: float):
+		for worker in self.workers.values():
+			if worker.isAlive():
+				continue
+			if worker.diedAt is None:
+				Log(ErrorLevel.warning, "monitor of {} exited with {}", worker.shard, worker.process.exitcode)
+				worker.diedAt = now
+				if now - worker.startedAt >= STABLE_RUN_TIME:
+					worker.restartDelay = MIN_RESTART_DELAY
+				self.releaseShard(worker.shard)
+			elif now - worker.diedAt >= worker.restartDelay:
+				self.startWorker(worker)
+				worker.restartDelay = min(MAX_RESTART_DELAY, worker.restartDelay * 2)
+
+	def handle(self, shard: str, record: List):
+		uid = record[1]
+		owner = self.owners.get(uid)
+		if owner is None:
+			if record[0] == RECORD_DROP:
+				return # nothing of it in the merged db
+			owner = self.owners[uid] = shard
+			self.claims.setdefault(shard, []).append(uid)
+		if owner != shard:
+			return
+		# the worker's version is replaced by the merged one
+		self.record(*record[:-1])
+
+	def drain(self, timeout: float):
+		try:
+			shard, record = self.outbox.get(timeout=timeout)
+			self.handle(shard, record)
+			for _ in range(MAX_DRAIN):
+				shard, record = self.outbox.get_nowait()
+				self.handle(shard, record)
+		except Empty:
+			pass
+		# tell the others about the users claimed meanwhile
+		for shard, uids in self.claims.items():
+			for worker in self.workers.values():
+				if worker.shard != shard:
+					worker.send(SHARD_RELEASE, uids)
+		self.claims = {}
+
+	def save(self):
+		self.storage.append(self.pendingRecords)
+		self.pendingRecords = []
+		if self.retention.isEnabled() and time() - self.retainedAt >= RETENTION_INTERVAL:
+			# same as the monitor: memory keeps the hot window, the compaction archives the rest
+			self.retainedAt = time()
+			if len(DropExpired(self.db, self.retention.cutoff(GetTimeStamp()))) != 0:
+				self.storage.compact()
+
+	def run(self):
+		for worker in self.workers.values():
+			self.startWorker(worker)
+		savedAt = time()
+		while globals.RUN_PROGRAM:
+			self.drain(QUEUE_TIMEOUT)
+			self.checkWorkers(time())
+			if time() - savedAt >= SAVE_INTERVAL:
+				self.save()
+				savedAt = time()
+		self.stop()
+
+	def stop(self):
+		Log(ErrorLevel.info, "stopping the monitors")
+		self.stopFlag.value = 1
+		# the workers close their intervals on the way out, keep taking their records
+		while any(worker.isAlive() for worker in self.workers.values()):
+			self.drain(QUEUE_TIMEOUT)
+		self.drain(0)
+		self.save()
+		self.storage.compact(wait=True)
+		self.storage.close()
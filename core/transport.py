@@ -0,0 +1,91 @@
+# coding=utf-8
+
+from typing import Dict
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+DEFAULT_POOL_CONNECTIONS    = 4    # number of hosts with a connection pool (edge-chat, www, cdn)
+DEFAULT_POOL_SIZE           = 10   # kept-alive connections per host
+DEFAULT_CONNECT_TIMEOUT     = 5    # seconds
+DEFAULT_READ_TIMEOUT        = 20   # seconds
+DEFAULT_PULL_TIMEOUT        = 70   # seconds, /pull is a long-poll so it needs a longer read timeout
+DEFAULT_RETRIES             = 3
+DEFAULT_BACKOFF             = 0.5  # sleeps 0.5s, 1s, 2s... between retries
+RETRY_STATUSES              = [500, 502, 503, 504]
+# a request that may have reached the server is only sent again if that can't change anything,
+# the POSTs are retried on connection errors only (nothing was sent then)
+RETRY_METHODS               = frozenset(["HEAD", "GET", "OPTIONS"])
+
+def CreateRetry(retries: int, backoff: float, readRetries: int = None) -> Retry:
+	# readRetries: retries after a read timeout or a broken response, `retries` if None
+	retryArgs = {
+		"total": retries,
+		"connect": retries,
+		"read": retries if readRetries is None else readRetries,
+		"status_forcelist": RETRY_STATUSES,
+		"backoff_factor": backoff,
+		"raise_on_status": False
+	}
+	try:
+		return Retry(allowed_methods=RETRY_METHODS, **retryArgs)
+	except TypeError:
+		# urllib3 before 1.26 calls it method_whitelist
+		return Retry(method_whitelist=RETRY_METHODS, **retryArgs)
+
+class HttpTransport:
+	# keep-alive sessions shared by the user queries and the profile lookups, the pull feed
+	# has one of its own: a long-poll that timed out is answered by the next /pull, not by
+	# waiting the whole timeout again
+
+	def __init__(
+		self,
+		poolConnections: int = DEFAULT_POOL_CONNECTIONS, poolSize: int = DEFAULT_POOL_SIZE,
+		connectTimeout: float = DEFAULT_CONNECT_TIMEOUT, readTimeout: float = DEFAULT_READ_TIMEOUT,
+		pullTimeout: float = DEFAULT_PULL_TIMEOUT,
+		retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF
+	):
+		self.timeout = (connectTimeout, readTimeout)
+		self.pullTimeout = (connectTimeout, pullTimeout)
+		adapter = HTTPAdapter(
+			pool_connections=poolConnections,
+			pool_maxsize=poolSize,
+			max_retries=CreateRetry(retries, backoff)
+		)
+		self.session = requests.Session()
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+		pullAdapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=CreateRetry(retries, backoff, readRetries=0))
+		self.pullSession = requests.Session()
+		self.pullSession.mount("https://", pullAdapter)
+		self.pullSession.mount("http://", pullAdapter)
+
+	@staticmethod
+	def fromConfig(config: Dict) -> 'HttpTransport':
+		# optional keys of the config file, defaults are used for the missing ones
+		return HttpTransport(
+			poolConnections=int(config.get("pool_connections", DEFAULT_POOL_CONNECTIONS)),
+			poolSize=int(config.get("pool_size", DEFAULT_POOL_SIZE)),
+			connectTimeout=float(config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)),
+			readTimeout=float(config.get("read_timeout", DEFAULT_READ_TIMEOUT)),
+			pullTimeout=float(config.get("pull_timeout", DEFAULT_PULL_TIMEOUT)),
+			retries=int(config.get("retries", DEFAULT_RETRIES)),
+			backoff=float(config.get("retry_backoff", DEFAULT_BACKOFF))
+		)
+
+	def get(self, url: str, **kwargs) -> requests.Response:
+		kwargs.setdefault("timeout", self.timeout)
+		return self.session.get(url, **kwargs)
+
+	def post(self, url: str, **kwargs) -> requests.Response:
+		kwargs.setdefault("timeout", self.timeout)
+		return self.session.post(url, **kwargs)
+
+	def pull(self, url: str, **kwargs) -> requests.Response:
+		# the /pull long-poll or stream, never read again after a timeout
+		kwargs.setdefault("timeout", self.pullTimeout)
+		return self.pullSession.get(url, **kwargs)
+
+	def close(self):
+		self.session.close()
+		self.pullSession.close()
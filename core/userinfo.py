@@ -1,38 +1,96 @@
 # coding=utf-8
 
 from typing import Dict, List
+from os import open as openFile, fdopen, replace, O_WRONLY, O_CREAT, O_TRUNC
+from os.path import exists
+from threading import Thread, Lock
+from time import time
+from hashlib import sha1
+from traceback import format_exc
 import sys
 import json
 import re
-import requests
 
 from core.utils import Log, ErrorLevel
+from core.transport import HttpTransport
+from core.decoders import DecodePayload
 
-JSON_PAYLOAD_PREFIX = "for (;;);"
 WEBSITE_URL         = "https://www.facebook.com/"
 INFORMATION_URL     = "https://www.facebook.com/chat/user_info/?dpr=1"
 PRESENCE_URL        = "https://www.facebook.com/ajax/mercury/tabs_presence.php?dpr=1"
+PROFILE_CHUNK_SIZE  = 100 # ids sent in one user_info request
+TOKEN_MAX_AGE       = 12 * 60 * 60 # seconds a fb_dtsg token is used before it is fetched again
+TOKEN_CACHE_SUFFIX  = ".token" # the token is cached next to the db so a restart doesn't wait for it
+TOKEN_TMP_SUFFIX    = ".tmp"
+
+class TokenCache:
+	# the fb_dtsg token on disk with the time it was fetched, tied to the session
+	# (a hash of the cookie) it belongs to. only readable by the owner
+
+	def __init__(self, path: str, maxAge: float = TOKEN_MAX_AGE):
+		self.path = path
+		self.maxAge = maxAge
+
+	@staticmethod
+	def sessionKey(cookie: str) -> str:
+		return sha1(cookie.encode('utf-8')).hexdigest()
+
+	def load(self, cookie: str) -> Dict:
+		# {"token": ..., "fetchedAt": ...} or None if there is no usable one
+		if not exists(self.path):
+			return None
+		try:
+			with open(self.path, 'r') as tokenFile:
+				cached = json.loads(tokenFile.read())
+		except (OSError, ValueError) as error:
+			Log(ErrorLevel.warning, "token cache {} is unreadable, fetching a new token: {}", self.path, error)
+			return None
+		if (not isinstance(cached, dict)
+			or not isinstance(cached.get("token"), str)
+			or not isinstance(cached.get("fetchedAt"), (int, float))
+		):
+			Log(ErrorLevel.warning, "token cache {} is malformed, fetching a new token", self.path)
+			return None
+		if cached.get("session") != self.sessionKey(cookie) or time() - cached.get("fetchedAt", 0) >= self.maxAge:
+			return None
+		return cached
+
+	def store(self, cookie: str, token: str, fetchedAt: float):
+		tmpPath = self.path + TOKEN_TMP_SUFFIX
+		with fdopen(openFile(tmpPath, O_WRONLY | O_CREAT | O_TRUNC, 0o600), 'w') as tokenFile:
+			tokenFile.write(json.dumps({ "session": self.sessionKey(cookie), "token": token, "fetchedAt": fetchedAt }))
+		replace(tmpPath, self.path)
 
 class UserQueryManager:
 
-	def __init__(self, userFBID: str, cookie: str, userAgent: str):
+	def __init__(
+		self, userFBID: str, cookie: str, userAgent: str, transport: HttpTransport = None,
+		websiteURL: str = WEBSITE_URL, informationURL: str = INFORMATION_URL, presenceURL: str = PRESENCE_URL,
+		tokenCache: TokenCache = None
+	):
 		self.user_fbid = userFBID
+		self.cookie = cookie
+		self.transport = transport if transport is not None else HttpTransport()
+		# overridable so the monitor can be pointed at a stand-in server (see core.fakefacebook)
+		self.websiteURL = websiteURL
+		self.informationURL = informationURL
+		self.presenceURL = presenceURL
+		# fb_dtsg is only needed by the user_info and presence queries, never by /pull:
+		# it is fetched on first use (or by prefetchToken) instead of in the constructor
+		self.tokenCache = tokenCache
+		self.tokenMaxAge = tokenCache.maxAge if tokenCache is not None else TOKEN_MAX_AGE
+		self.token = None # type: str
+		self.tokenFetchedAt = 0
+		self.tokenLock = Lock()
 		self.initHeaders(userFBID, cookie, userAgent)
 
 	@staticmethod
-	def getParsedResponse(rawResponse: str) -> Dict:
-		if not rawResponse:
-			data = None
-		elif rawResponse.startswith(JSON_PAYLOAD_PREFIX):
-			data = rawResponse[len(JSON_PAYLOAD_PREFIX):].strip()
-			data = json.loads(data)
-		else:
-			# If it didn't start with for (;;); then something weird is happening.
-			data = json.loads(rawResponse)
-		return data
+	def getParsedResponse(rawResponse: bytes) -> Dict:
+		# If it didn't start with for (;;); then something weird is happening, it is parsed anyway
+		return DecodePayload(rawResponse)
 
 	@staticmethod
-	def getParsedPresenceInfo(rawResponse: str) -> Dict:
+	def getParsedPresenceInfo(rawResponse: bytes) -> Dict:
 		result = { "isOnline": None }
 		Log(ErrorLevel.debug, "query presence raw response: {}", rawResponse)
 		responseObj = UserQueryManager.getParsedResponse(rawResponse)
@@ -61,7 +119,7 @@ class UserQueryManager:
 		return resultDict
 
 	@staticmethod
-	def getParsedUserInfo(rawResponse: str) -> Dict:
+	def getParsedUserInfo(rawResponse: bytes) -> Dict:
 		result = {
 			"fullname": None,
 			"thumbnailURL": None,
@@ -84,60 +142,107 @@ class UserQueryManager:
 
 	def getUserInfo(self, uid: str) -> Dict:
 		infoBody = self.INFORMATION_REQUEST_BODY.copy()
+		infoBody["fb_dtsg"] = self.getToken()
 		infoBody["ids[0]"] = uid
-		response_obj = requests.post(
-			INFORMATION_URL,
+		response_obj = self.transport.post(
+			self.informationURL,
 			data = infoBody,
 			headers = self.JSON_POST_HEADERS
 		)
-		Log(ErrorLevel.debug, "raw query response: {}", response_obj.text)
-		userInfo = self.getParsedUserInfo(response_obj.text)
+		Log(ErrorLevel.debug, "raw query response: {}", response_obj.content)
+		userInfo = self.getParsedUserInfo(response_obj.content)
 		return userInfo
 
-	def getAllUserInfo(self, uidList: list) -> Dict:
-		infoBody = self.INFORMATION_REQUEST_BODY.copy()
-		for i, uid in enumerate(uidList):
-			infoBody["ids[{}]".format(i)] = str(uid)
-			response_obj = requests.post(
-				INFORMATION_URL,
-			    data=infoBody,
-			    headers=self.JSON_POST_HEADERS
+	@staticmethod
+	def getParsedUserInfoBatch(rawResponse: bytes) -> Dict:
+		# always keyed by uid, even if only one profile came back
+		responseObj = UserQueryManager.getParsedResponse(rawResponse)
+		if  (   (responseObj is not None)
+			and ("payload" in responseObj)
+			and (type(responseObj["payload"]) is dict)
+			and ("profiles" in responseObj["payload"])
+		):
+			return UserQueryManager.getParsedAllUserInfo(
+				responseObj["payload"]["profiles"],
+				{ "fullname": None, "thumbnailURL": None }
 			)
-		return UserQueryManager.getParsedUserInfo(response_obj.text)
+		Log(ErrorLevel.warning, "unexpected user info: {}", responseObj)
+		return {}
+
+	def getAllUserInfo(self, uidList: list, chunkSize: int = PROFILE_CHUNK_SIZE) -> Dict:
+		# one request per chunk of ids instead of one per user
+		result = {}
+		for chunkStart in range(0, len(uidList), chunkSize):
+			infoBody = self.INFORMATION_REQUEST_BODY.copy()
+			infoBody["fb_dtsg"] = self.getToken()
+			for i, uid in enumerate(uidList[chunkStart:chunkStart + chunkSize]):
+				infoBody["ids[{}]".format(i)] = str(uid)
+			response_obj = self.transport.post(
+				self.informationURL,
+				data=infoBody,
+				headers=self.JSON_POST_HEADERS
+			)
+			result.update(UserQueryManager.getParsedUserInfoBatch(response_obj.content))
+		return result
 
 	def getPresence(self, uid: str) -> Dict:
 		presenceBody = self.PRESENCE_REQUEST_BODY.copy()
 		presenceBody["target_id"] = uid
+		presenceBody["fb_dtsg"] = self.getToken()
 		presenceHead = self.JSON_POST_HEADERS.copy()
 		presenceHead["content-length"] = \
 			str(len("&".join([
 				"{}={}".format(key, value)
 				for (key, value) in zip(presenceBody.keys(), presenceBody.values())
 			])))
-		response_obj = requests.post(
-			PRESENCE_URL,
+		response_obj = self.transport.post(
+			self.presenceURL,
 			data=presenceBody,
 			headers=presenceHead
 		)
-		return self.getParsedPresenceInfo(response_obj.text)
+		return self.getParsedPresenceInfo(response_obj.content)
+
+	def fetchToken(self) -> str:
+		# None if the main page has no token
+		response_obj = self.transport.get(
+			self.websiteURL,
+			headers=self.WEBSITE_REQUEST_HEADERS,
+			allow_redirects=True
+		)
+		matchTokenRegex = """name="fb_dtsg" ?value="([^\\"]+)""" # matching attribute in html with regex
+		m = re.search(matchTokenRegex, response_obj.text)
+		return m.group(1) if m else None
 
 	def getToken(self) -> str:
-		if hasattr(self, "token"):
-			return self.token
-		else:
-			response_obj = requests.get(
-				WEBSITE_URL,
-				headers=self.WEBSITE_REQUEST_HEADERS,
-				allow_redirects=True
-			)
-			matchTokenRegex = """name="fb_dtsg" ?value="([^\\"]+)""" # matching attribute in html with regex
-			m = re.search(matchTokenRegex, response_obj.text)
-			if m:
-				self.token = m.group(1)
+		with self.tokenLock:
+			if self.token is not None and time() - self.tokenFetchedAt < self.tokenMaxAge:
 				return self.token
-			else:
+			cached = self.tokenCache.load(self.cookie) if self.tokenCache is not None else None
+			if cached is not None:
+				self.token, self.tokenFetchedAt = cached["token"], cached["fetchedAt"]
+				return self.token
+			token = self.fetchToken()
+			if token is None:
 				Log(ErrorLevel.error, "token is missing from fb main page or invalid data in config file")
 				sys.exit(1)
+			self.token, self.tokenFetchedAt = token, time()
+			if self.tokenCache is not None:
+				self.tokenCache.store(self.cookie, self.token, self.tokenFetchedAt)
+			return self.token
+
+	def prefetchToken(self):
+		# loads the token on a background thread so the first query doesn't wait for the main page
+		Thread(target=self.prefetchTokenThread, name="token-prefetch", daemon=True).start()
+
+	def prefetchTokenThread(self):
+		# a failure here is only logged, sys.exit() in getToken() would end just this thread:
+		# the first query fetches the token again and stops the monitor if it fails
+		try:
+			self.getToken()
+		except SystemExit:
+			Log(ErrorLevel.warning, "token prefetch failed, the first query tries again")
+		except:
+			Log(ErrorLevel.warning, "token prefetch failed: {}", format_exc())
 
 	def initHeaders(self, user_fbid, cookie: str, userAgent: str):
 		self.WEBSITE_REQUEST_HEADERS = {
@@ -177,7 +282,6 @@ class UserQueryManager:
 			"__be": "-1",
 			"__pc": "PHASED:DEFAULT",
 			"__rev": "2702404",
-			"fb_dtsg": self.getToken(),
 			"ttstamp": "26512345678901234567890123456789012345678901234567890123456" # this isn't needed either
 		}
 		self.PRESENCE_REQUEST_BODY = {
@@ -192,7 +296,6 @@ class UserQueryManager:
 			"__be": "-1",
 			"__pc": "PHASED:DEFAULT",
 			"__rev": "2702404",
-			"fb_dtsg": self.getToken(),
 			"ttstamp": "26512345678901234567890123456789012345678901234567890123456"
 		}
 
@@ -0,0 +1,99 @@
+# coding=utf-8
+
+from argparse import ArgumentParser, Namespace
+from os import path
+from sys import exit, stdout
+
+from core import globals
+from core.utils import ErrorLevel, Log
+from core.intervals import STATES
+from core.export import HistoryRows, CsvChunks, NdjsonChunks, ColumnarWriter, EXPORT_FORMATS
+
+def SplitList(value: str):
+	return [item for item in value.split(",") if item] if value else None
+
+def InitArguments() -> Namespace:
+	parser = ArgumentParser(
+		prog="python " + path.basename(__file__),
+		description="Exports the presence history as flat uid,state,start,end rows. "
+		            "Rows are streamed, filtered while they are read, the archive is included."
+	)
+	parser.add_argument(
+		"-d", "--db",
+		metavar='DB_FILE', nargs=1, required=True,
+		help="Path to the database file"
+	)
+	parser.add_argument(
+		"-f", "--format",
+		choices=EXPORT_FORMATS, default="csv",
+		help="csv, ndjson or npy: a directory with one int64 .npy file per column "
+		     "(user, state, start, end) and dictionary.json for the user and state numbers"
+	)
+	parser.add_argument(
+		"-o", "--output",
+		metavar='OUTPUT', default=None,
+		help="Output file (default: standard output), the directory for npy"
+	)
+	parser.add_argument(
+		"--users",
+		metavar='UIDS', default=None,
+		help="Comma separated uids"
+	)
+	parser.add_argument(
+		"--regex",
+		metavar='REGEX', default=None,
+		help="Only users whose uid or name matches"
+	)
+	parser.add_argument(
+		"--states",
+		metavar='STATES', default=None,
+		help="Comma separated states: {}".format(", ".join(STATES))
+	)
+	parser.add_argument(
+		"--from",
+		dest="fromTs", metavar='TIMESTAMP', type=int, default=None,
+		help="Only intervals ending after this"
+	)
+	parser.add_argument(
+		"--to",
+		dest="toTs", metavar='TIMESTAMP', type=int, default=None,
+		help="Only intervals starting before this"
+	)
+	parser.add_argument(
+		"-l", "--log",
+		metavar='LOG_LEVEL', type=int, default=ErrorLevel.warning,
+		help="0: silent, 1: error, 2: warning (default), 3: info, 4: debug"
+	)
+	return parser.parse_args()
+
+def main():
+	args = InitArguments()
+	globals.LOG_LEVEL = args.log
+	states = SplitList(args.states)
+	if states is not None and any(state not in STATES for state in states):
+		Log(ErrorLevel.error, "unknown state in {}", args.states)
+		return 1
+	if args.format == "npy" and args.output is None:
+		Log(ErrorLevel.error, "npy needs an output directory")
+		return 1
+	# read straight from the files, the db is never loaded as a whole
+	rows = HistoryRows(
+		args.db[0], users=SplitList(args.users), regex=args.regex, states=states, fromTs=args.fromTs, toTs=args.toTs
+	)
+	if args.format == "npy":
+		writer = ColumnarWriter(args.output)
+		writer.write(rows)
+		Log(ErrorLevel.info, "{} rows written to {}", writer.close(), args.output)
+		return 0
+	chunks = CsvChunks(rows) if args.format == "csv" else NdjsonChunks(rows)
+	outputFile = open(args.output, 'w', newline="") if args.output is not None else stdout
+	try:
+		for chunk in chunks:
+			outputFile.write(chunk)
+	finally:
+		if outputFile is not stdout:
+			outputFile.close()
+	return 0
+
+if __name__ == "__main__":
+	exit(main())
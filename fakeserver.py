@@ -0,0 +1,94 @@
+# coding=utf-8
+
+from argparse import ArgumentParser, Namespace
+from os import path
+from sys import exit
+from time import sleep
+
+from core import globals
+from core.utils import ErrorLevel, Log
+from core.fakefacebook import (
+	FakeFacebook, StartFakeFacebook, FakeFacebookConfig,
+	DEFAULT_FAKE_PORT, DEFAULT_FRIEND_COUNT, DEFAULT_HOLD_TIME, DEFAULT_EVENT_RATE,
+	DEFAULT_BURST_CHANCE, DEFAULT_BURST_SIZE, DEFAULT_STICKY_INTERVAL
+)
+
+def InitArguments() -> Namespace:
+	parser = ArgumentParser(
+		prog="python " + path.basename(__file__),
+		description="Local stand-in for the facebook endpoints the monitor uses "
+		            "(/pull, user_info, tabs_presence and the fb_dtsg page). "
+		            "Point server.py at it with the printed config lines."
+	)
+	parser.add_argument(
+		"-p", "--port",
+		metavar='PORT', type=int, default=DEFAULT_FAKE_PORT,
+		help="Port to listen on (default: {})".format(DEFAULT_FAKE_PORT)
+	)
+	parser.add_argument(
+		"-f", "--friends",
+		metavar='FRIENDS', type=int, default=DEFAULT_FRIEND_COUNT,
+		help="Number of simulated friends"
+	)
+	parser.add_argument(
+		"--hold",
+		metavar='SECONDS', type=float, default=DEFAULT_HOLD_TIME,
+		help="How long an empty /pull is held open"
+	)
+	parser.add_argument(
+		"--rate",
+		metavar='MESSAGES', type=float, default=DEFAULT_EVENT_RATE,
+		help="Messages generated per second"
+	)
+	parser.add_argument(
+		"--burst-chance",
+		metavar='CHANCE', type=float, default=DEFAULT_BURST_CHANCE,
+		help="Chance of a message burst in every second"
+	)
+	parser.add_argument(
+		"--burst-size",
+		metavar='MESSAGES', type=int, default=DEFAULT_BURST_SIZE,
+		help="Messages in one burst"
+	)
+	parser.add_argument(
+		"--sticky-interval",
+		metavar='SECONDS', type=float, default=DEFAULT_STICKY_INTERVAL,
+		help="Seconds between two lb_info sticky changes"
+	)
+	parser.add_argument(
+		"--latency",
+		metavar='SECONDS', type=float, nargs=2, default=[0, 0],
+		help="Min and max extra latency of every response"
+	)
+	parser.add_argument(
+		"--error-rate",
+		metavar='RATE', type=float, default=0,
+		help="Share of the responses that fail (500, garbage or dropped connection)"
+	)
+	parser.add_argument(
+		"-l", "--log",
+		metavar='LOG_LEVEL', type=int, default=ErrorLevel.info,
+		help="0: silent, 1: error, 2: warning, 3: info (default), 4: debug"
+	)
+	return parser.parse_args()
+
+def main():
+	args = InitArguments()
+	globals.LOG_LEVEL = args.log
+	fake = FakeFacebook(
+		args.friends, holdTime=args.hold, eventRate=args.rate,
+		burstChance=args.burst_chance, burstSize=args.burst_size, stickyInterval=args.sticky_interval,
+		latency=tuple(args.latency), errorRate=args.error_rate
+	)
+	server = StartFakeFacebook(fake, args.port)
+	Log(ErrorLevel.info, "fake facebook listening, config for server.py:\n{}", FakeFacebookConfig(*server.server_address))
+	try:
+		while True:
+			sleep(1)
+	except KeyboardInterrupt:
+		fake.stop()
+		server.shutdown()
+	return 0
+
+if __name__ == "__main__":
+	exit(main())
@@ -3,10 +3,40 @@
 import sys
 import os
 import argparse
+import json
+import re
+from queue import Empty
+from threading import Thread
+from time import sleep
+from traceback import format_exc
+from datetime import datetime, timezone
+from email.utils import formatdate
 import flask
+from werkzeug.http import is_resource_modified
+
+from core import globals
+from core.utils import Log, ErrorLevel
+from core.avatars import AvatarDirectory, IsAvatarKey, GuessImageType
+from core.store import PresenceStore
+from core.storage import RecordVersion
+from core.intervals import STATES
+from core.rollups import RESOLUTIONS
+from core.bus import PresenceSubscriber, DEFAULT_BUS_PORT, IDLE_INTERVAL
+from core.export import CsvChunks, NdjsonChunks
+from core.dbcache import DatabaseCache
+
+AVATAR_MAX_AGE      = 365 * 24 * 60 * 60 # avatars are content addressed, they never change
+KEEPALIVE_INTERVAL  = 15 # seconds between two comments on an idle event stream
+# streamed export formats -> (chunk generator, mimetype, file extension), the columnar one is export.py only
+EXPORT_STREAMS      = {
+	"csv": (CsvChunks, "text/csv", "csv"),
+	"ndjson": (NdjsonChunks, "application/x-ndjson", "ndjson")
+}
 
 app = flask.Flask(__name__, static_folder="interface")
 DBPath = None # type: str
+Store = None # type: PresenceStore
+Snapshots = None # type: DatabaseCache
 
 @app.route("/")
 def root():
@@ -14,11 +44,224 @@ def root():
 
 @app.route("/db")
 def db():
-	with open(DBPath) as jsonDB:
-		return jsonDB.read()
+	# the whole db, from memory: gzipped once per version and revalidated by the
+	# clients with If-None-Match / If-Modified-Since, 304 while it is unchanged
+	snapshot = Snapshots.get()
+	headers = {
+		"ETag": '"{}"'.format(snapshot.etag),
+		"Last-Modified": formatdate(snapshot.lastModified, usegmt=True),
+		"Cache-Control": "no-cache",
+		"Vary": "Accept-Encoding",
+		"X-Presence-Version": str(snapshot.version)
+	}
+	lastModified = datetime.fromtimestamp(snapshot.lastModified, timezone.utc)
+	if not is_resource_modified(flask.request.environ, etag=snapshot.etag, last_modified=lastModified):
+		return flask.Response(status=304, headers=headers)
+	if flask.request.accept_encodings["gzip"] > 0:
+		headers["Content-Encoding"] = "gzip"
+		return flask.Response(snapshot.gzipped, mimetype="application/json", headers=headers)
+	return flask.Response(snapshot.json(), mimetype="application/json", headers=headers)
+
+def GetListArgument(name: str):
+	value = flask.request.args.get(name)
+	if not value:
+		return None
+	return [item for item in value.split(",") if item]
+
+def GetIntArgument(name: str):
+	value = flask.request.args.get(name)
+	if not value:
+		return None
+	try:
+		return int(value)
+	except ValueError:
+		flask.abort(400)
+
+def GetWidthArgument():
+	width = GetIntArgument("width")
+	if width is not None and width <= 0:
+		flask.abort(400)
+	return width
+
+def GetFilterArguments() -> dict:
+	# ?users=uid1,uid2 &regex=name &states=online,mobile &from=epoch &to=epoch
+	states = GetListArgument("states")
+	if (states is not None) and any(state not in STATES for state in states):
+		flask.abort(400)
+	regex = flask.request.args.get("regex") or None
+	if regex is not None:
+		try:
+			re.compile(regex)
+		except re.error:
+			flask.abort(400)
+	return {
+		"users": GetListArgument("users"),
+		"regex": regex,
+		"states": states,
+		"fromTs": GetIntArgument("from"),
+		"toTs": GetIntArgument("to")
+	}
+
+def VersionedResponse(result: dict, version: int) -> flask.Response:
+	response = flask.Response(json.dumps(result), mimetype="application/json")
+	response.headers["X-Presence-Version"] = str(version)
+	return response
+
+@app.route("/query")
+def query():
+	# &width=pixels: intervals closer than a pixel come merged, from an hourly or daily
+	# rollup when the range is long, so the payload doesn't grow with the range
+	filters = GetFilterArguments()
+	return VersionedResponse(*Store.query(width=GetWidthArgument(), **filters))
+
+@app.route("/rollups")
+def rollups():
+	# ?resolution=hour|day plus the filters of /query
+	resolution = flask.request.args.get("resolution", "hour")
+	if resolution not in RESOLUTIONS:
+		flask.abort(400)
+	return VersionedResponse(*Store.rollupBuckets(resolution, **GetFilterArguments()))
+
+@app.route("/at")
+def at():
+	# ?t=timestamp &states=online,mobile: who was in which state at t
+	timeStamp = GetIntArgument("t")
+	if timeStamp is None:
+		flask.abort(400)
+	return VersionedResponse(*Store.usersAt(timeStamp, GetFilterArguments()["states"]))
+
+@app.route("/overlap")
+def overlap():
+	# ?from=epoch &to=epoch &states=...: every interval overlapping the range, by state and uid
+	filters = GetFilterArguments()
+	return VersionedResponse(*Store.overlapping(filters["states"], filters["fromTs"], filters["toTs"]))
+
+@app.route("/copresence")
+def copresence():
+	# ?users=uid1,uid2 &states=online &from=epoch &to=epoch: time the two spent in the state together
+	filters = GetFilterArguments()
+	users = filters["users"]
+	states = filters["states"] or ["online"]
+	if users is None or len(users) != 2 or len(states) != 1:
+		flask.abort(400)
+	result = Store.coPresence(users[0], users[1], states[0], filters["fromTs"], filters["toTs"])
+	if result is None:
+		flask.abort(404)
+	return flask.Response(json.dumps(result), mimetype="application/json")
+
+@app.route("/export")
+def export():
+	# ?format=csv|ndjson plus the filters of /query: flat uid,state,start,end rows streamed
+	# as they are read, the archive is included when the range reaches back into it
+	exportFormat = flask.request.args.get("format", "csv")
+	if exportFormat not in EXPORT_STREAMS:
+		flask.abort(400)
+	chunks, mimetype, extension = EXPORT_STREAMS[exportFormat]
+	return flask.Response(
+		chunks(Store.exportRows(**GetFilterArguments())),
+		mimetype=mimetype,
+		headers={ "Content-Disposition": "attachment; filename=presence.{}".format(extension) }
+	)
+
+@app.route("/changes")
+def changes():
+	# ?since=version plus the filters of /query
+	# the client merges the changes into what it got from /query, or queries again on reset
+	since = GetIntArgument("since")
+	if since is None:
+		flask.abort(400)
+	result = Store.changesSince(since, **GetFilterArguments())
+	if result is None:
+		result = { "version": Store.version, "reset": True }
+	return flask.Response(json.dumps(result), mimetype="application/json")
+
+def EventMessage(event: str, data: dict, eventId: int = None) -> str:
+	message = "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+	if eventId is not None:
+		message = "id: {}\n".format(eventId) + message
+	return message
+
+@app.route("/events")
+def events():
+	# server-sent events with the filters of /query: a "snapshot" (or the "changes"
+	# since the Last-Event-ID / ?since= cursor) followed by live "changes".
+	# "reset" tells the client to reconnect without a cursor
+	filters = GetFilterArguments()
+	width = GetWidthArgument()
+	since = GetIntArgument("since")
+	lastEventId = flask.request.headers.get("Last-Event-ID")
+	if lastEventId is not None and lastEventId.isdigit():
+		since = int(lastEventId)
+	# subscribe first so nothing gets lost between the snapshot and the stream
+	subscription = Store.subscribe()
+
+	def stream():
+		try:
+			initial = Store.changesSince(since, **filters) if since is not None else None
+			if initial is None:
+				result, version = Store.query(width=width, **filters)
+				yield EventMessage("snapshot", { "version": version, "users": result }, version)
+			else:
+				version = initial["version"]
+				yield EventMessage("changes", initial, version)
+			while True:
+				try:
+					record = subscription.queue.get(timeout=KEEPALIVE_INTERVAL)
+				except Empty:
+					record = None
+				# a reload marks it too, with nothing queued: checked before the keepalive
+				if subscription.overflowed:
+					yield EventMessage("reset", { "version": Store.version })
+					return
+				if record is None:
+					yield ": keepalive\n\n"
+					continue
+				recordVersion = RecordVersion(record)
+				if recordVersion <= version:
+					continue
+				version = recordVersion
+				with Store.lock:
+					change = Store.filterChanges([record], **filters)
+				if len(change["changes"]) != 0:
+					change["version"] = version
+					yield EventMessage("changes", change, version)
+		finally:
+			Store.unsubscribe(subscription)
+
+	return flask.Response(
+		stream(),
+		mimetype="text/event-stream",
+		headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" }
+	)
+
+@app.route("/avatar/<key>")
+def avatar(key: str):
+	if not IsAvatarKey(key):
+		flask.abort(404)
+	avatarPath = os.path.join(AvatarDirectory(DBPath), key)
+	if not os.path.exists(avatarPath):
+		flask.abort(404)
+	with open(avatarPath, 'rb') as avatarFile:
+		imageBin = avatarFile.read()
+	response = flask.make_response(imageBin)
+	response.headers["Content-Type"] = GuessImageType(imageBin)
+	response.headers["Cache-Control"] = "public, max-age={}, immutable".format(AVATAR_MAX_AGE)
+	response.headers["ETag"] = '"{}"'.format(key)
+	return response
+
+def RefreshLoop():
+	# without the bus nothing tells the store about new records, the journal is tailed
+	# as often as an idle subscriber would do it so /events keeps pushing changes
+	while True:
+		sleep(IDLE_INTERVAL)
+		try:
+			Store.refresh()
+		except:
+			Log(ErrorLevel.warning, "refresh failed: {}", format_exc())
 
 def main():
-	global DBPath
+	global DBPath, Store, Snapshots
+	globals.LOG_LEVEL = ErrorLevel.warning
 	parser = argparse.ArgumentParser(
 		prog="python " + os.path.basename(__file__),
 		description="Description of the program",
@@ -29,9 +272,21 @@ def main():
 		metavar='DB_FILE', nargs=1, required=True,
 		help="Path to the database file"
 	)
+	parser.add_argument(
+		"-b", "--bus-port",
+		metavar='PORT', type=int, default=DEFAULT_BUS_PORT,
+		help="Local udp port the monitor publishes presence changes to (0: disabled)"
+	)
 	args = parser.parse_args()
 	DBPath = args.db[0]
-	app.run(host="0.0.0.0")
+	Store = PresenceStore(DBPath)
+	Snapshots = DatabaseCache(Store)
+	if args.bus_port != 0:
+		PresenceSubscriber(Store.applyLive, Store.refresh, port=args.bus_port).start()
+	else:
+		Thread(target=RefreshLoop, name="store-refresh", daemon=True).start()
+	# event streams hold a request open, every client needs its own thread
+	app.run(host="0.0.0.0", threaded=True)
 
 if __name__ == "__main__":
 	sys.exit(main())
\ No newline at end of file
@@ -23,7 +23,9 @@
     setInterval(function (){
         countdown = new Date(0);
         countdown.setMilliseconds(timeToCountDown);
-        $update.click();
+        if (!window.eventStream) {
+            updateChanges();
+        }
     }, timeToCountDown);
 
     // "start" website
@@ -31,38 +33,150 @@
     updateDataAndShow();
 })();
 
+function getQueryParameters() {
+    // filtering happens on the server, only the matching intervals are downloaded
+    var properties = window.currentProperties;
+    var parameters = {};
+    if (properties.states.length != 0){
+        parameters.states = properties.states.join(",");
+    }
+    if (properties.regex){
+        parameters.regex = properties.regex;
+    }
+    if (properties.from != null){
+        parameters.from = properties.from;
+    }
+    if (properties.to != null){
+        parameters.to = properties.to;
+    }
+    // intervals shorter than a pixel apart come merged
+    parameters.width = getChartWidth();
+    return parameters;
+}
+
+function mergeChanges(data) {
+    for (var uid in data.users) {
+        if (myJsonData[uid] === undefined) {
+            myJsonData[uid] = {
+                fullname: data.users[uid].fullname,
+                image: data.users[uid].image,
+                online: [], active: [], mobile: []
+            };
+        }
+    }
+    for (var change of data.changes) {
+        applyChange(change);
+    }
+    window.myJsonDataUsers = Object.keys(myJsonData).sort();
+    window.myJsonDataVersion = data.version;
+}
+
+function scheduleRedraw() {
+    // a burst of pushed changes is drawn once
+    if (!window.redrawTimer) {
+        window.redrawTimer = setTimeout(function () {
+            window.redrawTimer = null;
+            createGanttDiagram();
+        }, 1000);
+    }
+}
+
+function openEventStream() {
+    // live changes pushed by the server, the browser resumes from the last event id
+    if (window.eventStream) {
+        window.eventStream.close();
+    }
+    var stream = new EventSource("/events?" + $.param(getQueryParameters()));
+    stream.addEventListener("snapshot", function (event) {
+        var data = JSON.parse(event.data);
+        window.myJsonData = data.users;
+        window.myJsonDataUsers = Object.keys(data.users).sort();
+        window.myJsonDataVersion = data.version;
+        createGanttDiagram();
+    });
+    stream.addEventListener("changes", function (event) {
+        mergeChanges(JSON.parse(event.data));
+        scheduleRedraw();
+    });
+    stream.addEventListener("reset", function () {
+        openEventStream();
+    });
+    window.eventStream = stream;
+}
+
 function updateDataAndShow() {
-    $.getJSON("/db", function (data) {
+    if (window.EventSource) {
+        return openEventStream();
+    }
+    $.getJSON("/query", getQueryParameters(), function (data, status, xhr) {
         window.myJsonData = data;
         window.myJsonDataUsers = Object.keys(data).sort();
+        window.myJsonDataVersion = parseInt(xhr.getResponseHeader("X-Presence-Version"));
         createGanttDiagram();
     });
 }
 
+function applyChange(change) {
+    // same semantics as the journal records on the server
+    var user = myJsonData[change.uid];
+    if (change.type == "user") {
+        user.fullname = change.fullname;
+        user.image = change.image;
+        return;
+    }
+    if (user[change.state] === undefined) {
+        return; // state filtered out
+    }
+    var intervals = user[change.state];
+    var last = intervals.length != 0 ? intervals[intervals.length - 1] : null;
+    if (change.type == "open") {
+        if (last == null || last[0] < change.start) {
+            intervals.push([change.start, null]);
+        }
+    } else if (change.type == "interval") {
+        if (last != null && last[0] == change.start && last[1] == null) {
+            last[1] = change.end;
+        } else if (last == null || last[0] < change.start) {
+            intervals.push([change.start, change.end]);
+        }
+    } else if (change.type == "drop") {
+        if (last != null && last[0] == change.start && last[1] == null) {
+            intervals.pop();
+        }
+    }
+}
+
+function updateChanges() {
+    // only what changed since the last download, merged into the cached data
+    if (window.myJsonDataVersion === undefined || isNaN(myJsonDataVersion)) {
+        return updateDataAndShow();
+    }
+    var parameters = getQueryParameters();
+    parameters.since = myJsonDataVersion;
+    $.getJSON("/changes", parameters, function (data) {
+        if (data.reset) {
+            return updateDataAndShow();
+        }
+        mergeChanges(data);
+        if (data.changes.length != 0) {
+            createGanttDiagram();
+        }
+    });
+}
+
 function getLabelData(rawData) {
     var properties = window.currentProperties;
     var states = ["online", "active", "mobile"];
     var users = Object.keys(rawData).sort();
-    var epochMin = 0;
-    var epochMax = 1e12;
     if (properties.states.length != 0){
         states = properties.states;
     }
-    if (properties.users.length != 0){
-        users = properties.users;
-    }
-    if (properties.from != null){
-        epochMin = properties.from;
-    }
-    if (properties.to != null){
-        epochMax = properties.to;
-    }
     var labelData = [];
     for (var user of users) {
         for (var state of states) {
             var userStateTimes = [];
             for (var interval of rawData[user][state]) {
-                if (interval[0] >= epochMin && interval[1] <= epochMax){
+                if (interval[1] != null){
                     userStateTimes.push({
                             "starting_time": (interval[0] - 3600) * 1000,
                             "ending_time": (interval[1] - 3600) * 1000
@@ -73,7 +187,7 @@ function getLabelData(rawData) {
                 labelData.push({
                     color: state,
                     label: rawData[user]["fullname"] + " "  + ["","👁","📱"][states.indexOf(state)],
-                    icon: "data:image/png;base64," + rawData[user].image,
+                    icon: rawData[user].image ? "/avatar/" + rawData[user].image : "/interface/logo.png",
                     times: userStateTimes
                 });
             }
@@ -82,11 +196,15 @@ function getLabelData(rawData) {
     return labelData;
 }
 
+function getChartWidth() {
+    return (window.innerWidth * .9) | 0;
+}
+
 function createGanttDiagram() {
     var labelData = getLabelData(myJsonData);
     var colorScale = d3.scale.ordinal().range(['#999', '#2b0', '#59f'])
         .domain(['online', 'active', 'mobile']);
-    var width = (window.innerWidth * .9) | 0;
+    var width = getChartWidth();
     var chart = d3.timeline()
         .width(width)
         .stack()
@@ -143,7 +261,7 @@ function createGanttDiagram() {
 function resetProperties() {
     window.currentProperties = {
         states: [],
-        users: [],
+        regex: "",
         from: null,
         to: null,
         tickFormat: "%a. %H:%M",
@@ -154,7 +272,7 @@ function resetProperties() {
 
 function resetFilterAction() {
     resetProperties();
-    createGanttDiagram();
+    updateDataAndShow();
 }
 
 function filterDataAction() {
@@ -175,9 +293,6 @@ function filterDataAction() {
     if (online) states.push("online");
     if (active) states.push("active");
     if (mobile) states.push("mobile");
-    var users = myJsonDataUsers.filter(function(userName){
-        return new RegExp(regexText, "g").test(userName);
-    });
 
     // get view settings
     var propArray = [
@@ -204,12 +319,12 @@ function filterDataAction() {
     }
     window.currentProperties = {
         states: states,
-        users: users,
+        regex: regexText,
         from: epochStart,
         to: epochEnd,
         tickFormat: tickFormat,
         tickType: tickType,
         tickFreq: tickFreq
     };
-    createGanttDiagram();
+    updateDataAndShow();
 }
\ No newline at end of file
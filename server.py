@@ -10,27 +10,46 @@ from time import sleep
 
 from core import globals
 from core.utils import ErrorLevel, Log
-from core.monitor import PresenceMonitor
+from core.monitor import PresenceMonitor, DatabaseLoadError, DEFAULT_DB_PATH
 
 def StartPresenceMonitor(args: Namespace):
 	if args.log is not None:
 		globals.LOG_LEVEL = int(args.log[0])
+	if len(args.config) > 1:
+		# one monitor process per account, merged into one db
+		# (the optional engines are imported when they are used, startup only pays for the one it runs)
+		from core.supervisor import Supervisor
+		globals.RUN_PROGRAM = True
+		Supervisor(args.config, args.db[0] if args.db is not None else DEFAULT_DB_PATH).run()
+		return
 	args.config = args.config[0]
-	if args.db is None:
-		pm = PresenceMonitor(args.config)
-	else:
-		pm = PresenceMonitor(args.config, args.db)
+	# the db is read in the background while the first /pull is on its way
+	pm = PresenceMonitor(args.config, args.db[0] if args.db is not None else DEFAULT_DB_PATH, loadInBackground=True)
+	if args.record is not None:
+		from core.replay import FeedRecorder
+		pm.recorder = FeedRecorder(args.record[0])
+	globals.RUN_PROGRAM = True
+	if args.asyncEngine:
+		from core.asyncmonitor import StartAsyncPresenceMonitor
+		StartAsyncPresenceMonitor(pm)
+		return
+	if args.pipeline:
+		from core.pipeline import StartPresencePipeline
+		StartPresencePipeline(pm)
+		return
 	counter = 0
 	saveCount = 10 # db save frequency
-	sleepTime = 2  # sleep between two monitor action
-	globals.RUN_PROGRAM = True
+	sleepTime = 2  # sleep between two monitor action (none in stream mode, the stream waits itself)
 	while globals.RUN_PROGRAM:
 		try:
 			pm.query()
 			counter = (counter + 1) % saveCount
 			if counter == 0:
 				pm.saveDB()
-			sleep(sleepTime)
+			sleep(pm.nextCycleDelay(sleepTime))
+		except DatabaseLoadError:
+			# there is nothing to monitor into, stop like a failed load at startup
+			raise
 		except:
 			Log(ErrorLevel.warning, "{}", format_exc())
 			pm.resetParameters()
@@ -45,8 +64,9 @@ def InitArguments() -> List[List[str]]:
 	)
 	parser.add_argument(
 		"-c", "--config",
-		metavar='CONFIG_FILE', nargs=1, required=True,
-		help="Path to the config file"
+		metavar='CONFIG_FILE', nargs='+', required=True,
+		help="Path to the config file, with several files every account runs in its own "
+		     "process and their friends are merged into one db"
 	)
 	parser.add_argument(
 		"-d", "--db",
@@ -58,6 +78,23 @@ def InitArguments() -> List[List[str]]:
 		metavar='LOG_LEVEL', nargs=1, required=False,
 		help="0: silent, 1: error, 2: warning (default), 3: info, 4: debug"
 	)
+	parser.add_argument(
+		"-r", "--record",
+		metavar='RECORD_FILE', nargs=1, required=False,
+		help="Append every raw /pull response to this file (replay it with benchmark.py)"
+	)
+	parser.add_argument(
+		"-a", "--async",
+		dest="asyncEngine", action="store_true",
+		help="Use the asyncio engine: the long-poll, presence queries, "
+		     "profile lookups and saves run concurrently"
+	)
+	parser.add_argument(
+		"-p", "--pipeline",
+		action="store_true",
+		help="Run the monitor as a pipeline of threads connected by bounded queues: "
+		     "fetching, decoding, state updates and saving never wait for each other"
+	)
 	return parser.parse_args()
 
 def main():
@@ -0,0 +1,12 @@
+# coding=utf-8
+
+import sys
+from os.path import dirname, abspath
+
+# the modules import each other as core.*, from the root of the repository
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import globals
+from core.utils import ErrorLevel
+
+globals.LOG_LEVEL = ErrorLevel.warning
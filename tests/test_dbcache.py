@@ -0,0 +1,86 @@
+# coding=utf-8
+
+import gzip
+import json
+import pytest
+
+from core.dbcache import DatabaseCache
+from core.store import PresenceStore
+from core.storage import DumpDatabase, RECORD_OPEN, RECORD_INTERVAL, JOURNAL_SUFFIX
+
+def AppendRecords(dbPath: str, records: list):
+	with open(dbPath + JOURNAL_SUFFIX, 'a') as journalFile:
+		for record in records:
+			journalFile.write(json.dumps(record) + "\n")
+
+@pytest.fixture
+def store(tmp_path):
+	dbPath = str(tmp_path / "db.json")
+	AppendRecords(dbPath, [[RECORD_OPEN, "1", "online", 100, 1]])
+	store = PresenceStore(dbPath)
+	store.refresh()
+	return store
+
+def test_built_once_per_version(store):
+	cache = DatabaseCache(store)
+	snapshot = cache.get()
+	assert snapshot.version == 1
+	assert json.loads(gzip.decompress(snapshot.gzipped)) == json.loads(DumpDatabase(store.db))
+	assert snapshot.json() == gzip.decompress(snapshot.gzipped)
+	assert cache.get() is snapshot
+
+def test_requests_dont_read_the_disk(store):
+	cache = DatabaseCache(store)
+	cache.get()
+	def Refresh():
+		raise AssertionError("refreshed by a request")
+	store.refresh = Refresh
+	cache.get()
+
+def test_new_version_new_etag(store):
+	cache = DatabaseCache(store)
+	first = cache.get()
+	AppendRecords(store.dbPath, [[RECORD_INTERVAL, "1", "online", 100, 150, 2]])
+	store.refresh()
+	second = cache.get()
+	assert second.version == 2
+	assert second.etag != first.etag
+	# never the same second twice, If-Modified-Since would miss the change
+	assert second.lastModified > first.lastModified
+
+def test_same_content_keeps_the_etag(store):
+	cache = DatabaseCache(store)
+	first = cache.get()
+	# a reload changes the key, not the content
+	with store.lock:
+		store.load()
+	second = cache.get()
+	assert second is not first
+	assert (second.etag, second.lastModified) == (first.etag, first.lastModified)
+
+@pytest.fixture
+def client(store, monkeypatch):
+	pytest.importorskip("flask")
+	import interface
+	monkeypatch.setattr(interface, "Store", store)
+	monkeypatch.setattr(interface, "Snapshots", DatabaseCache(store))
+	return interface.app.test_client()
+
+def test_db_endpoint(client, store):
+	response = client.get("/db", headers={"Accept-Encoding": "gzip"})
+	assert response.status_code == 200
+	assert response.headers["Content-Encoding"] == "gzip"
+	assert response.headers["X-Presence-Version"] == "1"
+	assert json.loads(gzip.decompress(response.data)) == json.loads(DumpDatabase(store.db))
+	etag, lastModified = response.headers["ETag"], response.headers["Last-Modified"]
+	assert client.get("/db", headers={"If-None-Match": etag}).status_code == 304
+	assert client.get("/db", headers={"If-Modified-Since": lastModified}).status_code == 304
+	# without gzip
+	plain = client.get("/db")
+	assert "Content-Encoding" not in plain.headers
+	assert json.loads(plain.data) == json.loads(DumpDatabase(store.db))
+	AppendRecords(store.dbPath, [[RECORD_INTERVAL, "1", "online", 100, 150, 2]])
+	store.refresh()
+	changed = client.get("/db", headers={"If-None-Match": etag, "If-Modified-Since": lastModified})
+	assert changed.status_code == 200
+	assert changed.headers["ETag"] != etag
@@ -0,0 +1,75 @@
+# coding=utf-8
+
+import json
+import pytest
+
+from core.feedstream import FrameParser, FeedStream, DecodeFrame, FRAME_PREFIX
+
+PAYLOADS = [
+	{"t": "msg", "ms": [{"type": "buddylist_overlay", "overlay": {"1": {"a": 2}}}]},
+	{"t": "msg", "ms": [{"text": "braces } { and \"quotes\" in a string \\"}]},
+	{"t": "msg", "ms": [{"name": "árvíztűrő tükörfúrógép ☃"}]},
+	{"t": "heartbeat"},
+]
+
+def Body(payloads) -> bytes:
+	return b"".join(FRAME_PREFIX + json.dumps(payload, ensure_ascii=False).encode('utf-8') + b"\r\n" for payload in payloads)
+
+def Parse(chunks) -> list:
+	parser = FrameParser()
+	return [DecodeFrame(frame) for chunk in chunks for frame in parser.feed(chunk)]
+
+def test_whole_body():
+	assert Parse([Body(PAYLOADS)]) == PAYLOADS
+
+def test_every_split_point():
+	# the prefix, a string, an escape, a multi-byte character or a brace can all be cut in two
+	body = Body(PAYLOADS)
+	for cut in range(len(body) + 1):
+		assert Parse([body[:cut], body[cut:]]) == PAYLOADS, cut
+
+def test_byte_by_byte():
+	body = Body(PAYLOADS)
+	assert Parse([body[i:i + 1] for i in range(len(body))]) == PAYLOADS
+
+def test_frames_are_handed_out_as_soon_as_they_are_closed():
+	parser = FrameParser()
+	first, second = Body(PAYLOADS[:1]), Body(PAYLOADS[1:2])
+	assert len(parser.feed(first + second[:5])) == 1
+	assert len(parser.feed(second[5:])) == 1
+	assert parser.feed(b"") == []
+
+def test_frames_without_prefix():
+	assert Parse([b'{"a": 1} {"b": {"c": 2}}']) == [{"a": 1}, {"b": {"c": 2}}]
+
+def test_garbage_between_frames():
+	with pytest.raises(ValueError):
+		Parse([Body(PAYLOADS[:1]) + b"<html>"])
+
+class ChunkedResponse:
+	# what FeedStream reads from a streamed requests response
+
+	def __init__(self, chunks):
+		self.chunks = chunks
+		self.closed = False
+
+	def iter_content(self, chunk_size=None):
+		return iter(self.chunks)
+
+	def close(self):
+		self.closed = True
+
+def test_feed_stream():
+	body = Body(PAYLOADS)
+	response = ChunkedResponse([body[i:i + 7] for i in range(0, len(body), 7)])
+	stream = FeedStream(response)
+	frames = []
+	frame = stream.nextFrame()
+	while frame is not None:
+		frames.append(DecodeFrame(frame))
+		frame = stream.nextFrame()
+	assert frames == PAYLOADS
+	assert stream.frameCount == len(PAYLOADS)
+	assert stream.byteCount == len(body)
+	stream.close()
+	assert response.closed
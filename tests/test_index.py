@@ -0,0 +1,127 @@
+# coding=utf-8
+
+from random import Random
+
+from core.index import IntervalIndex, PresenceIndex, CoPresence
+from core.intervals import IntervalList, UserRecord, STATES
+from core.storage import ApplyRecord, RECORD_OPEN, RECORD_INTERVAL, RECORD_DROP
+from core.archive import DropExpired
+
+def Found(index: IntervalIndex, fromTs: int = None, toTs: int = None) -> list:
+	return [(index.owners[position],) + index.interval(position) for position in index.search(fromTs, toTs)]
+
+def test_search():
+	index = IntervalIndex()
+	index.add(0, 10, 20)
+	index.add(1, 15, 30)
+	index.add(0, 40)
+	assert Found(index, 21, 35) == [(1, 15, 30)]
+	assert Found(index, 20, 20) == [(0, 10, 20), (1, 15, 30)]
+	assert Found(index, 1000, 2000) == [(0, 40, None)]
+	assert Found(index, 0, 5) == []
+	assert Found(index) == [(0, 10, 20), (1, 15, 30), (0, 40, None)]
+
+def test_leaves_are_kept_in_start_order():
+	index = IntervalIndex()
+	for start in [50, 10, 30, 20, 40]:
+		index.add(start, start, start + 5)
+	assert [start for owner, start, end in Found(index)] == [10, 20, 30, 40, 50]
+	assert Found(index, 32, 42) == [(30, 30, 35), (40, 40, 45)]
+
+def test_close_and_remove():
+	index = IntervalIndex()
+	index.add(0, 10)
+	index.add(1, 10)
+	index.add(2, 5, 8)
+	index.close(1, 10, 12)
+	assert Found(index, 20, 30) == [(0, 10, None)]
+	index.remove(0, 10)
+	assert Found(index) == [(2, 5, 8), (1, 10, 12)]
+	# nothing there to close
+	index.close(0, 10, 15)
+	assert Found(index) == [(2, 5, 8), (1, 10, 12)]
+
+def test_drop_before():
+	index = IntervalIndex()
+	index.add(0, 10, 20)
+	index.add(1, 15)
+	index.add(2, 18, 40)
+	index.add(3, 50, 60)
+	index.dropBefore(30)
+	assert len(index) == 3
+	assert Found(index) == [(1, 15, None), (2, 18, 40), (3, 50, 60)]
+
+def test_matches_a_scan():
+	random = Random(1)
+	index = IntervalIndex()
+	intervals = []
+	for owner in range(1000):
+		start = random.randint(0, 100000)
+		end = None if random.random() < 0.05 else start + random.randint(0, 1000)
+		index.add(owner, start, end)
+		intervals.append((owner, start, end))
+	cutoff = 20000
+	index.dropBefore(cutoff)
+	intervals = [interval for interval in intervals if interval[2] is None or interval[2] >= cutoff]
+	for _ in range(200):
+		fromTs, toTs = sorted([random.randint(0, 110000), random.randint(0, 110000)])
+		expected = [
+			interval for interval in intervals
+			if interval[1] <= toTs and (interval[2] is None or interval[2] >= fromTs)
+		]
+		assert sorted(Found(index, fromTs, toTs)) == sorted(expected)
+
+def ApplyToBoth(db: dict, presenceIndex: PresenceIndex, record: list):
+	ApplyRecord(db, record)
+	presenceIndex.applyRecord(record)
+
+def test_presence_index_follows_the_records():
+	db = {uid: UserRecord() for uid in ["1", "2"]}
+	presenceIndex = PresenceIndex()
+	for record in [
+		[RECORD_OPEN, "1", "online", 100, 1],
+		[RECORD_OPEN, "2", "online", 110, 2],
+		[RECORD_INTERVAL, "1", "online", 100, 150, 3],
+		[RECORD_OPEN, "1", "online", 200, 4],
+		[RECORD_DROP, "2", "online", 110, 5],
+		# applied already
+		[RECORD_INTERVAL, "1", "online", 100, 150, 3],
+	]:
+		ApplyToBoth(db, presenceIndex, record)
+	assert presenceIndex.overlapping("online") == {"1": [[100, 150], [200, None]]}
+	assert presenceIndex.usersAt("online", 120) == ["1"]
+	assert presenceIndex.usersAt("online", 170) == []
+	assert presenceIndex.overlapping("online") == PresenceIndex.fromDatabase(db).overlapping("online")
+
+def test_presence_index_trimmed_like_the_db():
+	random = Random(2)
+	db = {uid: UserRecord() for uid in map(str, range(5))}
+	presenceIndex = PresenceIndex()
+	timeStamp, version = 0, 0
+	for _ in range(2000):
+		uid, state = str(random.randint(0, 4)), random.choice(STATES)
+		timeStamp += random.randint(1, 30)
+		version += 1
+		intervals = db[uid][state]
+		if not intervals.isLastOpen():
+			record = [RECORD_OPEN, uid, state, timeStamp, version]
+		elif random.random() < 0.9:
+			record = [RECORD_INTERVAL, uid, state, intervals.lastStart(), timeStamp, version]
+		else:
+			record = [RECORD_DROP, uid, state, intervals.lastStart(), version]
+		ApplyToBoth(db, presenceIndex, record)
+		if random.random() < 0.01:
+			cutoff = timeStamp - random.randint(0, 2000)
+			DropExpired(db, cutoff)
+			presenceIndex.dropBefore(cutoff)
+	rebuilt = PresenceIndex.fromDatabase(db)
+	for state in STATES:
+		assert presenceIndex.overlapping(state) == rebuilt.overlapping(state)
+		for fromTs in range(0, timeStamp, 500):
+			assert presenceIndex.overlapping(state, fromTs, fromTs + 250) == rebuilt.overlapping(state, fromTs, fromTs + 250)
+
+def test_co_presence():
+	first = IntervalList.fromList([[10, 20], [30, 40], [50, None]])
+	second = IntervalList.fromList([[15, 35], [55, 58]])
+	assert CoPresence(first, second, now=100) == (5 + 5 + 3, [[15, 20], [30, 35], [55, 58]])
+	assert CoPresence(first, second, now=100, fromTs=18, toTs=32) == (2 + 2, [[18, 20], [30, 32]])
@@ -0,0 +1,67 @@
+# coding=utf-8
+
+from core.intervals import IntervalList, UserRecord, OPEN_END
+
+CLOSED = [[10, 20], [30, 40], [50, 60]]
+
+def test_round_trip():
+	intervals = IntervalList.fromList(CLOSED + [[70, None]])
+	assert intervals.toList() == CLOSED + [[70, None]]
+	assert intervals[3] == (70, None)
+	assert intervals.ends[3] == OPEN_END
+	assert list(intervals) == [(10, 20), (30, 40), (50, 60), (70, None)]
+
+def test_open_interval():
+	intervals = IntervalList.fromList(CLOSED)
+	assert not intervals.isLastOpen()
+	intervals.appendOpen(70)
+	assert intervals.isLastOpen() and intervals.lastStart() == 70
+	intervals.closeLast(80)
+	assert intervals.toList() == CLOSED + [[70, 80]]
+	intervals.appendOpen(90)
+	intervals.popOpen()
+	assert intervals.toList() == CLOSED + [[70, 80]]
+	intervals.popOpen()
+	assert len(intervals) == 4
+
+def test_slice():
+	intervals = IntervalList.fromList(CLOSED)
+	assert intervals.slice().toList() == CLOSED
+	assert intervals.slice(35, 55).toList() == [[30, 40], [50, 60]]
+	# the bounds touch the intervals
+	assert intervals.slice(20, 30).toList() == [[10, 20], [30, 40]]
+	assert intervals.slice(21, 29).toList() == []
+	assert intervals.slice(None, 15).toList() == [[10, 20]]
+	assert intervals.slice(55, None).toList() == [[50, 60]]
+	assert intervals.slice(61, 100).toList() == []
+	assert intervals.slice(0, 5).toList() == []
+
+def test_slice_with_the_ongoing_interval():
+	intervals = IntervalList.fromList(CLOSED + [[70, None]])
+	assert intervals.slice(1000, 2000).toList() == [[70, None]]
+	assert intervals.slice(65, 69).toList() == []
+	assert intervals.slice(55, 75).toList() == [[50, 60], [70, None]]
+
+def test_slice_of_an_empty_list():
+	assert IntervalList().slice(0, 10).toList() == []
+
+def test_drop_before():
+	intervals = IntervalList.fromList(CLOSED + [[70, None]])
+	assert intervals.dropBefore(40).toList() == [[10, 20]]
+	assert intervals.toList() == [[30, 40], [50, 60], [70, None]]
+	# the ongoing interval stays, whatever the cutoff
+	assert intervals.dropBefore(1000).toList() == [[30, 40], [50, 60]]
+	assert intervals.toList() == [[70, None]]
+
+def test_copy_is_independent():
+	intervals = IntervalList.fromList(CLOSED)
+	copy = intervals.copy()
+	copy.append(70, 80)
+	assert copy != intervals and len(intervals) == 3
+
+def test_user_record_round_trip():
+	userDict = {
+		"online": CLOSED, "active": [[10, 15]], "mobile": [[50, None]],
+		"fullname": "name", "image": None, "thumbnail": "http://thumbnail"
+	}
+	assert UserRecord.fromDict(userDict).toDict() == userDict
@@ -0,0 +1,45 @@
+# coding=utf-8
+
+from core.intervals import MergeIntervals
+from core.rollups import Rollups, PickResolution, RAW_RESOLUTION
+from core.storage import RECORD_OPEN, RECORD_INTERVAL
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+def test_merge_intervals():
+	assert MergeIntervals([[10, 20], [25, 30], [40, 50]], 10) == [[10, 30], [40, 50]]
+	assert MergeIntervals([[10, 20], [22, 30], [31, 35]], 5) == [[10, 35]]
+	assert MergeIntervals([[10, 50], [20, 30]], 5) == [[10, 50]]
+
+def test_merge_keeps_the_ongoing_interval():
+	assert MergeIntervals([[10, 20], [22, None]], 10) == [[10, 20], [22, None]]
+
+def test_pick_resolution():
+	assert PickResolution(1000, 1000) == (RAW_RESOLUTION, 1)
+	assert PickResolution(100 * DAY, 1000)[0] == "day"
+	assert PickResolution(2 * DAY, 1000)[0] == "hour"
+
+def test_buckets_and_merged():
+	rollups = Rollups()
+	rollups.applyRecord([RECORD_INTERVAL, "1", "online", HOUR - 60, HOUR + 60, 1])
+	rollups.applyRecord([RECORD_INTERVAL, "1", "online", HOUR + 90, HOUR + 120, 2])
+	# ongoing and replayed intervals don't count
+	rollups.applyRecord([RECORD_OPEN, "1", "online", HOUR + 200, 3])
+	rollups.applyRecord([RECORD_INTERVAL, "1", "online", HOUR + 90, HOUR + 120, 2])
+	assert rollups.buckets("hour", "1", "online") == [[0, 60, 1, HOUR - 60, HOUR], [HOUR, 90, 1, HOUR, HOUR + 120]]
+	assert rollups.merged("hour", "1", "online").toList() == [[HOUR - 60, HOUR + 120]]
+	assert rollups.buckets("hour", "1", "online", HOUR, None) == [[HOUR, 90, 1, HOUR, HOUR + 120]]
+	assert rollups.buckets("day", "2", "online") == []
+
+def test_drop_before():
+	rollups = Rollups()
+	rollups.applyRecord([RECORD_INTERVAL, "1", "online", 0, 60, 1])
+	rollups.applyRecord([RECORD_INTERVAL, "1", "online", 3 * HOUR, 3 * HOUR + 60, 2])
+	rollups.applyRecord([RECORD_INTERVAL, "2", "online", 0, 60, 3])
+	rollups.dropBefore(2 * HOUR)
+	assert rollups.buckets("hour", "1", "online") == [[3 * HOUR, 60, 1, 3 * HOUR, 3 * HOUR + 60]]
+	assert rollups.merged("hour", "1", "online").toList() == [[3 * HOUR, 3 * HOUR + 60]]
+	# the day bucket is still going on
+	assert len(rollups.buckets("day", "1", "online")) == 1
+	assert ("2", "online") not in rollups.rollups["hour"]
@@ -0,0 +1,96 @@
+# coding=utf-8
+
+from core.scheduler import StaleScheduler
+
+def CreateScheduler(**kwargs) -> StaleScheduler:
+	options = dict(staleAfter=60, minInterval=10, maxInterval=400, queryRate=1.0, queryBurst=2)
+	options.update(kwargs)
+	return StaleScheduler(**options)
+
+def test_nothing_is_due_before_it_is_stale():
+	scheduler = CreateScheduler()
+	scheduler.opened("1", 0)
+	assert scheduler.takeDue(59) == []
+	assert scheduler.takeDue(60) == ["1"]
+
+def test_due_in_order():
+	scheduler = CreateScheduler(queryBurst=10)
+	for uid, start in [("1", 20), ("2", 0), ("3", 10)]:
+		scheduler.opened(uid, start)
+	assert scheduler.takeDue(100) == ["2", "3", "1"]
+
+def test_take_due_respects_the_rate():
+	scheduler = CreateScheduler()
+	for uid in map(str, range(10)):
+		scheduler.opened(uid, 0)
+	# the burst, then one per second
+	assert len(scheduler.takeDue(60)) == 2
+	assert scheduler.takeDue(60) == []
+	assert len(scheduler.takeDue(60.5)) == 0
+	assert len(scheduler.takeDue(61)) == 1
+	assert len(scheduler.takeDue(64)) == 2
+	# a quiet period only refills up to the burst
+	assert len(scheduler.takeDue(100)) == 2
+	assert len(scheduler) == 10
+
+def test_the_ones_over_the_rate_stay_due():
+	scheduler = CreateScheduler(queryBurst=1)
+	scheduler.opened("1", 0)
+	scheduler.opened("2", 0)
+	assert scheduler.takeDue(60) == ["1"]
+	assert scheduler.takeDue(61) == ["2"]
+
+def test_taken_users_are_checked_again_an_interval_later():
+	# a query that never answers is retried
+	scheduler = CreateScheduler()
+	scheduler.opened("1", 0)
+	assert scheduler.takeDue(60) == ["1"]
+	assert scheduler.takeDue(119) == []
+	assert scheduler.takeDue(120) == ["1"]
+
+def test_backoff_pushes_the_next_check_out():
+	scheduler = CreateScheduler(queryBurst=10)
+	scheduler.opened("1", 0)
+	assert scheduler.takeDue(60) == ["1"]
+	scheduler.confirmed("1", 60)
+	assert scheduler.interval("1") == 120
+	assert scheduler.takeDue(179) == []
+	assert scheduler.takeDue(180) == ["1"]
+	scheduler.confirmed("1", 180)
+	scheduler.confirmed("1", 180)
+	scheduler.confirmed("1", 180)
+	# capped
+	assert scheduler.interval("1") == 400
+	assert scheduler.takeDue(579) == []
+	assert scheduler.takeDue(580) == ["1"]
+
+def test_a_state_change_halves_the_interval():
+	scheduler = CreateScheduler()
+	scheduler.opened("1", 0)
+	scheduler.confirmed("1", 60)
+	scheduler.confirmed("1", 60)
+	assert scheduler.interval("1") == 240
+	scheduler.closed("1")
+	scheduler.opened("1", 300)
+	assert scheduler.interval("1") == 120
+	for _ in range(10):
+		scheduler.opened("1", 300)
+	assert scheduler.interval("1") == 10
+
+def test_a_removed_user_is_never_returned():
+	scheduler = CreateScheduler(queryBurst=10)
+	scheduler.opened("1", 0)
+	scheduler.opened("2", 0)
+	scheduler.closed("1")
+	assert "1" not in scheduler
+	assert scheduler.takeDue(60) == ["2"]
+	assert "1" not in scheduler.takeDue(10000)
+	# confirming a query that came back after the user went offline doesn't bring it back
+	scheduler.confirmed("1", 10000)
+	assert "1" not in scheduler.takeDue(100000)
+
+def test_outdated_entries_are_compacted():
+	scheduler = CreateScheduler()
+	for _ in range(1000):
+		scheduler.opened("1", 0)
+	assert len(scheduler.heap) <= 2 * len(scheduler) + 65
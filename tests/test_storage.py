@@ -0,0 +1,149 @@
+# coding=utf-8
+
+import json
+import errno
+import pytest
+
+from core.storage import (
+	ApplyRecord, ReplayJournal, JournalStorage, RECORD_USER, RECORD_OPEN, RECORD_INTERVAL, RECORD_DROP, JOURNAL_SUFFIX
+)
+from core.replay import CreateOfflineMonitor
+
+AVATAR_KEY = "0123456789abcdef0123456789abcdef01234567"
+
+RECORDS = [
+	[RECORD_USER, "1", "first", AVATAR_KEY, "http://thumbnail", 1],
+	[RECORD_OPEN, "1", "online", 100, 2],
+	[RECORD_INTERVAL, "1", "online", 100, 150, 3],
+	[RECORD_OPEN, "1", "online", 200, 4],
+	[RECORD_OPEN, "1", "active", 210, 5],
+	[RECORD_DROP, "1", "active", 210, 6],
+]
+
+def Replayed(records) -> dict:
+	db = {}
+	for record in records:
+		ApplyRecord(db, record)
+	return {uid: user.toDict() for uid, user in db.items()}
+
+def WriteJournal(path, records, tail: bytes = b""):
+	with open(path, 'wb') as journalFile:
+		journalFile.write("".join(json.dumps(record) + "\n" for record in records).encode('utf-8') + tail)
+
+def test_apply_record():
+	assert Replayed(RECORDS) == {"1": {
+		"online": [[100, 150], [200, None]], "active": [], "mobile": [],
+		"fullname": "first", "image": AVATAR_KEY, "thumbnail": "http://thumbnail"
+	}}
+
+def test_apply_record_returns_version():
+	assert ApplyRecord({}, RECORDS[1]) == 2
+
+def test_replaying_twice_is_a_no_op():
+	# a crash between the journal append and the compaction replays the same records again
+	assert Replayed(RECORDS + RECORDS) == Replayed(RECORDS)
+
+def test_older_records_are_ignored():
+	db = Replayed(RECORDS + [[RECORD_INTERVAL, "1", "online", 50, 60, 7], [RECORD_OPEN, "1", "online", 200, 8]])
+	assert db["1"]["online"] == [[100, 150], [200, None]]
+
+def test_drop_only_removes_the_ongoing_interval():
+	db = Replayed(RECORDS + [[RECORD_DROP, "1", "online", 100, 7]])
+	assert db["1"]["online"] == [[100, 150], [200, None]]
+	db = Replayed(RECORDS + [[RECORD_DROP, "1", "online", 200, 7]])
+	assert db["1"]["online"] == [[100, 150]]
+
+def test_user_record_without_thumbnail():
+	# journaled before the avatar cache and the versions
+	assert Replayed([[RECORD_USER, "2", "second", None]])["2"]["thumbnail"] is None
+
+def test_replay_journal_stops_at_a_torn_record(tmp_path):
+	journalPath = str(tmp_path / "db.json.journal")
+	WriteJournal(journalPath, RECORDS, b'["open", "1", "mob')
+	db = {}
+	validOffset, version = ReplayJournal(db, journalPath)
+	assert validOffset == len("".join(json.dumps(record) + "\n" for record in RECORDS))
+	assert version == 6
+	assert {uid: user.toDict() for uid, user in db.items()} == Replayed(RECORDS)
+
+def test_load_cuts_the_torn_record_off(tmp_path):
+	dbPath = str(tmp_path / "db.json")
+	WriteJournal(dbPath + JOURNAL_SUFFIX, RECORDS[:2], b'["interval", "1"')
+	storage = JournalStorage(dbPath)
+	storage.load()
+	storage.append([RECORDS[2]])
+	storage.close()
+	storage = JournalStorage(dbPath)
+	db = storage.load()
+	storage.close()
+	assert db["1"]["online"].toList() == [[100, 150]]
+	assert storage.version == 3
+
+def test_compaction_keeps_the_db(tmp_path):
+	dbPath = str(tmp_path / "db.json")
+	storage = JournalStorage(dbPath)
+	storage.load()
+	storage.append(RECORDS[:3])
+	storage.compact(wait=True)
+	storage.append(RECORDS[3:])
+	storage.close()
+	storage = JournalStorage(dbPath)
+	db = storage.load()
+	storage.close()
+	assert {uid: user.toDict() for uid, user in db.items()} == Replayed(RECORDS)
+	assert storage.version == 6
+
+def test_dangling_intervals_are_dropped_on_load(tmp_path):
+	# an interval still open on disk was cut by a crash
+	WriteJournal(str(tmp_path / "database.json") + JOURNAL_SUFFIX, RECORDS)
+	pm = CreateOfflineMonitor(str(tmp_path))
+	pm.waitForDatabase()
+	assert pm.db["1"]["online"].toList() == [[100, 150]]
+	assert pm.takePendingRecords() == [[RECORD_DROP, "1", "online", 200, 7]]
+	pm.storage.close()
+
+class TornFile:
+	# writes half of the data, then runs out of space
+
+	def __init__(self, journalFile):
+		self.journalFile = journalFile
+
+	def write(self, data: bytes):
+		self.journalFile.write(data[:len(data) // 2])
+		self.journalFile.flush()
+		raise OSError(errno.ENOSPC, "No space left on device")
+
+	def __getattr__(self, name):
+		return getattr(self.journalFile, name)
+
+def test_failed_append_leaves_no_torn_record(tmp_path):
+	dbPath = str(tmp_path / "db.json")
+	storage = JournalStorage(dbPath)
+	storage.load()
+	storage.append(RECORDS[:2])
+	storage.journalFile = TornFile(storage.journalFile)
+	with pytest.raises(OSError):
+		storage.append(RECORDS[2:4])
+	storage.append(RECORDS[2:])
+	storage.close()
+	storage = JournalStorage(dbPath)
+	db = storage.load()
+	storage.close()
+	assert {uid: user.toDict() for uid, user in db.items()} == Replayed(RECORDS)
+	assert storage.version == 6
+
+def test_failed_save_keeps_the_records(tmp_path):
+	pm = CreateOfflineMonitor(str(tmp_path))
+	pm.waitForDatabase()
+	pm.record(*RECORDS[1][:-1])
+	records = pm.takePendingRecords()
+	pm.record(*RECORDS[2][:-1])
+	pm.storage.journalFile = TornFile(pm.storage.journalFile)
+	with pytest.raises(OSError):
+		pm.saveRecords(records)
+	assert [record[-1] for record in pm.pendingRecords] == [1, 2]
+	pm.saveRecords(pm.takePendingRecords())
+	pm.storage.close()
+	storage = JournalStorage(str(tmp_path / "database.json"))
+	assert storage.load()["1"]["online"].toList() == [[100, 150]]
+	storage.close()
@@ -0,0 +1,63 @@
+# coding=utf-8
+
+import json
+import pytest
+
+from core.store import PresenceStore
+from core.storage import JournalStorage, RECORD_OPEN, RECORD_INTERVAL, JOURNAL_SUFFIX
+
+def AppendRecords(dbPath: str, records: list):
+	with open(dbPath + JOURNAL_SUFFIX, 'a') as journalFile:
+		for record in records:
+			journalFile.write(json.dumps(record) + "\n")
+
+def test_tail_follows_the_journal(tmp_path):
+	dbPath = str(tmp_path / "db.json")
+	AppendRecords(dbPath, [[RECORD_OPEN, "1", "online", 100, 1]])
+	store = PresenceStore(dbPath)
+	store.refresh()
+	AppendRecords(dbPath, [[RECORD_INTERVAL, "1", "online", 100, 150, 2]])
+	store.refresh()
+	assert store.version == 2
+	assert store.db["1"]["online"].toList() == [[100, 150]]
+	assert store.changes[-1] == [RECORD_INTERVAL, "1", "online", 100, 150, 2]
+
+def test_gap_on_disk_is_skipped_after_a_reload(tmp_path):
+	# versions lost for good (a failed append) must not reload the store over and over
+	dbPath = str(tmp_path / "db.json")
+	AppendRecords(dbPath, [[RECORD_OPEN, "1", "online", 100, 1]])
+	store = PresenceStore(dbPath)
+	store.refresh()
+	generation = store.generation
+	AppendRecords(dbPath, [[RECORD_INTERVAL, "1", "online", 100, 150, 4]])
+	store.refresh()
+	assert store.generation == generation + 1
+	assert store.version == 4
+	assert store.db["1"]["online"].toList() == [[100, 150]]
+	AppendRecords(dbPath, [[RECORD_OPEN, "1", "online", 200, 5]])
+	store.refresh()
+	assert store.generation == generation + 1
+	assert store.version == 5
+
+def test_idle_event_stream_is_reset_by_a_reload(tmp_path, monkeypatch):
+	pytest.importorskip("flask")
+	import interface
+	dbPath = str(tmp_path / "db.json")
+	# all in the snapshot, the reload has no change to queue
+	storage = JournalStorage(dbPath)
+	storage.load()
+	storage.append([[RECORD_OPEN, "1", "online", 100, 1]])
+	storage.compact(wait=True)
+	storage.close()
+	store = PresenceStore(dbPath)
+	store.refresh()
+	monkeypatch.setattr(interface, "Store", store)
+	monkeypatch.setattr(interface, "KEEPALIVE_INTERVAL", 0.01)
+	response = interface.app.test_client().get("/events", buffered=False)
+	body = response.response
+	assert b"event: snapshot" in next(body)
+	assert next(body) == b": keepalive\n\n"
+	with store.lock:
+		store.load()
+	assert next(body).startswith(b"event: reset")
+	response.close()